@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import yaml
+
+from mail2alert import config, server
+
+"""
+Compare the time it takes to read a big configuration: YAML with the
+pure Python loader, YAML with the C loader, and compiled.
+
+The configuration has one gocd manager with two rules per pipeline
+group, like the ones scripts/make_gocd_rules.py makes.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+
+def make_configuration(groups):
+    rules = []
+    for i in range(groups):
+        group = 'group-%i' % i
+        for function, args in (
+            ('pipelines.in_group', [group]),
+            ('pipelines.name_like_in_group', [r'(.+)-release.*', group]),
+        ):
+            rules.append({
+                'actions': ['mailto:team-%i@example.com' % (i % 50)],
+                'filter': {
+                    'events': ['FIXED', 'BREAKS'],
+                    'function': function,
+                    'args': args,
+                }
+            })
+    return {
+        'local-smtp': 'localhost:1025',
+        'remote-smtp': 'localhost:8025',
+        'managers': [{
+            'name': 'gocd',
+            'url': 'http://localhost:8153/go',
+            'user': '$GOUSER',
+            'passwd': '$GOPASS',
+            'messages-we-want': {'to': 'mail2alert@example.com'},
+            'rules': rules,
+        }],
+    }
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 2)
+
+
+def benchmark(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'configuration.yml')
+        with open(path, 'w') as conf_file:
+            yaml.dump(make_configuration(args.groups), conf_file)
+        report = server.compile_configuration(path)
+
+        def read_yaml(loader):
+            return lambda: config.read_yaml(path, loader)
+
+        results = {
+            'rules': report['rules'],
+            'yaml_bytes': os.path.getsize(path),
+            'compiled_bytes': os.path.getsize(report['compiled']),
+            'ms': {
+                'yaml-python': timed(read_yaml(yaml.SafeLoader), args.repeat),
+                'compiled': timed(lambda: config.Configuration(path), args.repeat),
+            }
+        }
+        if hasattr(yaml, 'CSafeLoader'):
+            results['ms']['yaml-c'] = timed(read_yaml(yaml.CSafeLoader), args.repeat)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-g', '--groups', type=int, default=2000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
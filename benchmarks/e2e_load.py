@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import subprocess
+import tempfile
+import time
+
+import yaml
+
+from mail2alert import server
+
+from standins import (
+    RelaySink, StandInGoCD, StandInSlack, pipeline_groups, stage_subject
+)
+
+"""
+Load the whole server, as it's deployed, and measure what it does.
+
+mail2alert runs in a process of its own, with a configuration like
+a real one: a gocd manager with a rule per pipeline group, which
+mails and posts to Slack. GoCD, Slack and the remote SMTP server are
+local stand-ins which answer at once. SMTP clients send mail about
+stage runs, mostly passed and some failed, broken, fixed or
+cancelled, plus some mail the manager doesn't want, which is just
+relayed, at a mix of body sizes over concurrent connections.
+
+The result is printed as JSON, and written to --output, to compare
+with later, e.g.
+
+    python benchmarks/e2e_load.py -o before.json
+    ...
+    python benchmarks/e2e_load.py --compare before.json
+
+Latency is from MAIL FROM to the reply to the message data, which
+mail2alert sends when it has dispatched and relayed the message.
+Slack posts are queued, so they are counted after the load, when
+the stand-ins stop getting anything.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+SMTP_PORT = 8130
+RELAY_PORT = 8131
+GOCD_PORT = 8132
+SLACK_PORT = 8133
+
+MAIL_FROM = 'go@example.com'
+MAIL2ALERT = 'mail2alert@example.com'
+OTHERS = 'ops@example.com'
+
+
+def configuration(groups, slack, gocd):
+    return {
+        'local-smtp': 'localhost:%i' % SMTP_PORT,
+        'remote-smtp': 'localhost:%i' % RELAY_PORT,
+        'managers': [
+            {
+                'name': 'gocd',
+                'url': gocd.url,
+                'user': 'bench',
+                'passwd': 'bench',
+                'messages-we-want': {'to': MAIL2ALERT},
+                'slack-token': 'bench',
+                'slack-api-url': slack.url,
+                'slack-queue': {
+                    'max-pending': 100000,
+                    'rate': 10000,
+                    'burst': 10000,
+                    'concurrency': 16,
+                },
+                'rules': [
+                    {
+                        'actions': [
+                            'mailto:%s@example.com' % group['name'],
+                            'slack:#%s' % group['name'],
+                        ],
+                        'filter': {
+                            'events': ['BREAKS', 'FAILS', 'FIXED'],
+                            'function': 'pipelines.in_group',
+                            'args': [group['name']],
+                        },
+                    }
+                    for group in groups
+                ],
+            },
+        ],
+    }
+
+
+def body(size, i):
+    line = 'revision: pipeline/%08i/stage/1, modified by someone on 2019-01-01\n' % i
+    return line * max(size // len(line), 1)
+
+
+def message(i, groups, sizes, passthrough, rng):
+    group = rng.choice(groups)
+    pipeline = rng.choice(group['pipelines'])['name']
+    subject = stage_subject(pipeline, i, rng)
+    rcpt = OTHERS if rng.random() < passthrough else MAIL2ALERT
+    text = (
+        'From: <%s>\n'
+        'To: <%s>\n'
+        'Subject: %s\n'
+        'MIME-Version: 1.0\n'
+        'Content-Type: text/plain; charset="UTF-8"\n'
+        '\n'
+        '%s' % (MAIL_FROM, rcpt, subject, body(rng.choice(sizes) * 1024, i))
+    )
+    return rcpt, text.replace('\n', '\r\n').encode('utf-8')
+
+
+class SMTPClient:
+    """
+    Just enough of an SMTP client to send mail, without the threads
+    smtplib would need.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port):
+        client = cls(*await asyncio.open_connection(host, port))
+        await client.reply()
+        await client.command(b'EHLO localhost')
+        return client
+
+    async def reply(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('SMTP server closed the connection')
+            if line[3:4] != b'-':
+                code = int(line[:3])
+                if code >= 400:
+                    raise RuntimeError(line.decode('utf-8', 'replace').strip())
+                return code
+
+    async def command(self, line):
+        self.writer.write(line + b'\r\n')
+        return await self.reply()
+
+    async def send(self, rcpt, data):
+        await self.command(b'MAIL FROM:<%s>' % MAIL_FROM.encode('ascii'))
+        await self.command(b'RCPT TO:<%s>' % rcpt.encode('ascii'))
+        await self.command(b'DATA')
+        if data.startswith(b'.'):
+            data = b'.' + data
+        self.writer.write(data.replace(b'\r\n.', b'\r\n..') + b'\r\n.\r\n')
+        await self.reply()
+
+    async def quit(self):
+        await self.command(b'QUIT')
+        self.writer.close()
+
+
+async def smtp_client(messages, latencies):
+    client = await SMTPClient.connect('localhost', SMTP_PORT)
+    for rcpt, data in messages:
+        start = time.perf_counter()
+        await client.send(rcpt, data)
+        latencies.append(time.perf_counter() - start)
+    await client.quit()
+
+
+def percentile(ordered, share):
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+def memory(pid):
+    """
+    Resident set size, now and at most, in KiB, on Linux.
+    """
+    try:
+        with open('/proc/%i/status' % pid) as status:
+            fields = dict(line.split(':', 1) for line in status)
+    except OSError:
+        return None
+    return {
+        'rss_kb': int(fields['VmRSS'].split()[0]),
+        'peak_rss_kb': int(fields['VmHWM'].split()[0]),
+    }
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        with open('VERSION') as version_file:
+            return version_file.read().strip()
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('localhost', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+async def drain(counters, quiet=0.5, timeout=30):
+    """
+    Wait until the counts stop changing, since Slack posts are
+    queued, and return the seconds it took.
+    """
+    start = time.perf_counter()
+    counts = counters()
+    still = time.monotonic()
+    while time.perf_counter() - start < timeout:
+        await asyncio.sleep(0.05)
+        if counters() != counts:
+            counts = counters()
+            still = time.monotonic()
+        elif time.monotonic() - still >= quiet:
+            break
+    return time.perf_counter() - start - quiet
+
+
+async def load(args, pid, relay, slack):
+    rng = random.Random(args.seed)
+    groups = pipeline_groups(args.groups, args.pipelines)
+    per_client = args.messages // args.concurrency
+    batches = [
+        [
+            message(c * per_client + i, groups, args.sizes, args.passthrough, rng)
+            for i in range(per_client)
+        ]
+        for c in range(args.concurrency)
+    ]
+    if args.warmup:
+        await smtp_client(batches[0][:args.warmup], [])
+        await drain(lambda: (relay.received, slack.posts))
+        relay.received = slack.posts = 0
+    before = memory(pid)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        smtp_client(batch, latencies) for batch in batches
+    ])
+    elapsed = time.perf_counter() - start
+    drained = await drain(lambda: (relay.received, slack.posts))
+    latencies.sort()
+    sent = per_client * args.concurrency
+    return {
+        'messages': sent,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(sent / elapsed, 1),
+        'latency_ms': {
+            name: round(percentile(latencies, share) * 1000, 2)
+            for name, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))
+        },
+        'relayed': relay.received,
+        'slack_posts': slack.posts,
+        'drain_seconds': round(max(drained, 0), 3),
+        'memory_before': before,
+        'memory_after': memory(pid),
+    }
+
+
+async def benchmark(args):
+    gocd = StandInGoCD(GOCD_PORT, pipeline_groups(args.groups, args.pipelines))
+    slack = StandInSlack(SLACK_PORT)
+    relay = RelaySink(RELAY_PORT)
+    for stand_in in (gocd, slack, relay):
+        await stand_in.start()
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='mail2alert-bench-') as directory:
+            config_path = os.path.join(directory, 'configuration.yml')
+            with open(config_path, 'w') as config_file:
+                yaml.safe_dump(configuration(gocd.groups, slack, gocd), config_file)
+            os.environ['MAIL2ALERT_CONFIGURATION'] = config_path
+            # Spawn, so the server doesn't inherit our event loop.
+            process = multiprocessing.get_context('spawn').Process(
+                target=server.main,
+                args=(args.loglevel, args.event_loop)
+            )
+            process.start()
+            try:
+                await wait_for_port(SMTP_PORT)
+                return await load(args, process.pid, relay, slack)
+            finally:
+                os.kill(process.pid, signal.SIGINT)
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+    finally:
+        for stand_in in (relay, slack, gocd):
+            await stand_in.stop()
+
+
+def compare(results, baseline):
+    """
+    Relative change of the main figures, in percent.
+    """
+    def figures(run):
+        yield 'messages_per_second', run['messages_per_second']
+        for name, value in run['latency_ms'].items():
+            yield 'latency_ms_' + name, value
+        if run.get('memory_after'):
+            yield 'peak_rss_kb', run['memory_after']['peak_rss_kb']
+
+    old = dict(figures(baseline['results']))
+    return {
+        name: {
+            'baseline': old[name],
+            'current': value,
+            'change_percent': round((value - old[name]) * 100 / old[name], 1),
+        }
+        for name, value in figures(results)
+        if old.get(name)
+    }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--messages', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument(
+        '-s', '--sizes', type=lambda sizes: [int(s) for s in sizes.split(',')],
+        default=[1, 8, 64],
+        help='body sizes in KiB, picked at random, default 1,8,64'
+    )
+    parser.add_argument('-g', '--groups', type=int, default=20)
+    parser.add_argument('-p', '--pipelines', type=int, default=10,
+                        help='pipelines per group')
+    parser.add_argument('--passthrough', type=float, default=0.1,
+                        help='share of mail which the gocd manager does not want')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--event-loop', choices=server.EVENT_LOOPS, default='auto',
+                        help='the event loop of the server')
+    parser.add_argument('--loglevel', default='WARNING')
+    return parser
+
+
+def main():
+    parser = make_parser()
+    parser.add_argument('-o', '--output', help='write the result to this file')
+    parser.add_argument('--compare', help='a result written before, to compare with')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(benchmark(args))
+    report = {
+        'version': version(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': {
+            key: value for key, value in vars(args).items()
+            if key not in ('output', 'compare', 'loglevel')
+        },
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as baseline:
+            report['comparison'] = compare(results, json.load(baseline))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+from e2e_load import benchmark, make_parser
+
+"""
+Compare SMTP throughput and latency of the server with each event
+loop implementation which is installed, under the load of
+e2e_load.py, which takes the same options.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+
+def installed():
+    loops = ['asyncio']
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        loops.append('uvloop')
+    return loops
+
+
+def main():
+    parser = make_parser()
+    parser.add_argument('--loops', type=lambda loops: loops.split(','),
+                        default=installed(),
+                        help='event loops to compare, default those installed')
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    report = {}
+    for name in args.loops:
+        args.event_loop = name
+        results = loop.run_until_complete(benchmark(args))
+        report[name] = {
+            'messages_per_second': results['messages_per_second'],
+            'latency_ms': results['latency_ms'],
+            'peak_rss_kb': (results['memory_after'] or {}).get('peak_rss_kb'),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
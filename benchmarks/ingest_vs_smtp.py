@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from smtplib import SMTP
+
+import aiohttp
+
+from mail2alert import server
+from mail2alert.ingest import IngestServer
+from mail2alert.plugin import mail
+
+"""
+Compare the throughput of the SMTP listener with HTTP ingest.
+
+Both paths feed a mail manager with one mailto rule, and mail to
+the remote SMTP server is counted rather than sent. SMTP clients
+send one message per transaction over persistent connections, and
+HTTP clients post batches over keep-alive connections.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+SMTP_PORT = 8125
+HTTP_PORT = 8102
+
+
+class CountingProxy(server.Mail2AlertProxy):
+    delivered = 0
+
+    def _deliver(self, mail_from, rcpt_tos, data):
+        self.delivered += 1
+        return {}
+
+
+def make_proxy():
+    manager = mail.Manager({
+        'messages-we-want': {'from': 'go@example.com'},
+        'rules': [
+            {
+                'actions': ['mailto:sys@example.com'],
+                'filter': {'function': 'mail.in_subject', 'args': ['backup']},
+            },
+        ]
+    })
+    return CountingProxy('localhost', 8025, [manager])
+
+
+def subject(i):
+    return 'Server backup %i %s' % (i, 'failed' if i % 2 else 'completed')
+
+
+def smtp_client(first, count):
+    client = SMTP('localhost', SMTP_PORT)
+    for i in range(first, first + count):
+        msg = EmailMessage()
+        msg['Subject'] = subject(i)
+        msg['From'] = 'go@example.com'
+        msg['To'] = 'mail2alert@example.com'
+        msg.set_content('Backup report %i\n' % i)
+        client.send_message(msg)
+    client.quit()
+
+
+async def run_smtp(messages, concurrency):
+    loop = asyncio.get_event_loop()
+    per_client = messages // concurrency
+    with ThreadPoolExecutor(concurrency) as executor:
+        await asyncio.gather(*[
+            loop.run_in_executor(executor, smtp_client, c * per_client, per_client)
+            for c in range(concurrency)
+        ])
+    return per_client * concurrency
+
+
+async def http_client(session, first, count, batch_size):
+    url = 'http://localhost:%i/events' % HTTP_PORT
+    for start in range(first, first + count, batch_size):
+        events = [
+            {
+                'from': 'go@example.com',
+                'to': ['mail2alert@example.com'],
+                'subject': subject(i),
+                'body': 'Backup report %i\n' % i,
+            }
+            for i in range(start, min(start + batch_size, first + count))
+        ]
+        async with session.post(url, json=events) as response:
+            await response.read()
+
+
+async def run_http(messages, concurrency, batch_size):
+    per_client = messages // concurrency
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[
+            http_client(session, c * per_client, per_client, batch_size)
+            for c in range(concurrency)
+        ])
+    return per_client * concurrency
+
+
+async def timed(name, coro, proxy):
+    proxy.delivered = 0
+    start = time.perf_counter()
+    sent = await coro
+    elapsed = time.perf_counter() - start
+    return name, dict(
+        messages=sent,
+        delivered=proxy.delivered,
+        seconds=round(elapsed, 3),
+        messages_per_second=round(sent / elapsed, 1)
+    )
+
+
+async def benchmark(args):
+    proxy = make_proxy()
+    controller = server.SMTPUTF8Controller(
+        proxy,
+        hostname='localhost',
+        port=SMTP_PORT
+    )
+    controller.start()
+    ingest = IngestServer(proxy)
+    await ingest.start('localhost', HTTP_PORT)
+    try:
+        results = [
+            await timed('smtp', run_smtp(args.messages, args.concurrency), proxy),
+            await timed('http', run_http(args.messages, args.concurrency, 1), proxy),
+            await timed(
+                'http-batch-%i' % args.batch_size,
+                run_http(args.messages, args.concurrency, args.batch_size),
+                proxy
+            ),
+        ]
+    finally:
+        await ingest.stop()
+        controller.stop()
+    return dict(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--messages', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('-b', '--batch-size', type=int, default=50)
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    print(json.dumps(loop.run_until_complete(benchmark(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from mail2alert import server
+from mail2alert.mime import MimeOffload
+from mail2alert.plugin import mail
+
+"""
+How big messages affect the latency of small ones, with the MIME
+work on big messages done inline, and in worker processes.
+
+A mail manager gets small messages at a steady rate, while big
+ones arrive alongside. Each message goes through the proxy, as from
+the SMTP server: the manager parses it and checks its rules, and the
+To and From of the mail it relays are rewritten. Relayed mail is
+counted, not sent. Latency is the time from when a small message is
+due until it's been handled, so it includes the time it waited for
+the event loop, e.g. while a big message was parsed inline.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+MAIL_FROM = 'go@example.com'
+MAIL2ALERT = 'mail2alert@example.com'
+
+
+class CountingProxy(server.Mail2AlertProxy):
+    delivered = 0
+
+    async def deliver(self, mail_from, rcpt_tos, data):
+        self.delivered += 1
+        return {}
+
+
+def message(i, size):
+    line = 'revision: pipeline/%08i/stage/1, modified by someone on 2019-01-01\n' % i
+    text = (
+        'From: <%s>\n'
+        'To: <%s>\n'
+        'Subject: Build %i failed\n'
+        'MIME-Version: 1.0\n'
+        'Content-Type: text/plain; charset="UTF-8"\n'
+        '\n'
+        '%s' % (MAIL_FROM, MAIL2ALERT, i, line * max(size // len(line), 1))
+    )
+    return text.replace('\n', '\r\n').encode('utf-8')
+
+
+def manager():
+    return mail.Manager({
+        'messages-we-want': {'to': MAIL2ALERT},
+        'rules': [
+            {
+                'actions': ['mailto:sys@example.com'],
+                'filter': {
+                    'function': 'mail.in_subject',
+                    'args': ['failed'],
+                },
+            },
+        ],
+    })
+
+
+def percentile(ordered, share):
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+async def small_messages(proxy, count, interval, size, latencies):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for i in range(count):
+        due = start + i * interval
+        await asyncio.sleep(max(due - loop.time(), 0))
+        await proxy._adeliver(MAIL_FROM, [MAIL2ALERT], message(i, size))
+        latencies.append(loop.time() - due)
+
+
+async def big_messages(proxy, count, interval, size):
+    data = message(0, size)
+    pending = []
+    for _ in range(count):
+        await asyncio.sleep(interval)
+        pending.append(asyncio.ensure_future(
+            proxy._adeliver(MAIL_FROM, [MAIL2ALERT], data)
+        ))
+    await asyncio.gather(*pending)
+
+
+async def run(args, mime):
+    proxy = CountingProxy('localhost', 0, [manager()], mime)
+    if mime.workers:
+        # Start the workers, which takes a while, before timing.
+        await mime.parse(message(0, 1))
+    latencies = []
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(
+            small_messages(
+                proxy,
+                args.messages,
+                args.interval / 1000,
+                args.small_kb * 1024,
+                latencies
+            ),
+            big_messages(
+                proxy,
+                args.big,
+                args.messages * args.interval / 1000 / (args.big + 1),
+                args.big_kb * 1024
+            ),
+        )
+    finally:
+        mime.close()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'seconds': round(elapsed, 3),
+        'relayed': proxy.delivered,
+        'small_latency_ms': {
+            name: round(percentile(latencies, share) * 1000, 2)
+            for name, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--messages', type=int, default=500,
+                        help='small messages')
+    parser.add_argument('-i', '--interval', type=float, default=10,
+                        help='milliseconds between small messages')
+    parser.add_argument('--small-kb', type=int, default=2)
+    parser.add_argument('-b', '--big', type=int, default=10,
+                        help='big messages, spread over the run')
+    parser.add_argument('--big-kb', type=int, default=1024)
+    parser.add_argument('--threshold-kb', type=int, default=256)
+    parser.add_argument('-w', '--workers', type=int, default=2)
+    parser.add_argument('--loglevel', default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    loop = asyncio.get_event_loop()
+    report = {
+        'params': vars(args),
+        'inline': loop.run_until_complete(run(args, MimeOffload(workers=0))),
+        'offload': loop.run_until_complete(run(args, MimeOffload(
+            threshold_kb=args.threshold_kb,
+            workers=args.workers
+        ))),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
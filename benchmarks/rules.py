@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import timeit
+
+from mail2alert.actions import Actions
+from mail2alert.plugin import gocd, mail
+
+from standins import pipeline_groups, stage_subject
+
+"""
+Microbenchmarks of the rule engine: parsing GoCD subjects, the rule
+functions, GocdRule.check and Actions, and the cost of routing a
+message, i.e. gocd.Manager.matching_actions, as the configuration
+grows.
+
+A synthetic configuration has G pipeline groups of M pipelines, and
+R rules, which use pipelines.in_group, pipelines.in_any_group and
+pipelines.name_like_in_group in turn. The scaling curves grow one
+of G, M and R at a time, from the defaults.
+
+Times are in microseconds per message. Since they depend on the
+machine, they are also given relative to a fixed piece of Python
+code, and the regression gate compares those. The reference code is
+timed in turn with each item, so that the machine getting faster or
+slower during the run cancels out, and the medians of --repeat such
+rounds are reported:
+
+    python benchmarks/rules.py --save benchmarks/baselines/rules.json
+    python benchmarks/rules.py --check benchmarks/baselines/rules.json
+
+--check exits with status 1 if anything got slower than the
+baseline by more than --tolerance.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+GROUPS = 50
+PIPELINES = 20
+RULES = 50
+MESSAGES = 1000
+
+
+def rule_confs(groups, count, rng):
+    names = [group['name'] for group in groups]
+    rules = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            function, args = 'pipelines.in_group', [rng.choice(names)]
+        elif kind == 1:
+            function, args = 'pipelines.in_any_group', rng.sample(names, min(3, len(names)))
+        else:
+            function, args = 'pipelines.name_like_in_group', [r'(.+)-release.*', rng.choice(names)]
+        rules.append({
+            'actions': [
+                'mailto:team-%i@example.com' % (i % 10),
+                'slack:#team-%i' % (i % 10),
+            ],
+            'filter': {
+                'events': ['BREAKS', 'FAILS', 'FIXED'],
+                'function': function,
+                'args': args,
+            },
+        })
+    return rules
+
+
+def subjects(groups, count, rng):
+    pipelines = [
+        pipeline['name']
+        for group in groups
+        for pipeline in group['pipelines']
+    ]
+    return [stage_subject(rng.choice(pipelines), i, rng) for i in range(count)]
+
+
+class Setup:
+    """
+    A synthetic configuration, and messages for it.
+    """
+
+    def __init__(self, groups=GROUPS, pipelines=PIPELINES, rules=RULES,
+                 messages=MESSAGES, seed=1):
+        rng = random.Random(seed)
+        self.groups = pipeline_groups(groups, pipelines)
+        self.pipelines = gocd.Pipelines(self.groups)
+        self.functions = {'pipelines': self.pipelines}
+        self.manager = gocd.Manager({
+            'name': 'gocd',
+            'url': 'http://localhost:8153/go',
+            'messages-we-want': {'to': 'mail2alert@example.com'},
+            'rules': rule_confs(self.groups, rules, rng),
+        })
+        server = self.manager.default_server
+        server._pipeline_groups = self.groups
+        # Never stale, so they're never fetched.
+        server._pipeline_groups_time = float('inf')
+        self.rules = self.manager.rule_list
+        self.subjects = subjects(self.groups, messages, rng)
+        self.messages = [
+            gocd.Message(None, fields={'Subject': subject})
+            for subject in self.subjects
+        ]
+
+    def route(self):
+        """
+        gocd.Manager.matching_actions for each message.
+        """
+        asyncio.get_event_loop().run_until_complete(self._route())
+
+    async def _route(self):
+        for msg in self.messages:
+            await self.manager.matching_actions(msg)
+
+
+def calibrated(function):
+    """
+    A timer for function, and how many calls to time at once, so
+    that each timing takes at least 0.2 seconds.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return timer, number
+
+
+def per_call(function, calls, repeat):
+    """
+    The time of function, which makes calls calls, in microseconds
+    per call, and relative to the reference code: the medians of
+    repeat rounds, which each time the reference code and function.
+    """
+    reference_timer, reference_number = calibrated(reference)
+    timer, number = calibrated(function)
+    times = []
+    ratios = []
+    for _ in range(repeat):
+        unit = reference_timer.timeit(reference_number) / reference_number
+        time = timer.timeit(number) / number / calls
+        times.append(time * 1e6)
+        ratios.append(time / unit)
+    return statistics.median(times), statistics.median(ratios)
+
+
+def reference():
+    """
+    Python code which won't change, to time the machine with.
+    """
+    total = 0
+    for i in range(1000):
+        total += len(str(i)) * i % 7
+    return total
+
+
+def micro(setup, repeat):
+    messages = setup.messages
+    pipelines = setup.pipelines
+    in_group = pipelines.in_group('group-0')
+    in_any_group = pipelines.in_any_group('group-0', 'group-1', 'group-2')
+    name_like = pipelines.name_like_in_group(r'(.+)-release.*', 'group-0')
+    in_subject = mail.Mail.in_subject('build', 'failed')
+    rule = setup.rules[0]
+    functions = setup.functions
+    targets = [
+        'mailto:team-1@example.com',
+        'slack:#team-1',
+        'mailto:team-1@example.com',
+        'slack:#team-2:full',
+    ]
+    count = len(messages)
+
+    def each(check):
+        return lambda: [check(msg) for msg in messages]
+
+    return {
+        'message_parse': per_call(
+            lambda: [gocd.Message(None, fields={'Subject': s}) for s in setup.subjects],
+            count,
+            repeat
+        ),
+        'in_group': per_call(each(in_group), count, repeat),
+        'in_any_group': per_call(each(in_any_group), count, repeat),
+        'name_like_in_group': per_call(each(name_like), count, repeat),
+        'in_subject': per_call(each(in_subject), count, repeat),
+        'rule_check': per_call(each(lambda msg: rule.check(msg, functions)), count, repeat),
+        'actions': per_call(lambda: Actions(targets), 1, repeat),
+        'route': per_call(setup.route, count, repeat),
+    }
+
+
+def curves(sizes, repeat):
+    """
+    Routing cost per message as each dimension grows.
+    """
+    result = {}
+    for dimension in ('groups', 'pipelines', 'rules'):
+        result[dimension] = {
+            str(size): per_call(
+                Setup(**{dimension: size}).route,
+                MESSAGES,
+                repeat
+            )
+            for size in sizes[dimension]
+        }
+    return result
+
+
+def benchmark(args):
+    timings = {
+        'micro': micro(Setup(), args.repeat),
+        'curves': curves(
+            {
+                'groups': args.groups,
+                'pipelines': args.pipelines,
+                'rules': args.rules,
+            },
+            args.repeat
+        ),
+    }
+    unit, _ = per_call(reference, 1, args.repeat)
+    return {
+        'reference_us': round(unit, 2),
+        'us': round_all(pick(timings, 0), 3),
+        'relative': round_all(pick(timings, 1), 5),
+    }
+
+
+def pick(timings, index):
+    if isinstance(timings, dict):
+        return {key: pick(value, index) for key, value in timings.items()}
+    return timings[index]
+
+
+def round_all(timings, digits):
+    if isinstance(timings, dict):
+        return {key: round_all(value, digits) for key, value in timings.items()}
+    return round(timings, digits)
+
+
+def flatten(timings, prefix=''):
+    for key, value in timings.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + '/')
+        else:
+            yield prefix + key, value
+
+
+def regressions(report, baseline, tolerance):
+    """
+    Timings which are more than tolerance slower than the baseline,
+    relative to the reference code.
+    """
+    old = dict(flatten(baseline['relative']))
+    return {
+        name: {
+            'baseline': old[name],
+            'current': value,
+            'change_percent': round((value - old[name]) * 100 / old[name], 1),
+        }
+        for name, value in flatten(report['relative'])
+        if name in old and value > old[name] * (1 + tolerance)
+    }
+
+
+def sizes(text):
+    return [int(size) for size in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-g', '--groups', type=sizes, default=[10, 100, 1000],
+                        help='pipeline groups for the scaling curve')
+    parser.add_argument('-p', '--pipelines', type=sizes, default=[5, 20, 100],
+                        help='pipelines per group for the scaling curve')
+    parser.add_argument('-r', '--rules', type=sizes, default=[10, 100, 1000],
+                        help='rules for the scaling curve')
+    parser.add_argument('--repeat', type=int, default=9)
+    parser.add_argument('--save', help='write the result as a baseline')
+    parser.add_argument('--check', help='a baseline to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    if args.check:
+        with open(args.check) as baseline_file:
+            report['regressions'] = regressions(
+                report,
+                json.load(baseline_file),
+                args.tolerance
+            )
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or '.', exist_ok=True)
+        with open(args.save, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+    print(json.dumps(report, indent=2))
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from aiohttp import web
+
+from mail2alert.plugin.mail import Message
+from mail2alert.slackbot import SlackClient, SlackMessage
+
+"""
+Compare Slack posts through one long-lived SlackClient with the
+previous way of posting, which read the configuration and set up a
+new HTTP session for each post.
+
+Posts go to a local stand-in for the Slack API, which answers
+chat.postMessage after an optional delay, so the numbers show the
+overhead on our side rather than the latency of Slack.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+PORT = 8103
+
+CONFIGURATION = """\
+---
+local-smtp: localhost:1025
+remote-smtp: localhost:8025
+slack-token: xoxb-benchmark
+slack-api-url: http://localhost:%i/api/
+managers: []
+""" % PORT
+
+
+class Action:
+    def __init__(self, destination, style='brief'):
+        self.destination = destination
+        self.style = style
+
+
+class StandInSlack:
+    def __init__(self, delay):
+        self.delay = delay
+        self.posts = 0
+        self.app = web.Application()
+        self.app.router.add_post('/api/chat.postMessage', self.post_message)
+        self._runner = None
+
+    async def post_message(self, request):
+        await request.json()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.posts += 1
+        return web.json_response({'ok': True, 'ts': str(self.posts)})
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, 'localhost', PORT).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def make_message(i):
+    msg = Message(b'Backup report\n')
+    msg['From'] = 'go@example.com'
+    msg['Subject'] = 'Server backup %i failed' % i
+    return msg
+
+
+async def post_per_message_session(count):
+    for i in range(count):
+        await SlackMessage(make_message(i)).post([Action('#ops')])
+
+
+async def post_persistent_client(count):
+    slack = SlackClient.from_conf({})
+    try:
+        for i in range(count):
+            await SlackMessage(make_message(i)).post([Action('#ops')], slack)
+    finally:
+        await slack.close()
+
+
+async def timed(name, coro, stand_in, count):
+    stand_in.posts = 0
+    start = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - start
+    return name, dict(
+        posts=stand_in.posts,
+        seconds=round(elapsed, 3),
+        ms_per_post=round(1000 * elapsed / count, 3)
+    )
+
+
+async def benchmark(args):
+    stand_in = StandInSlack(args.delay / 1000)
+    await stand_in.start()
+    try:
+        results = [
+            await timed(
+                'per-message-session',
+                post_per_message_session(args.posts),
+                stand_in,
+                args.posts
+            ),
+            await timed(
+                'persistent-client',
+                post_persistent_client(args.posts),
+                stand_in,
+                args.posts
+            ),
+        ]
+    finally:
+        await stand_in.stop()
+    results = dict(results)
+    results['ms_saved_per_post'] = round(
+        results['per-message-session']['ms_per_post'] -
+        results['persistent-client']['ms_per_post'],
+        3
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--posts', type=int, default=500)
+    parser.add_argument('-d', '--delay', type=float, default=0,
+                        help='milliseconds the stand-in waits per post')
+    args = parser.parse_args()
+    with tempfile.NamedTemporaryFile('w', suffix='.yml') as conf_file:
+        conf_file.write(CONFIGURATION)
+        conf_file.flush()
+        os.environ['MAIL2ALERT_CONFIGURATION'] = conf_file.name
+        loop = asyncio.get_event_loop()
+        print(json.dumps(loop.run_until_complete(benchmark(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+from mail2alert import server
+from mail2alert.plugin import gocd
+
+from standins import StandInGoCD, StandInSlack, pipeline_groups, stage_subject
+
+"""
+Soak test: replay a great many messages through a gocd manager and
+the proxy, and check that memory levels off.
+
+Most messages are about pipelines in the configured groups, and
+some are about pipelines with names never seen before, e.g. for
+release branches, so the stage states keep getting new keys. Rules
+mail, and post broken stages to a local Slack stand-in, through the
+Slack queue. Mail to the remote SMTP server is counted, not sent.
+
+Memory is traced with tracemalloc. After a warm-up, which should
+fill the bounded stores such as the stage states and the Slack
+threads, a snapshot is taken every --interval messages. The report
+has the traced memory and RSS over time, and the allocation sites
+which grew the most since the warm-up. The run fails, with exit
+status 1, if traced memory grew by more than --max-growth-kb after
+the warm-up, or the stage states outgrew state-max-stages.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+GOCD_PORT = 8134
+SLACK_PORT = 8135
+
+MAIL_FROM = 'go@example.com'
+MAIL2ALERT = 'mail2alert@example.com'
+
+TEMPLATE = (
+    'From: <%s>\r\n'
+    'To: <%s>\r\n'
+    'Subject: %%s\r\n'
+    'MIME-Version: 1.0\r\n'
+    'Content-Type: text/plain; charset="UTF-8"\r\n'
+    '\r\n'
+    '%%s' % (MAIL_FROM, MAIL2ALERT)
+)
+
+# Allocations by the soak test itself, or by tracing, don't count.
+IGNORE = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+class CountingProxy(server.Mail2AlertProxy):
+    delivered = 0
+
+    async def deliver(self, mail_from, rcpt_tos, data):
+        self.delivered += 1
+        return {}
+
+
+def configuration(groups, gocd_url, slack_url, max_stages):
+    return {
+        'name': 'gocd',
+        'url': gocd_url,
+        'user': 'soak',
+        'passwd': 'soak',
+        'state-max-stages': max_stages,
+        'messages-we-want': {'to': MAIL2ALERT},
+        'slack-token': 'soak',
+        'slack-api-url': slack_url,
+        'slack-queue': {'rate': 10000, 'burst': 10000},
+        'slack-threads': {'max-size': max_stages},
+        'rules': [
+            {
+                'actions': ['mailto:%s@example.com' % group['name']],
+                'filter': {
+                    'events': ['BREAKS', 'FAILS', 'FIXED'],
+                    'function': 'pipelines.in_group',
+                    'args': [group['name']],
+                },
+            }
+            for group in groups
+        ] + [
+            {
+                'actions': ['slack:#builds'],
+                'filter': {
+                    'events': ['BREAKS'],
+                    'function': 'pipelines.any',
+                },
+            },
+        ],
+    }
+
+
+def messages(count, groups, new_share, body_size, seed):
+    rng = random.Random(seed)
+    known = [
+        pipeline['name']
+        for group in groups
+        for pipeline in group['pipelines']
+    ]
+    body = 'revision: build/1, modified by someone on 2019-01-01\r\n' * (
+        body_size // 52 + 1
+    )
+    for i in range(count):
+        if rng.random() < new_share:
+            pipeline = 'release-%i' % i
+        else:
+            pipeline = rng.choice(known)
+        subject = stage_subject(pipeline, i, rng)
+        yield (TEMPLATE % (subject, body)).encode('utf-8')
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def sample(sent, manager):
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot().filter_traces(IGNORE)
+    server_ = manager.default_server
+    return snapshot, {
+        'messages': sent,
+        'traced_kb': sum(stat.size for stat in snapshot.statistics('filename')) // 1024,
+        'rss_kb': rss_kb(),
+        'stage_states': len(server_.previous_pipeline_state),
+        'slack_threads': len(manager.slack_threads or ()),
+        'slack_pending': manager.slack_dispatcher.pending if manager.slack_dispatcher else 0,
+    }
+
+
+async def soak(args):
+    groups = pipeline_groups(args.groups, args.pipelines)
+    gocd_stand_in = StandInGoCD(GOCD_PORT, groups)
+    slack = StandInSlack(SLACK_PORT)
+    await gocd_stand_in.start()
+    await slack.start()
+    manager = gocd.Manager(configuration(
+        groups,
+        gocd_stand_in.url,
+        slack.url,
+        args.max_stages
+    ))
+    manager.validate()
+    proxy = CountingProxy('localhost', 0, [manager])
+    manager.relay = proxy
+    await manager.async_init()
+
+    tracemalloc.start(args.frames)
+    start = time.perf_counter()
+    base = None
+    samples = []
+    try:
+        for sent, data in enumerate(messages(
+            args.messages,
+            groups,
+            args.new_share,
+            args.body_size,
+            args.seed
+        ), 1):
+            await proxy._adeliver(MAIL_FROM, [MAIL2ALERT], data)
+            while manager.slack_dispatcher.pending > args.slack_backlog:
+                # Let the Slack queue catch up, rather than drop posts.
+                await asyncio.sleep(0.001)
+            if sent == args.warmup or (sent > args.warmup and sent % args.interval == 0):
+                snapshot, stats = sample(sent, manager)
+                samples.append(stats)
+                print(json.dumps(stats), file=sys.stderr)
+                if base is None:
+                    base = snapshot
+        elapsed = time.perf_counter() - start
+        final, stats = sample(args.messages, manager)
+        if samples[-1]['messages'] != args.messages:
+            samples.append(stats)
+    finally:
+        tracemalloc.stop()
+        await manager.close()
+        await slack.stop()
+        await gocd_stand_in.stop()
+
+    growth = samples[-1]['traced_kb'] - samples[0]['traced_kb']
+    failures = []
+    if growth > args.max_growth_kb:
+        failures.append(
+            'Traced memory grew by %i KiB after the warm-up, more than %i KiB'
+            % (growth, args.max_growth_kb)
+        )
+    if samples[-1]['stage_states'] > args.max_stages:
+        failures.append(
+            '%i stage states, more than %i'
+            % (samples[-1]['stage_states'], args.max_stages)
+        )
+    return {
+        'messages': args.messages,
+        'seconds': round(elapsed, 1),
+        'relayed': proxy.delivered,
+        'slack_posts': slack.posts,
+        'growth_kb': growth,
+        'samples': samples,
+        'top_growth': [
+            {
+                'site': str(stat.traceback),
+                'size_kb': round(stat.size_diff / 1024, 1),
+                'count': stat.count_diff,
+            }
+            for stat in final.compare_to(base, 'traceback' if args.frames > 1 else 'lineno')[:args.top]
+        ],
+        'failures': failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--messages', type=int, default=1000000)
+    parser.add_argument('-w', '--warmup', type=int, default=50000)
+    parser.add_argument('-i', '--interval', type=int, default=100000,
+                        help='messages between snapshots')
+    parser.add_argument('-g', '--groups', type=int, default=20)
+    parser.add_argument('-p', '--pipelines', type=int, default=10,
+                        help='pipelines per group')
+    parser.add_argument('--new-share', type=float, default=0.3,
+                        help='share of messages about new pipelines')
+    parser.add_argument('--max-stages', type=int, default=10000,
+                        help='state-max-stages of the GoCD server')
+    parser.add_argument('--body-size', type=int, default=2048)
+    parser.add_argument('--max-growth-kb', type=int, default=1024)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--frames', type=int, default=1,
+                        help='frames to keep per allocation site')
+    parser.add_argument('--slack-backlog', type=int, default=100,
+                        help='Slack posts pending before we wait')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--loglevel', default='ERROR')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(soak(args))
+    print(json.dumps(report, indent=2))
+    if report['failures']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
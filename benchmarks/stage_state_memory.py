@@ -0,0 +1,71 @@
+import argparse
+import json
+import tracemalloc
+from collections import defaultdict
+
+from mail2alert.stagestate import StageStates
+
+"""
+Compare the memory used for pipeline stage states by a plain
+defaultdict of state objects, which is what the gocd manager used
+to do, and by StageStates.
+
+Run from the repository root with PYTHONPATH=src.
+"""
+
+
+class Unknown:
+    pass
+
+
+class Success:
+    pass
+
+
+class Failure:
+    pass
+
+
+def stage_keys(count, stages_per_pipeline):
+    stages = ['stage-%i' % i for i in range(stages_per_pipeline)]
+    for i in range(count):
+        pipeline = i // stages_per_pipeline
+        yield 'pipeline-%i-release-1.2.%i/%s' % (
+            pipeline // 100,
+            pipeline % 100,
+            stages[i % stages_per_pipeline]
+        )
+
+
+def measure(make_store, count, stages_per_pipeline):
+    tracemalloc.start()
+    store = make_store()
+    for i, key in enumerate(stage_keys(count, stages_per_pipeline)):
+        store[key] = Success() if i % 3 else Failure()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(keys=len(store), bytes=size, bytes_per_key=size / count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--keys', type=int, default=1000000)
+    parser.add_argument('-s', '--stages-per-pipeline', type=int, default=4)
+    args = parser.parse_args()
+    report = {
+        'defaultdict': measure(
+            lambda: defaultdict(Unknown),
+            args.keys,
+            args.stages_per_pipeline
+        ),
+        'StageStates': measure(
+            lambda: StageStates((Unknown, Success, Failure)),
+            args.keys,
+            args.stages_per_pipeline
+        ),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import asyncio
+import json
+
+from aiohttp import web
+from aiosmtpd.smtp import SMTP
+
+"""
+Local stand-ins for the services mail2alert talks to, for
+benchmarks: a GoCD server, the Slack API and the remote SMTP server
+mail is relayed to. They answer at once and count what they get, so
+the numbers show the cost on our side.
+
+Also the synthetic GoCD configuration and mail the benchmarks share.
+"""
+
+# (event text in the subject, weight)
+EVENTS = (
+    ('passed', 70),
+    ('failed', 15),
+    ('is broken', 5),
+    ('is fixed', 5),
+    ('is cancelled', 5),
+)
+
+
+def pipeline_groups(groups, pipelines_per_group):
+    """
+    Pipeline names end in a release, for name_like_in_group.
+    """
+    return [
+        {
+            'name': 'group-%i' % g,
+            'pipelines': [
+                {'name': 'pipeline-%i-%i-release-1.%i' % (g, p, p % 3)}
+                for p in range(pipelines_per_group)
+            ],
+        }
+        for g in range(groups)
+    ]
+
+
+def stage_subject(pipeline, counter, rng):
+    """
+    The subject of mail from GoCD about a run of a stage of
+    pipeline, with an event picked by the weights in EVENTS.
+    """
+    event = rng.choices([e for e, _ in EVENTS], [w for _, w in EVENTS])[0]
+    return 'Stage [%s/%i/build/1] %s' % (pipeline, counter, event)
+
+
+def cctray(groups):
+    projects = ''.join(
+        '<Project name="{0} :: build" activity="Sleeping" '
+        'lastBuildStatus="Success" lastBuildLabel="1" '
+        'lastBuildTime="2019-01-01T00:00:00" '
+        'webUrl="http://localhost/go/pipelines/{0}/1/build/1"/>'.format(
+            pipeline['name']
+        )
+        for group in groups
+        for pipeline in group['pipelines']
+    )
+    return '<?xml version="1.0" encoding="utf-8"?><Projects>%s</Projects>' % projects
+
+
+class HTTPStandIn:
+    def __init__(self, port):
+        self.port = port
+        self.app = web.Application()
+        self._runner = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, 'localhost', self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class StandInGoCD(HTTPStandIn):
+    def __init__(self, port, groups):
+        super().__init__(port)
+        self.groups = groups
+        self.requests = 0
+        self._groups_json = json.dumps(groups).encode('utf-8')
+        self._cctray = cctray(groups).encode('utf-8')
+        self.app.router.add_get('/go/api/config/pipeline_groups', self.get_groups)
+        self.app.router.add_get('/go/cctray.xml', self.get_cctray)
+
+    @property
+    def url(self):
+        return 'http://localhost:%i/go' % self.port
+
+    async def get_groups(self, request):
+        self.requests += 1
+        return web.Response(body=self._groups_json, content_type='application/json')
+
+    async def get_cctray(self, request):
+        self.requests += 1
+        return web.Response(body=self._cctray, content_type='application/xml')
+
+
+class StandInSlack(HTTPStandIn):
+    def __init__(self, port):
+        super().__init__(port)
+        self.posts = 0
+        self.app.router.add_post('/api/chat.postMessage', self.post_message)
+        self.app.router.add_post('/api/chat.update', self.update_message)
+
+    @property
+    def url(self):
+        return 'http://localhost:%i/api/' % self.port
+
+    async def post_message(self, request):
+        params = await request.json()
+        self.posts += 1
+        return web.json_response({
+            'ok': True,
+            'channel': params.get('channel'),
+            'ts': '%i.000000' % self.posts,
+        })
+
+    async def update_message(self, request):
+        params = await request.json()
+        self.posts += 1
+        return web.json_response({'ok': True, 'channel': params.get('channel'), 'ts': params.get('ts')})
+
+
+class RelaySink:
+    """
+    An SMTP server which counts the mail it gets.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.received = 0
+        self._server = None
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return '250 OK'
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self._server = await loop.create_server(
+            lambda: SMTP(self, enable_SMTPUTF8=True),
+            host='localhost',
+            port=self.port
+        )
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
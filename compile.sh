@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+
+docker run \
+    --rm \
+    --net=host \
+    --volume $1:/mail2alert_config \
+    -e "MAIL2ALERT_CONFIGURATION=/mail2alert_config/configuration.yml" \
+    mail2alert --compile
@@ -8,26 +8,24 @@ Example script for bulk generation of rules.
 
 def add_rules(receiver, pipelinegroups):
     mail_domain = 'example.com'
-    rules = []
-    for group in pipelinegroups:
-        rule1 = {
+    rules = [
+        {
             'actions': ['mailto:%s@%s' % (receiver, mail_domain)],
             'filter': {
                 'events': ['FIXED', 'BREAKS'],
-                'function': 'pipelines.in_group',
-                'args': [group]
+                'function': 'pipelines.in_any_group',
+                'args': list(pipelinegroups)
             }
-        }
-        rules.append(rule1)
-        rule2 = {
+        },
+        {
             'actions': ['mailto:%s@%s' % (receiver, mail_domain)],
             'filter': {
                 'events': ['FIXED', 'BREAKS'],
                 'function': 'pipelines.name_like_in_group',
-                'args': [r'(.+)-release.*', group]
+                'args': [r'(.+)-release.*', list(pipelinegroups)]
             }
-        }
-        rules.append(rule2)
+        },
+    ]
     return rules
 
 
@@ -36,7 +34,7 @@ def main():
     parser.add_argument('-i', '--input', )
     rules = []
     with open('actions.yml') as actions:
-        for receiver, pipelinegroups in yaml.load(actions).items():
+        for receiver, pipelinegroups in yaml.safe_load(actions).items():
             rules.extend(add_rules(receiver, pipelinegroups))
         with open('snippets.yaml', 'w') as snippet:
             yaml.dump(
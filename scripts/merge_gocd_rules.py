@@ -0,0 +1,109 @@
+import argparse
+import json
+import sys
+
+import yaml
+
+"""
+Merge gocd rules which only differ in their pipeline groups.
+
+Rules made by make_gocd_rules.py before it made lists of groups have
+one pipelines.in_group and one pipelines.name_like_in_group rule per
+group. This merges all pipelines.in_group and pipelines.in_any_group
+rules with the same actions, events and other settings into one
+pipelines.in_any_group rule, and all pipelines.name_like_in_group
+rules with the same pattern, actions and so on into one rule with a
+list of groups. Other rules are left as they are.
+
+Each merged rule takes the place of the first rule it was made from.
+
+    python merge_gocd_rules.py configuration.yml > merged.yml
+"""
+
+
+def groups_of(group):
+    return [group] if isinstance(group, str) else list(group)
+
+
+def merge_key(rule):
+    """
+    Return (key, groups) for rules we can merge, where key tells
+    which rules can be merged with each other, else (None, None).
+    """
+    rule_filter = rule.get('filter', {})
+    function = rule_filter.get('function')
+    args = rule_filter.get('args', [])
+    rest = dict(rule, filter={
+        key: value for key, value in rule_filter.items()
+        if key not in ('function', 'args')
+    })
+    if function == 'pipelines.in_group' and len(args) == 1:
+        groups = groups_of(args[0])
+        function = 'pipelines.in_any_group'
+    elif function == 'pipelines.in_any_group':
+        groups = list(args)
+    elif function == 'pipelines.name_like_in_group' and len(args) == 2:
+        groups = groups_of(args[1])
+        rest['filter']['args'] = args[0]
+    else:
+        return None, None
+    return (function, json.dumps(rest, sort_keys=True)), groups
+
+
+def merge_rules(rules):
+    merged = []
+    by_key = {}
+    for rule in rules:
+        key, groups = merge_key(rule)
+        if key is None:
+            merged.append(rule)
+            continue
+        if key not in by_key:
+            function, rest = key
+            new_rule = json.loads(rest)
+            pattern = new_rule['filter'].pop('args', None)
+            new_rule['filter']['function'] = function
+            new_rule['filter']['args'] = [] if pattern is None else [pattern, []]
+            by_key[key] = new_rule
+            merged.append(new_rule)
+        new_rule = by_key[key]
+        group_list = (
+            new_rule['filter']['args'][1]
+            if key[0] == 'pipelines.name_like_in_group'
+            else new_rule['filter']['args']
+        )
+        for group in groups:
+            if group not in group_list:
+                group_list.append(group)
+    return merged
+
+
+def merge_configuration(cnf):
+    for manager in cnf.get('managers', []):
+        if manager.get('name', 'gocd') == 'gocd' and 'rules' in manager:
+            before = len(manager['rules'])
+            manager['rules'] = merge_rules(manager['rules'])
+            print(
+                'Merged %i rules into %i' % (before, len(manager['rules'])),
+                file=sys.stderr
+            )
+    return cnf
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge gocd rules')
+    parser.add_argument('configuration', help='YAML file with managers')
+    parser.add_argument('-o', '--output', help='Where to write, default stdout')
+    args = parser.parse_args()
+    with open(args.configuration) as conf_file:
+        cnf = yaml.safe_load(conf_file)
+    merge_configuration(cnf)
+    if args.output:
+        with open(args.output, 'w') as output:
+            yaml.safe_dump(cnf, output, default_flow_style=False)
+    else:
+        yaml.safe_dump(cnf, sys.stdout, default_flow_style=False)
+
+
+if __name__ == '__main__':
+    main()
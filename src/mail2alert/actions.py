@@ -8,19 +8,37 @@ class Actions:
     def add_action_type(cls, action_type):
         cls._action_types[action_type.kind()] = action_type
 
+    @classmethod
+    def kinds(cls):
+        return set(cls._action_types)
+
     def __init__(self, target_strings):
+        """
+        Actions which are the same, e.g. since several rules matched
+        and asked for the same thing, are only included once.
+        """
         self._actions = {kind: [] for kind in self._action_types}
+        seen = set()
         for text in target_strings:
-            kind, *args = text.split(':')
+            kind, _, args = text.partition(':')
             try:
                 action_type = self._action_types[kind]
-                self._actions[action_type.kind()].append(action_type(*args))
             except KeyError:
                 logging.error('Unexpected action: ' + text)
+                continue
+            action = action_type.parse(args)
+            if action.key() in seen:
+                continue
+            seen.add(action.key())
+            self._actions[action_type.kind()].append(action)
 
     def __getattr__(self, item):
         return self._actions[item]
 
+    def __iter__(self):
+        for actions in self._actions.values():
+            yield from actions
+
 
 class Action:
     def __init__(self, destination, *args):
@@ -30,6 +48,16 @@ class Action:
     def kind(cls):
         return cls.__name__.lower()
 
+    @classmethod
+    def parse(cls, args):
+        return cls(*args.split(':'))
+
+    def key(self):
+        return self.kind(), self.destination
+
+    def __str__(self):
+        return '%s:%s' % (self.kind(), self.destination)
+
 
 class Mailto(Action):
     pass
@@ -43,5 +71,36 @@ class Slack(Action):
         super().__init__(destination)
         self.style = style
 
+    def key(self):
+        return self.kind(), self.destination, self.style
+
+    def __str__(self):
+        return '%s:%s:%s' % (self.kind(), self.destination, self.style)
+
 
 Actions.add_action_type(Slack)
+
+
+class Webhook(Action):
+    """
+    webhook:<url> or webhook:<url>#<template>
+    The URL fragment, which is never sent, names a template.
+    """
+    def __init__(self, destination):
+        url, _, template = destination.partition('#')
+        super().__init__(url)
+        self.template = template or None
+
+    @classmethod
+    def parse(cls, args):
+        return cls(args)
+
+    def key(self):
+        return self.kind(), self.destination, self.template
+
+    def __str__(self):
+        text = super().__str__()
+        return text + '#' + self.template if self.template else text
+
+
+Actions.add_action_type(Webhook)
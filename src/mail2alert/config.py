@@ -1,24 +1,157 @@
+import hashlib
+import inspect
+import json
 import logging
+import os
 import yaml
 from os import environ
 from os.path import expandvars
 """
 Read configuration from YAML file and expand environment
 variables in all values.
+
+`mail2alert --compile` checks the configuration, and writes it to a
+compiled file next to the YAML file, e.g. configuration.compiled for
+configuration.yml. If it exists, and was compiled from the YAML file
+as it is now, it's read instead of the YAML file, which is much
+faster for big files.
+
+A compiled file is a JSON header line, followed by the configuration
+as JSON. The header has the format version, a checksum of the JSON
+and a checksum of the YAML file it was compiled from. Files which
+don't match are ignored. Environment variables are not expanded in
+the compiled file, but when it's read, as for the YAML file, so it
+holds no secrets from them, and changes to them aren't missed.
 """
 
+# The C loader is much faster, but might not be available.
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+COMPILED_FORMAT = 2
+
+
+def configuration_path():
+    return environ.get('MAIL2ALERT_CONFIGURATION') or 'configuration.yml'
+
+
+def compiled_path(config_path):
+    return os.path.splitext(config_path)[0] + '.compiled'
+
 
 class Configuration(dict):
-    def __init__(self):
-        config_path = environ.get('MAIL2ALERT_CONFIGURATION') or 'configuration.yml'
+    def __init__(self, config_path=None, compiled=True):
+        if config_path is None:
+            config_path = configuration_path()
         super().__init__()
-        with open(config_path) as conf_file:
-            data = yaml.load(conf_file)
-            expand_vars(data)
-            for key, value in data.items():
-                self[key] = value
-            logging.debug('read configuration from {}'.format(conf_file.name))
-            logging.debug('got configuration {}'.format(self))
+        data = None
+        if compiled:
+            data = read_compiled(compiled_path(config_path), config_path)
+        if data is None:
+            data = read_yaml(config_path, expand=False)
+        expand_vars(data)
+        self.update(data)
+        logging.debug('got configuration {}'.format(self))
+
+
+def read_yaml(config_path, loader=None, expand=True):
+    with open(config_path) as conf_file:
+        data = yaml.load(conf_file, Loader=loader or Loader)
+    if expand:
+        expand_vars(data)
+    logging.debug('read configuration from {}'.format(config_path))
+    return data
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_compiled(data, path, config_path):
+    """
+    Write data, the configuration in config_path without environment
+    variables expanded, compiled to path. Raises ValueError if data
+    has values JSON can't hold as they are, e.g. dates or numbers as
+    keys. The file is only readable by its owner, as the YAML file
+    might hold passwords.
+    """
+    with open(config_path, 'rb') as conf_file:
+        source = conf_file.read()
+    try:
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    except TypeError as error:
+        raise ValueError('Can\'t compile %s: %s' % (config_path, error))
+    if json.loads(payload.decode('utf-8')) != data:
+        raise ValueError(
+            'Can\'t compile %s: it has keys which aren\'t strings' % config_path
+        )
+    header = {
+        'format': COMPILED_FORMAT,
+        'sha256': sha256(payload),
+        'source-sha256': sha256(source),
+    }
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'wb') as compiled_file:
+        compiled_file.write(json.dumps(header).encode('ascii') + b'\n')
+        compiled_file.write(payload)
+        compiled_file.flush()
+        os.fsync(compiled_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_compiled(path, config_path):
+    """
+    Return the compiled configuration in path, or None if there's
+    none we can use.
+    """
+    try:
+        with open(path, 'rb') as compiled_file:
+            header = json.loads(compiled_file.readline().decode('ascii'))
+            payload = compiled_file.read()
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logging.warning('Ignoring %s: %s', path, error)
+        return None
+    if header.get('format') != COMPILED_FORMAT:
+        logging.warning('Ignoring %s: format %s', path, header.get('format'))
+        return None
+    if header.get('sha256') != sha256(payload):
+        logging.warning('Ignoring %s: checksum mismatch', path)
+        return None
+    try:
+        with open(config_path, 'rb') as conf_file:
+            source = conf_file.read()
+    except FileNotFoundError:
+        source = None
+    if source is not None and header.get('source-sha256') != sha256(source):
+        logging.warning('Ignoring %s: %s has changed', path, config_path)
+        return None
+    logging.debug('read configuration from {}'.format(path))
+    return json.loads(payload.decode('utf-8'))
+
+
+def settings(section, conf, target, renames=None):
+    """
+    The settings in conf, the `section` section of the configuration,
+    as keyword arguments for target, e.g. max_size for `max-size`.
+    renames maps the names of settings to those of arguments, where
+    they differ. Settings target doesn't take raise ValueError.
+    """
+    parameters = inspect.signature(target).parameters
+    renames = renames or {}
+    arguments = {}
+    for key, value in conf.items():
+        name = key.replace('-', '_')
+        name = renames.get(name, name)
+        parameter = parameters.get(name)
+        if parameter is None or parameter.kind not in (
+            parameter.POSITIONAL_OR_KEYWORD,
+            parameter.KEYWORD_ONLY,
+        ):
+            raise ValueError('Unknown setting %r in %s' % (key, section))
+        arguments[name] = value
+    return arguments
 
 
 def expand_vars(structure):
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+
+import yaml
+
+"""
+A console for looking inside the running server, e.g. with
+
+    nc localhost 50101
+
+It's served on the `console` host:port of the configuration. There
+is no authentication, so only listen on localhost, or on a port
+which isn't published beyond those who may look. See Console.help_text
+for the commands.
+"""
+
+
+def describe_task(task):
+    coro = task._coro
+    name = getattr(coro, '__qualname__', repr(coro))
+    stack = task.get_stack()
+    if stack:
+        frame = stack[-1]
+        return '%s at %s:%s' % (name, frame.f_code.co_filename, frame.f_lineno)
+    return name
+
+
+def pool_usage(session):
+    if session is None or session.closed:
+        return None
+    connector = session.connector
+    return {
+        'in-use': len(getattr(connector, '_acquired', ())),
+        'idle': sum(len(conns) for conns in getattr(connector, '_conns', {}).values()),
+        'limit': connector.limit,
+        'limit-per-host': connector.limit_per_host,
+    }
+
+
+class Console:
+    prompt = b'mail2alert> '
+    help_text = (
+        'tasks                  pending asyncio tasks, and where they wait\n'
+        'queues                 Slack and webhook queue depths per manager\n'
+        'pools                  HTTP connection pool usage per manager\n'
+        'gocd                   GoCD pipeline groups age, stage states etc.\n'
+        'blocked                the latest times the event loop was blocked\n'
+        'eval <name> <subject>  the actions the rules of manager <name> give\n'
+        '                       for a message with <subject>, without\n'
+        '                       carrying them out\n'
+        'help\n'
+        'quit\n'
+    )
+
+    def __init__(self, proxy, loop_monitor=None):
+        self.proxy = proxy
+        self.loop_monitor = loop_monitor
+        self._server = None
+
+    @property
+    def managers(self):
+        # Read each time, since a reload replaces the list.
+        return self.proxy.mail2alert_managers
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self.handle, host, port)
+        logging.info('Console on %s:%s', host, port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def handle(self, reader, writer):
+        try:
+            writer.write(b'mail2alert console, try help\n' + self.prompt)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('utf-8', 'replace').strip()
+                if command in ('quit', 'exit'):
+                    break
+                reply = await self.run(command)
+                writer.write(reply.encode('utf-8') + self.prompt)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, command):
+        name, _, args = command.partition(' ')
+        if not name:
+            return ''
+        method = getattr(self, 'do_' + name, None)
+        if method is None:
+            return 'Unknown command %s, try help\n' % name
+        try:
+            return await method(args.strip())
+        except Exception as error:
+            logging.exception('Console command %r failed', command)
+            return 'Failed: %s\n' % error
+
+    @staticmethod
+    def dump(data):
+        return yaml.safe_dump(data, default_flow_style=False)
+
+    async def do_help(self, args):
+        return self.help_text
+
+    async def do_tasks(self, args):
+        current = asyncio.current_task()
+        tasks = sorted(
+            describe_task(task) for task in asyncio.all_tasks() if task is not current
+        )
+        return ''.join(task + '\n' for task in tasks) + '%i tasks\n' % len(tasks)
+
+    async def do_queues(self, args):
+        return self.dump({
+            manager.name: manager.status() for manager in self.managers
+        })
+
+    async def do_pools(self, args):
+        pools = {}
+        for manager in self.managers:
+            if manager.slack is not None:
+                pools['%s slack' % manager.name] = pool_usage(manager.slack._session)
+            if manager.webhooks is not None:
+                pools['%s webhooks' % manager.name] = pool_usage(manager.webhooks._session)
+        return self.dump(pools) if pools else 'No connection pools\n'
+
+    async def do_gocd(self, args):
+        return self.dump({
+            manager.name: {
+                server.name or 'default': server.status()
+                for server in manager.servers
+            }
+            for manager in self.managers if hasattr(manager, 'servers')
+        })
+
+    async def do_blocked(self, args):
+        if self.loop_monitor is None or not self.loop_monitor.blocked:
+            return 'Not blocked\n'
+        return ''.join(
+            '%s blocked for more than %.3f s at:\n%s' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)),
+                seconds,
+                stack
+            )
+            for when, seconds, stack in self.loop_monitor.blocked
+        )
+
+    async def do_eval(self, args):
+        name, _, subject = args.partition(' ')
+        for manager in self.managers:
+            if manager.name == name:
+                break
+        else:
+            return 'No manager %s\n' % name
+        start = time.perf_counter()
+        msg, actions = await manager.evaluate({'Subject': subject})
+        elapsed = time.perf_counter() - start
+        event = msg.get('event')
+        return self.dump({
+            'event': getattr(event, 'name', event),
+            'actions': [str(action) for action in actions],
+            'ms': round(elapsed * 1000, 2),
+        })
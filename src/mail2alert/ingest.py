@@ -0,0 +1,134 @@
+import logging
+
+from aiohttp import web
+
+from mail2alert.metrics import REGISTRY
+from mail2alert.profiling import ProfilingError
+from mail2alert.tracing import start_trace
+
+"""
+HTTP ingest of events, as an alternative to sending mail.
+
+POST a JSON object, or a JSON array of objects, to /events:
+
+    {
+        "from": "go@example.com",
+        "to": ["mail2alert@example.com"],
+        "subject": "Stage [my-pipeline/2/build/1] failed",
+        "body": "See details: ...",
+        "headers": {"X-Whatever": "value"}
+    }
+
+Only "subject" is required, and "to" may be a single address. Each
+event is handled as if it was a mail with these fields, but without
+any MIME parsing or generation unless mail is actually sent, which
+has the headers as well. The events in a batch are handled in order,
+and the response contains one result per event.
+
+GET /metrics returns the metrics in the Prometheus text format.
+
+POST /profile?seconds=30&rules=1 profiles the server for that many
+seconds, and returns the paths of the files written, see profiling.
+"""
+
+
+class IngestServer:
+    keepalive_timeout = 75
+
+    def __init__(self, proxy, profiler=None):
+        self.proxy = proxy
+        self.profiler = profiler
+        self.app = web.Application()
+        self.app.router.add_post('/events', self.handle_events)
+        self.app.router.add_get('/metrics', self.handle_metrics)
+        if profiler is not None:
+            self.app.router.add_post('/profile', self.handle_profile)
+        self._runner = None
+
+    async def start(self, host, port):
+        self._runner = web.AppRunner(
+            self.app,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        logging.info('Accepting events on http://%s:%s/events', host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_events(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({'error': 'Invalid JSON'}, status=400)
+        events = data if isinstance(data, list) else [data]
+        results = []
+        for event in events:
+            try:
+                mail_from, rcpt_tos, fields, body = normalize_event(event)
+            except (KeyError, TypeError, AttributeError) as error:
+                logging.warning('Bad event %r: %s', event, error)
+                results.append({'error': 'Bad event: %s' % error})
+                continue
+            with start_trace('event', peer=request.remote):
+                refused = await self.proxy.deliver_event(
+                    mail_from,
+                    rcpt_tos,
+                    fields,
+                    body
+                )
+            results.append({'refused': sorted(refused)})
+        return web.json_response({'results': results})
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            body=REGISTRY.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    async def handle_profile(self, request):
+        seconds = request.query.get('seconds')
+        if seconds is not None:
+            try:
+                seconds = float(seconds)
+            except ValueError:
+                seconds = None
+            if seconds is None or not 0 < seconds <= self.profiler.max_seconds:
+                return web.json_response(
+                    {'error': 'seconds must be more than 0, and at most %s'
+                     % self.profiler.max_seconds},
+                    status=400
+                )
+        rules = request.query.get('rules')
+        if rules is not None:
+            rules = rules.lower() not in ('0', 'false', 'no')
+        try:
+            files = await self.profiler.profile(seconds, rules)
+        except ProfilingError as error:
+            return web.json_response({'error': str(error)}, status=409)
+        return web.json_response({'files': files})
+
+
+def normalize_event(event):
+    mail_from = event.get('from', '')
+    rcpt_tos = event.get('to', [])
+    if isinstance(rcpt_tos, str):
+        rcpt_tos = [rcpt_tos]
+    if not isinstance(rcpt_tos, list) or not all(isinstance(rcpt, str) for rcpt in rcpt_tos):
+        raise TypeError('"to" must be an address or a list of addresses')
+    headers = event.get('headers', {})
+    if not isinstance(headers, dict) or not all(
+        isinstance(value, str) for value in headers.values()
+    ):
+        raise TypeError('"headers" must map names to strings')
+    if not isinstance(event['subject'], str):
+        raise TypeError('"subject" must be a string')
+    fields = dict(headers)
+    fields['Subject'] = event['subject']
+    fields['From'] = mail_from
+    fields['To'] = ', '.join(rcpt_tos)
+    return mail_from, rcpt_tos, fields, event.get('body', '')
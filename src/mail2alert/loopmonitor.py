@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from mail2alert.config import settings
+from mail2alert.metrics import Counter, Histogram
+
+"""
+Notice when the event loop is blocked.
+
+A blocking call in a callback, e.g. synchronous file or socket I/O,
+or a big parse, stalls everything else the server does, without
+any sign of it in the logs. The LoopMonitor measures how late the
+loop runs a sleep which should end at a known time, and exports that
+as a metric. A watchdog thread notices when the loop hasn't done so
+for longer than a threshold, and logs the stack of the loop thread
+while it's still blocked, which is where the blocking call is.
+
+For tests, MAIL2ALERT_LOOP_DEBUG=1 in the environment runs event
+loops in asyncio debug mode, and makes callbacks which block the
+loop for 0.1 seconds or more raise BlockingCallError, so the test
+fails. The test package calls fail_on_blocking for that.
+"""
+
+LOOP_LAG = Histogram(
+    'mail2alert_loop_lag_seconds',
+    'How late the event loop runs a callback due at a known time.',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+BLOCKED = Counter(
+    'mail2alert_loop_blocked_total',
+    'Times the event loop was blocked for longer than the threshold.'
+)
+
+
+def enable_debug(loop, threshold):
+    """
+    In debug mode, asyncio logs callbacks which take threshold
+    seconds or more. It also makes everything slower.
+    """
+    loop.set_debug(True)
+    loop.slow_callback_duration = threshold
+
+
+class LoopMonitor:
+    """
+    Settings, from the `loop-monitor` section of the configuration:
+
+    interval: seconds between measurements of the loop lag.
+    threshold: seconds the loop may be blocked before we log it.
+    debug: run the loop in asyncio debug mode, which also logs each
+    callback taking threshold seconds or more. Costly, so only for
+    tracking down problems.
+    """
+
+    def __init__(self, interval=0.25, threshold=0.5, debug=False, keep=20):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        # (time, seconds, stack) for the latest times the loop blocked.
+        self.blocked = deque(maxlen=keep)
+        self._beat = None
+        self._loop_thread = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(**settings('loop-monitor', conf, cls))
+
+    def start(self):
+        """
+        Call this in the thread running the loop.
+        """
+        loop = asyncio.get_event_loop()
+        if self.debug:
+            enable_debug(loop, self.threshold)
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self.measure())
+        self._watchdog = threading.Thread(
+            target=self.watch,
+            name='loop-watchdog',
+            daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._watchdog.join)
+            self._watchdog = None
+
+    async def measure(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(loop.time() - start - self.interval, 0.0))
+            self._beat = time.monotonic()
+
+    def watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 4):
+            beat = self._beat
+            late = time.monotonic() - beat - self.interval
+            if late > self.threshold and beat != reported:
+                reported = beat
+                self.capture(late)
+
+    def capture(self, late):
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        BLOCKED.inc()
+        self.blocked.append((time.time(), late, stack))
+        logging.warning(
+            'Event loop blocked for more than %.3f s, at:\n%s',
+            late,
+            stack
+        )
+
+
+class BlockingCallError(AssertionError):
+    pass
+
+
+class FailOnSlowCallbacks(logging.Handler):
+    """
+    Raise from asyncio's warning about a slow callback. It's logged
+    by the loop right after the callback, so the exception ends the
+    run_until_complete of the test.
+    """
+
+    def emit(self, record):
+        if str(record.msg).startswith('Executing '):
+            raise BlockingCallError(record.getMessage())
+
+
+class DebugEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    def __init__(self, threshold):
+        super().__init__()
+        self.threshold = threshold
+
+    def new_event_loop(self):
+        loop = super().new_event_loop()
+        enable_debug(loop, self.threshold)
+        return loop
+
+
+def fail_on_blocking(threshold=0.1):
+    """
+    Make event loops created from now on raise BlockingCallError
+    when a callback blocks for threshold seconds or more.
+    """
+    asyncio.set_event_loop_policy(DebugEventLoopPolicy(threshold))
+    asyncio_logger = logging.getLogger('asyncio')
+    asyncio_logger.setLevel(logging.WARNING)
+    asyncio_logger.addHandler(FailOnSlowCallbacks())
@@ -0,0 +1,174 @@
+from bisect import bisect_left
+from time import perf_counter
+
+"""
+Counters and histograms, served in the Prometheus text format at
+/metrics on the `http-ingest` port.
+
+This is deliberately small: a metric is a dict from a tuple of label
+values to numbers, and updating one is a dict lookup and an addition,
+cheap enough to leave on everywhere. Label values are given in the
+order of the label names, e.g. STAGES.observe(0.01, 'parse').
+"""
+
+DEFAULT_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10
+)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, escape(value)) for name, value in labels
+    )
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, tuple(zip(self.labelnames, labels)), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            # Count per bucket, with one for values above all bounds,
+            # then sum and count.
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *labels):
+        """
+        Observe the time a with block takes.
+        """
+        return Timer(self, labels)
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def samples(self):
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            label_pairs = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield (
+                    self.name + '_bucket',
+                    label_pairs + (('le', format_value(float(bound))),),
+                    cumulative
+                )
+            yield self.name + '_sum', label_pairs, total
+            yield self.name + '_count', label_pairs, count
+
+
+class Timer:
+    # A class rather than a contextmanager, since it's several
+    # times faster.
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+
+STAGES = Histogram(
+    'mail2alert_stage_seconds',
+    'Time spent in each stage of handling messages.',
+    ('stage',)
+)
+MESSAGES = Counter(
+    'mail2alert_messages_total',
+    'Messages dispatched, by manager and event.',
+    ('manager', 'event')
+)
+DROPPED = Counter(
+    'mail2alert_dropped_total',
+    'Messages and events which no one should get.',
+    ('source',)
+)
+REFUSED = Counter(
+    'mail2alert_refused_recipients_total',
+    'Recipients refused when relaying mail.'
+)
+CACHE = Counter(
+    'mail2alert_cache_requests_total',
+    'Cache lookups, by cache and result, hit or miss.',
+    ('cache', 'result')
+)
+
+
+def cache_lookup(cache, hit):
+    CACHE.inc(cache, 'hit' if hit else 'miss')
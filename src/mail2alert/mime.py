@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email import message_from_bytes
+
+from mail2alert.config import settings
+from mail2alert.metrics import STAGES
+
+"""
+Parse and rewrite mail, in worker processes for big messages.
+
+The email package is pure Python, and parsing a message, or
+rewriting its headers and serializing it again, takes CPU time in
+proportion to its size. For a big message, that would keep the
+event loop from serving anything else for as long, so messages of
+at least `threshold-kb` are handled in a process pool instead. What
+comes back is compact: the header fields and the body as text, or
+the rewritten mail as bytes. Smaller messages are handled inline,
+since a trip to another process costs more than they do.
+"""
+
+
+def mail_policy():
+    from email.policy import EmailPolicy
+    return EmailPolicy(utf8=True, linesep='\r\n')
+
+
+def update_mail_to_from(bytes_data, rcpttos, mailfrom):
+    msg = message_from_bytes(bytes_data, policy=mail_policy())
+
+    logging.debug('Removing To: %s', msg['To'])
+    del msg['To']
+    msg['To'] = rcpttos
+    logging.debug('Added To: %s', msg['To'])
+
+    logging.debug('Removing From: %s', msg['From'])
+    del msg['From']
+    msg['From'] = mailfrom
+    logging.debug('Added From: %s', msg['From'])
+
+    mail_bytes = msg.as_bytes()
+    logging.debug(
+        'update_mail_to_from got %i bytes and returned %i bytes',
+        len(bytes_data),
+        len(mail_bytes)
+    )
+    return mail_bytes
+
+
+def parse_message(bytes_data):
+    """
+    Return the header fields and the body text of a mail, as
+    mail.Message(None, fields=..., body=...) takes them.
+    """
+    msg = message_from_bytes(bytes_data, policy=mail_policy())
+    fields = {name: str(value) for name, value in msg.items()}
+    try:
+        body = msg.get_content()
+    except KeyError:
+        # Multipart, which mail.Message doesn't have a body text for either.
+        body = ''
+    return fields, body
+
+
+class MimeOffload:
+    """
+    Settings, from the `mime-offload` section of the configuration:
+
+    threshold-kb: messages this big or bigger are parsed and
+    rewritten in worker processes, default 256.
+    workers: worker processes, default 2. 0 handles all messages
+    inline.
+    """
+
+    def __init__(self, threshold_kb=256, workers=2):
+        self.threshold = threshold_kb * 1024
+        self.workers = workers
+        self._pool = None
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(**settings('mime-offload', conf, cls))
+
+    def offloads(self, data):
+        return self.workers > 0 and data is not None and len(data) >= self.threshold
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # Spawned, since forking a process with threads, e.g. the
+            # loop monitor's, may copy locks which are held. Niced, so
+            # the server process comes first when CPUs are few, or
+            # else small messages wait for big ones after all.
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=os.nice,
+                initargs=(10,)
+            )
+        return self._pool
+
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        with STAGES.time('mime_offload'):
+            try:
+                return await loop.run_in_executor(self.pool, function, *args)
+            except BrokenProcessPool:
+                logging.exception('MIME worker process died, handling message inline')
+                self._pool = None
+        return function(*args)
+
+    async def parse(self, data):
+        return await self.run(parse_message, data)
+
+    async def update_mail_to_from(self, data, rcpttos, mailfrom):
+        if not self.offloads(data):
+            return update_mail_to_from(data, rcpttos, mailfrom)
+        return await self.run(update_mail_to_from, data, rcpttos, mailfrom)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
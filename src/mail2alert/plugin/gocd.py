@@ -6,17 +6,30 @@ from enum import Enum, auto
 from itertools import product
 from xml.etree import ElementTree as Et
 
-import aiohttp
-
 from mail2alert.plugin import mail
 from mail2alert.rules import Rule
 from mail2alert.common import AlertLevels
+from mail2alert.metrics import STAGES, cache_lookup
+from mail2alert.tracing import client_span, start_trace
+from mail2alert.snapshot import Snapshot
+from mail2alert.stagestate import StageStates
+
+# aiohttp is slow to import, so it's imported when first used.
+TIMEOUT = 10
+
+
+def client_session(auth):
+    import aiohttp
+    return aiohttp.ClientSession(
+        auth=auth,
+        timeout=aiohttp.ClientTimeout(total=TIMEOUT)
+    )
 
 
-async def get_json_url(session, url):
+async def get_json_url(session, url, headers=None):
     logging.debug('Fetching url %s', url)
-    with aiohttp.Timeout(10, loop=session.loop):
-        async with session.get(url) as response:
+    with STAGES.time('gocd_fetch'), client_span('GET', url=url):
+        async with session.get(url, headers=headers) as response:
             if response.status == 200:
                 logging.debug(response)
                 return await response.json()
@@ -26,7 +39,7 @@ async def get_json_url(session, url):
 
 async def get_xml_url(session, url):
     logging.debug('Fetching url %s', url)
-    with aiohttp.Timeout(10, loop=session.loop):
+    with STAGES.time('gocd_fetch'), client_span('GET', url=url):
         async with session.get(url) as response:
             if response.status == 200:
                 logging.debug(response)
@@ -43,18 +56,385 @@ class Manager(mail.Manager):
     Based on the mail2alert configuration and knowledge about the
     GoCD server configuration, they determine what to do with the
     mail message.
+
+    A manager may serve several GoCD servers, listed as `servers` in
+    its configuration. Otherwise, the manager configuration describes
+    the one GoCD server.
     """
+    # Server settings which may be given once for all servers.
+    inherited_settings = (
+        'user',
+        'passwd',
+        'state-ttl-days',
+        'state-max-stages',
+        'snapshot-compact-after',
+    )
 
     def __init__(self, conf):
         super().__init__(conf)
+        if 'servers' in conf:
+            self.servers = []
+            for server_conf in conf['servers']:
+                merged = {
+                    key: conf[key]
+                    for key in self.inherited_settings
+                    if key in conf
+                }
+                merged.update(server_conf)
+                self.servers.append(GocdServer(merged))
+        else:
+            self.servers = [GocdServer(conf)]
+        self._servers_by_name = {
+            server.name: server for server in self.servers
+        }
+        self._adopted_servers = set()
+
+    @property
+    def default_server(self):
+        return self.servers[0]
+
+    @property
+    def previous_pipeline_state(self):
+        return self.default_server.previous_pipeline_state
+
+    @previous_pipeline_state.setter
+    def previous_pipeline_state(self, states):
+        self.default_server.previous_pipeline_state = states
+
+    async def async_init(self):
+        await super().async_init()
+        servers = [
+            server for server in self.servers
+            if server not in self._adopted_servers
+        ]
+        await asyncio.gather(
+            *[server.async_init() for server in servers]
+        )
+        for server in servers:
+            if 'poll' in server.conf:
+                poll_conf = server.conf['poll']
+                server.poller = HistoryPoller(
+                    self,
+                    server,
+                    interval=poll_conf.get('interval', 10),
+                    mail_from=poll_conf.get('mail-from', 'go@localhost')
+                )
+                server.poll_task = asyncio.ensure_future(server.poller.run())
+
+    def adopt(self, previous):
+        """
+        Servers with unchanged settings are taken over as they are,
+        with their state, snapshot and poller. Servers at the same
+        url as before keep their stage states, with the new limits,
+        and pipeline groups.
+        """
+        super().adopt(previous)
+        for i, server in enumerate(self.servers):
+            old = previous._servers_by_name.get(server.name)
+            if old is None or old not in previous.servers:
+                continue
+            if old.same_settings(server):
+                self.servers[i] = old
+                self._adopted_servers.add(old)
+                previous.hand_over(old)
+                if old.poller is not None:
+                    old.poller.manager = self
+            elif old.conf.get('url') == server.conf.get('url'):
+                states = old.previous_pipeline_state
+                states.ttl = server.previous_pipeline_state.ttl
+                states.max_size = server.previous_pipeline_state.max_size
+                states.on_expire = server.save_state
+                states.expire()
+                server.previous_pipeline_state = states
+                server._pipeline_groups = old._pipeline_groups
+                server._pipeline_groups_time = old._pipeline_groups_time
+        self._servers_by_name = {
+            server.name: server for server in self.servers
+        }
+
+    async def close(self, timeout=5):
+        await super().close(timeout)
+        for server in self.servers:
+            if self.owns(server):
+                await server.close()
+
+    def server_for(self, mail_from, msg):
+        """
+        Find the server which sent msg. Servers we can't tell apart
+        from others get the messages no other server claims.
+        """
+        for server in self.servers:
+            if server.sent(mail_from, msg):
+                return server
+        return self.default_server
+
+    def server_named(self, name):
+        return self._servers_by_name.get(name, self.default_server)
+
+    async def evaluate(self, fields):
+        """
+        Like get_message, the stage history isn't applied or updated.
+        """
+        msg = Message(None, fields=fields)
+        msg['server'] = self.server_for(fields.get('From'), msg).name
+        return msg, await self.matching_actions(msg)
+
+    @property
+    async def rule_funcs(self):
+        return {'pipelines': await self.default_server.pipelines}
+
+    async def get_rule_funcs(self, msg):
+        server = self.server_named(msg.get('server'))
+        return {'pipelines': await server.pipelines}
+
+    @staticmethod
+    def rule_types():
+        return {'pipelines': Pipelines}
+
+    def validate(self):
+        """
+        Also check events, and the patterns of name_like_in_group.
+        """
+        super().validate()
+        for rule in self.rule_list:
+            for event in rule.filter.get('events', []):
+                if event not in Event.__members__:
+                    raise ValueError('Unknown event: %r' % event)
+            if rule.filter['function'] == 'pipelines.name_like_in_group':
+                pattern = rule.filter.get('args', [''])[0]
+                try:
+                    groups = re.compile(pattern).groups
+                except re.error as error:
+                    raise ValueError('Bad pattern %r: %s' % (pattern, error))
+                if groups < 1:
+                    raise ValueError('Pattern %r needs a group' % pattern)
+
+    @staticmethod
+    def rules(rule_list):
+        for rule in rule_list:
+            yield GocdRule(rule)
+
+    # noinspection PyMethodOverriding
+    def get_message(self, content, mail_from=None, server=None, **kwargs):
+        msg = Message(content, **kwargs)
+        if server is None:
+            server = self.server_for(mail_from, msg)
+        msg['server'] = server.name
+        if msg['event']:
+            what = '{}/{}'.format(msg['pipeline'], msg['stage'])
+            before = server.previous_pipeline_state[what]
+            msg.apply_history(server.previous_pipeline_state)
+            if server.previous_pipeline_state[what] != before:
+                server.save_state(what)
+        return msg
+
+    async def test(self):
+        """
+        This method can be used both to check that the configuration
+        is correct, and to produce a report about where alerts go.
+        """
+        report = []
+        for server in self.servers:
+            report.extend(await self.test_server(server))
+        return report
+
+    async def test_server(self, server):
+        report = []
+        pipeline_map = {}
+        for pipeline_group in await server.pipeline_groups:
+            group_report = {
+                'pipeline_group': pipeline_group['name'],
+                'pipelines': [
+                    {'pipeline': p['name']}
+                    for p in pipeline_group['pipelines']
+                ]
+            }
+            if len(self.servers) > 1:
+                group_report['server'] = server.name
+            report.append(group_report)
+            for pipeline_report in group_report['pipelines']:
+                pipeline_map[pipeline_report['pipeline']] = pipeline_report
+
+        for msg in await self.test_msgs(server):
+            for rule in self.rule_list:
+                if rule.check(
+                    msg,
+                    {'pipelines': await server.pipelines}
+                ):
+                    logging.debug('msg %s checks for rule %s' % (msg, rule))
+                    self.add_alert_to_report(msg, rule, pipeline_map)
+        return report
+
+    async def test_msgs(self, server=None):
+        if server is None:
+            server = self.default_server
+        pipelines = []
+        for grp in await server.pipeline_groups:
+            pipelines.extend([p['name'] for p in grp['pipelines']])
+        return (
+            dict(pipeline=p, event=e) for p, e in product(pipelines, Event)
+        )
+
+    @staticmethod
+    def add_alert_to_report(msg, rule, pipeline_map):
+        pipeline_dict = pipeline_map[msg['pipeline']]
+        alerts = pipeline_dict.setdefault('alerts', [])
+        for candidate in alerts:
+            if rule.actions == candidate['actions']:
+                alert = candidate
+                break
+        else:
+            alert = dict(actions=rule.actions, events=[])
+            alerts.append(alert)
+        if msg['event'].name not in alert['events']:
+            alert['events'].append(msg['event'].name)
+
+
+class GocdServer:
+    """
+    A GoCD server, and what we know about it: its pipeline groups,
+    and the last known state of each pipeline stage.
+    """
+    # A server with other values for these is another server.
+    settings = (
+        'name',
+        'url',
+        'user',
+        'passwd',
+        'sender',
+        'headers',
+        'state-ttl-days',
+        'state-max-stages',
+        'snapshot',
+        'snapshot-compact-after',
+        'poll',
+    )
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.name = conf.get('name', '')
         self._pipeline_groups = None
         self._pipeline_groups_time = 0
+        self._pipelines = None
         # None is a valid value. I use NotImplemented as not set.
         self._auth = NotImplemented
-        self.previous_pipeline_state = defaultdict(BuildStateUnknown)
+        self.previous_pipeline_state = StageStates(
+            BUILD_STATES,
+            ttl=conf.get('state-ttl-days', 30) * 24 * 3600,
+            max_size=conf.get('state-max-stages'),
+            # Journal what's dropped, lest it come back on restart.
+            on_expire=self.save_state
+        )
+        self._snapshot = None
+        self._compact_task = None
+        self._refresh_task = None
+        self.poller = None
+        self.poll_task = None
+        if 'snapshot' in conf:
+            self._snapshot = Snapshot(
+                conf['snapshot'],
+                conf.get('snapshot-compact-after', 1000)
+            )
 
     async def async_init(self):
+        if self.load_snapshot():
+            # Serve the snapshot right away, and catch up in the background.
+            self._refresh_task = asyncio.ensure_future(self.refresh())
+        else:
+            await self.fetch_cctray()
+
+    def same_settings(self, other):
+        return all(
+            self.conf.get(key) == other.conf.get(key)
+            for key in self.settings
+        )
+
+    async def close(self):
+        for task in (self.poll_task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+        if self._compact_task is not None:
+            await self._compact_task
+        if self._snapshot is not None:
+            self._snapshot.close()
+
+    def status(self):
+        if self._pipeline_groups is None:
+            age = None
+        elif not self._pipeline_groups_time:
+            age = 'from snapshot'
+        else:
+            age = round(asyncio.get_event_loop().time() - self._pipeline_groups_time, 1)
+        return {
+            'url': self.conf.get('url'),
+            'pipeline-groups': len(self._pipeline_groups or ()),
+            'pipeline-groups-age': age,
+            'stage-states': len(self.previous_pipeline_state),
+            'snapshot': self._snapshot.path if self._snapshot else None,
+            'polling': self.poll_task is not None and not self.poll_task.done(),
+        }
+
+    def sent(self, mail_from, msg):
+        """
+        Did this server send msg? The `sender` and `headers` settings
+        tell. A server without them claims nothing.
+        """
+        sender = self.conf.get('sender')
+        headers = self.conf.get('headers')
+        if not sender and not headers:
+            return False
+        if sender and sender != mail_from:
+            return False
+        for name, value in (headers or {}).items():
+            if msg.get(name) != value:
+                return False
+        return True
+
+    async def refresh(self):
+        self._pipeline_groups_time = asyncio.get_event_loop().time()
         await self.fetch_cctray()
+        await self.fetch_pipeline_groups()
+
+    def load_snapshot(self):
+        if not self._snapshot:
+            return False
+        data = self._snapshot.load()
+        if not data:
+            return False
+        for key, value in data.items():
+            if key == 'pipeline_groups':
+                self._pipeline_groups = value
+            elif key.startswith('stage:'):
+                state = build_state_factory(last_build_status=value)
+                if state != BuildStateUnknown():
+                    self.previous_pipeline_state[key[len('stage:'):]] = state
+        return True
+
+    def snapshot_items(self):
+        if self._pipeline_groups:
+            yield 'pipeline_groups', self._pipeline_groups
+        for what, state in self.previous_pipeline_state.items():
+            if state != BuildStateUnknown():
+                yield 'stage:' + what, state.status
+
+    def save_state(self, what):
+        if not self._snapshot:
+            return
+        self._snapshot.record(
+            'stage:' + what,
+            self.previous_pipeline_state[what].status
+        )
+        self.compact_snapshot()
+
+    def save_pipeline_groups(self):
+        if not self._snapshot:
+            return
+        self._snapshot.record('pipeline_groups', self._pipeline_groups)
+        self.compact_snapshot()
+
+    def compact_snapshot(self):
+        if self._snapshot.needs_compaction:
+            self._compact_task = self._snapshot.compact(self.snapshot_items())
 
     @property
     def pipeline_groups_timeout(self):
@@ -62,26 +442,38 @@ class Manager(mail.Manager):
 
     @property
     async def pipeline_groups(self):
-        if asyncio.get_event_loop().time() > self.pipeline_groups_timeout:
+        expired = asyncio.get_event_loop().time() > self.pipeline_groups_timeout
+        cache_lookup('pipeline_groups', not expired)
+        if expired:
             # We can probably survive that subsequent requests use old
             # config while fetch is in progress.
             self._pipeline_groups_time = asyncio.get_event_loop().time()
-            await self.fetch_pipeline_groups()
+            if self._pipeline_groups is None:
+                await self.fetch_pipeline_groups()
+            else:
+                self._refresh_task = asyncio.ensure_future(
+                    self.fetch_pipeline_groups()
+                )
         return self._pipeline_groups
 
     @property
-    async def rule_funcs(self):
-        return {'pipelines': Pipelines(await self.pipeline_groups)}
-
-    @staticmethod
-    def rules(rule_list):
-        for rule in rule_list:
-            yield GocdRule(rule)
+    async def pipelines(self):
+        """
+        Pipelines for the current pipeline groups, rebuilt only when
+        they change.
+        """
+        pipeline_groups = await self.pipeline_groups
+        stale = self._pipelines is None or self._pipelines.config_listing is not pipeline_groups
+        cache_lookup('pipelines', not stale)
+        if stale:
+            self._pipelines = Pipelines(pipeline_groups)
+        return self._pipelines
 
     @property
     def auth(self):
         if self._auth is NotImplemented:
             if 'user' in self.conf:
+                import aiohttp
                 self._auth = aiohttp.BasicAuth(
                     self.conf['user'],
                     self.conf['passwd']
@@ -94,7 +486,7 @@ class Manager(mail.Manager):
     async def fetch_pipeline_groups(self):
         try:
             logging.info('Fetching pipeline groups')
-            async with aiohttp.ClientSession(auth=self.auth) as session:
+            async with client_session(self.auth) as session:
                 if 'url' not in self.conf:
                     error = "No URL in config, can't fetch pipeline groups"
                     logging.error(error)
@@ -104,7 +496,9 @@ class Manager(mail.Manager):
                 url = base_url + '/api/config/pipeline_groups'
                 pipeline_groups = await get_json_url(session, url)
                 if pipeline_groups:
-                    self._pipeline_groups = pipeline_groups
+                    if pipeline_groups != self._pipeline_groups:
+                        self._pipeline_groups = pipeline_groups
+                        self.save_pipeline_groups()
                     logging.debug(
                         'Set pipeline groups config with %s pipeline groups.',
                         len(pipeline_groups)
@@ -117,7 +511,7 @@ class Manager(mail.Manager):
     async def fetch_cctray(self):
         try:
             logging.info('Fetching cctray')
-            async with aiohttp.ClientSession(auth=self.auth) as session:
+            async with client_session(self.auth) as session:
                 if 'url' not in self.conf:
                     error = "No URL in config, can't fetch cctray"
                     logging.error(error)
@@ -127,7 +521,8 @@ class Manager(mail.Manager):
                 url = base_url + '/cctray.xml'
                 tree = await get_xml_url(session, url)
                 if tree:
-                    self.parse_cctray(tree)
+                    with STAGES.time('cctray_parse'):
+                        self.parse_cctray(tree)
                 else:
                     logging.warning('Unable to fetch cctray.')
         except Exception as error:
@@ -146,68 +541,158 @@ class Manager(mail.Manager):
             what = "{}/{}".format(pipeline_name, stage_name)
             if timestamp > when[pipeline_name]:
                 state = build_state_factory(last_build_status=project.attrib['lastBuildStatus'])
+                changed = self.previous_pipeline_state.get(what) != state
                 self.previous_pipeline_state[what] = state
                 when[what] = timestamp
                 logging.debug('Set state for %s to %s', what, state)
+                if changed:
+                    self.save_state(what)
 
-    @property
-    async def rule_funcs(self):
-        return {'pipelines': Pipelines(await self.pipeline_groups)}
 
-    # noinspection PyMethodOverriding
-    def get_message(self, content):
-        return Message(content, previous_states=self.previous_pipeline_state)
+class HistoryPoller:
+    """
+    Poll GoCD for finished stages, as an alternative to having GoCD
+    send us mail about them.
 
-    async def test(self):
+    The cctray feed tells us the last finished run of each stage, so
+    one request per poll tells us which pipelines have news. For those,
+    we read the pipeline history, which lists each stage run. We keep
+    a cursor, the (pipeline counter, stage counter) last reported, for
+    each stage, so that each run is reported once, in order.
+
+    Each stage run is turned into the same Message as the mail from
+    GoCD would have been, and handed to the manager.
+    """
+    results = {
+        'Passed': 'passed',
+        'Failed': 'failed',
+        'Cancelled': 'is cancelled',
+    }
+    headers = {'Accept': 'application/vnd.go.cd.v1+json'}
+    web_url_pattern = re.compile(r'/pipelines/([^/]+)/(\d+)/([^/]+)/(\d+)$')
+    max_pages = 5
+
+    def __init__(self, manager, server, interval=10, mail_from='go@localhost'):
+        self.manager = manager
+        self.server = server
+        self.interval = interval
+        self.mail_from = mail_from
+        self.cursors = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as error:
+                logging.exception('Exception in HistoryPoller.poll: %s', error)
+            await asyncio.sleep(self.interval)
+
+    async def poll(self):
+        base_url = self.server.conf['url']
+        async with client_session(self.server.auth) as session:
+            tree = await get_xml_url(session, base_url + '/cctray.xml')
+            if tree is None:
+                logging.warning('Unable to poll cctray.')
+                return
+            for pipeline in self.changed_pipelines(tree):
+                for run in await self.new_stage_runs(session, pipeline):
+                    await self.report(*run)
+
+    def changed_pipelines(self, tree):
         """
-        This method can be used both to check that the configuration
-        is correct, and to produce a report about where alerts go.
+        Compare the last runs in cctray with our cursors. The first
+        time, we just set the cursors.
         """
-        report = []
-        pipeline_map = {}
-        for pipeline_group in await self.pipeline_groups:
-            group_report = {
-                'pipeline_group': pipeline_group['name'],
-                'pipelines': [
-                    {'pipeline': p['name']}
-                    for p in pipeline_group['pipelines']
-                ]
-            }
-            report.append(group_report)
-            for pipeline_report in group_report['pipelines']:
-                pipeline_map[pipeline_report['pipeline']] = pipeline_report
-
-        for msg in await self.test_msgs():
-            for rule in self.rules(self.conf['rules']):
-                if rule.check(
-                    msg,
-                    {'pipelines': Pipelines(await self.pipeline_groups)}
-                ):
-                    logging.debug('msg %s checks for rule %s' % (msg, rule))
-                    self.add_alert_to_report(msg, rule, pipeline_map)
-        return report
-
-    async def test_msgs(self):
-        pipelines = []
-        for grp in await self.pipeline_groups:
-            pipelines.extend([p['name'] for p in grp['pipelines']])
-        return (
-            dict(pipeline=p, event=e) for p, e in product(pipelines, Event)
+        first_poll = self.cursors is None
+        if first_poll:
+            self.cursors = {}
+        changed = []
+        for project in tree.findall('Project'):
+            mo = self.web_url_pattern.search(project.attrib.get('webUrl', ''))
+            if not mo:
+                # Not a stage, e.g. a job.
+                continue
+            pipeline, stage = mo.group(1), mo.group(3)
+            what = '{}/{}'.format(pipeline, stage)
+            last_run = (int(mo.group(2)), int(mo.group(4)))
+            if first_poll:
+                self.cursors[what] = last_run
+            elif what not in self.cursors:
+                # A new stage. Only report its latest run.
+                self.cursors[what] = (last_run[0], last_run[1] - 1)
+            if self.cursors[what] < last_run and pipeline not in changed:
+                changed.append(pipeline)
+        return changed
+
+    async def new_stage_runs(self, session, pipeline):
+        url = '{}/api/pipelines/{}/history'.format(
+            self.server.conf['url'],
+            pipeline
         )
-
-    @staticmethod
-    def add_alert_to_report(msg, rule, pipeline_map):
-        pipeline_dict = pipeline_map[msg['pipeline']]
-        alerts = pipeline_dict.setdefault('alerts', [])
-        for candidate in alerts:
-            if rule.actions == candidate['actions']:
-                alert = candidate
+        runs = []
+        for _ in range(self.max_pages):
+            history = await get_json_url(session, url, headers=self.headers)
+            if not history:
                 break
-        else:
-            alert = dict(actions=rule.actions, events=[])
-            alerts.append(alert)
-        if msg['event'].name not in alert['events']:
-            alert['events'].append(msg['event'].name)
+            reached_cursor = False
+            for instance in history.get('pipelines', []):
+                for stage in instance.get('stages', []):
+                    what = '{}/{}'.format(pipeline, stage['name'])
+                    position = (int(instance['counter']), int(stage['counter']))
+                    if position <= self.cursors.get(what, (0, 0)):
+                        reached_cursor = True
+                        continue
+                    result = stage.get('result') or stage.get('status')
+                    if result in self.results:
+                        runs.append((position, pipeline, stage['name'], result))
+            url = history.get('_links', {}).get('next', {}).get('href')
+            if reached_cursor or not url:
+                break
+        runs.sort()
+        return runs
+
+    async def report(self, position, pipeline, stage, result):
+        """
+        Dispatch a stage run, and only then move the cursor past it,
+        so that a run we fail to dispatch is reported again next poll.
+        """
+        pipeline_counter, stage_counter = position
+        what = '{}/{}'.format(pipeline, stage)
+        states = self.server.previous_pipeline_state
+        before = states[what]
+        subject = 'Stage [{}/{}/{}/{}] {}'.format(
+            pipeline, pipeline_counter, stage, stage_counter,
+            self.results[result]
+        )
+        body = 'See details: {}/pipelines/{}/{}/{}/{}\n'.format(
+            self.server.conf['url'],
+            pipeline, pipeline_counter, stage, stage_counter
+        )
+        try:
+            with start_trace('gocd stage run', server=self.server.name):
+                msg = self.manager.get_message(
+                    None,
+                    server=self.server,
+                    fields={'Subject': subject, 'From': self.mail_from},
+                    body=body
+                )
+                recipients = await self.manager.dispatch(msg)
+                if recipients:
+                    if self.manager.relay:
+                        await self.manager.relay.relay_message(
+                            self.mail_from,
+                            recipients,
+                            msg
+                        )
+                    else:
+                        logging.warning('No relay for mail to %s', recipients)
+        except BaseException:
+            # Forget the run, so that it gives the same event again.
+            if states[what] != before:
+                states[what] = before
+                self.server.save_state(what)
+            raise
+        self.cursors[what] = position
 
 
 class GocdRule(Rule):
@@ -251,11 +736,15 @@ class Event(Enum):
 
 
 class BuildState:
+    status = None
+
     def __eq__(self, other):
         return self.__class__ == other.__class__
 
 
 class BuildStateSuccess(BuildState):
+    status = 'Success'
+
     @staticmethod
     def after(old_state):
         return {
@@ -266,6 +755,8 @@ class BuildStateSuccess(BuildState):
 
 
 class BuildStateFailure(BuildState):
+    status = 'Failure'
+
     @staticmethod
     def after(old_state):
         return {
@@ -276,11 +767,17 @@ class BuildStateFailure(BuildState):
 
 
 class BuildStateUnknown(BuildState):
+    status = 'Unknown'
+
     @staticmethod
     def after(old_state):
         pass
 
 
+# The position in this tuple is the state code in StageStates.
+BUILD_STATES = (BuildStateUnknown, BuildStateSuccess, BuildStateFailure)
+
+
 def build_state_factory(*, event=None, last_build_status=None):
     if event:
         state = {
@@ -294,6 +791,7 @@ def build_state_factory(*, event=None, last_build_status=None):
         state = {
             'Success': BuildStateSuccess,
             'Failure': BuildStateFailure,
+            'Unknown': BuildStateUnknown,
         }[last_build_status]
     else:
         raise ValueError('Need either event or last_builld_status')
@@ -305,17 +803,29 @@ class Pipelines:
     """
     This class should be passed the content from
     go/api/config/pipeline_groups
+
+    Rule functions which take a group also take a list of groups,
+    and match pipelines in any of them.
     """
 
     def __init__(self, config_listing):
-        self._config_listing = config_listing
+        self.config_listing = config_listing
+        # pipeline name -> names of the groups it's in
+        self._groups_of = {}
+        for pipeline_group in config_listing or []:
+            for pipeline_instance in pipeline_group['pipelines']:
+                self._groups_of.setdefault(
+                    pipeline_instance['name'], set()
+                ).add(pipeline_group['name'])
+
+    def groups_of(self, pipeline):
+        return self._groups_of.get(pipeline, ())
 
-    def _get_group_pipelines(self, group):
-        for pipeline_group in self._config_listing:
-            if pipeline_group['name'] == group:
-                return pipeline_group['pipelines']
-        else:
-            return []
+    @staticmethod
+    def _group_set(group):
+        if isinstance(group, str):
+            return {group}
+        return set(group)
 
     @staticmethod
     def any():
@@ -324,24 +834,26 @@ class Pipelines:
     all = any  # For backwards compatibility. Deprecated.
 
     def in_group(self, group):
+        groups = self._group_set(group)
+
         def in_group_filter(msg):
-            for pipeline_instance in self._get_group_pipelines(group):
-                if pipeline_instance['name'] == msg['pipeline']:
-                    return True
-            return False
+            return not groups.isdisjoint(self.groups_of(msg['pipeline']))
 
         return in_group_filter
 
+    def in_any_group(self, *groups):
+        return self.in_group(groups)
+
     def name_like_in_group(self, re_pattern, group):
+        groups = self._group_set(group)
+        pattern = re.compile(re_pattern)
+
         def name_like_in_group_filter(msg):
-            mo = re.search(re_pattern, msg['pipeline'])
+            mo = pattern.search(msg['pipeline'])
             if not mo:
                 return False
             matched_pipeline = mo.group(1)
-            for pipeline_instance in self._get_group_pipelines(group):
-                if pipeline_instance['name'] == matched_pipeline:
-                    return True
-            return False
+            return not groups.isdisjoint(self.groups_of(matched_pipeline))
 
         return name_like_in_group_filter
 
@@ -356,20 +868,19 @@ class Message(mail.Message):
     }
     pattern = re.compile(r'Stage \[([^/]+)/[^/]+/([^/]+)/[^/]+\] (.+)$')
 
-    def __init__(self, content, previous_states=None):
-        if previous_states is None:
-            previous_states = defaultdict(BuildStateUnknown)
-        super().__init__(content)
+    def __init__(self, content, previous_states=None, **kwargs):
+        super().__init__(content, **kwargs)
         mo = self.pattern.search(self['Subject'])
 
         if not mo:
             logging.warning('Unable to parse message: %r' % content)
             self['pipeline'] = None
+            self['stage'] = None
             self['event'] = None
             return
 
         self['pipeline'] = mo.group(1)
-        stage = mo.group(2)
+        self['stage'] = mo.group(2)
         event = self.event_map.get(mo.group(3).strip())
 
         if not event:
@@ -378,8 +889,18 @@ class Message(mail.Message):
             return
 
         logging.debug('Got %s' % event)
+        self['event'] = event
+        if previous_states is not None:
+            self.apply_history(previous_states)
+        self.set_alert_level()
 
-        pipeline_stage = "{}/{}".format(self['pipeline'], stage)
+    def apply_history(self, previous_states):
+        """
+        Adjust the event to what we knew about the stage before,
+        and remember the new state of the stage.
+        """
+        event = self['event']
+        pipeline_stage = "{}/{}".format(self['pipeline'], self['stage'])
         expected_event = build_state_factory(event=event).after(previous_states[pipeline_stage])
         if previous_states[pipeline_stage] == BuildStateUnknown():
             pass
@@ -400,10 +921,8 @@ class Message(mail.Message):
             )
 
         self['event'] = event
-
-        if event:
-            previous_states[pipeline_stage] = build_state_factory(event=event)
-            self.set_alert_level()
+        previous_states[pipeline_stage] = build_state_factory(event=event)
+        self.set_alert_level()
 
     def set_alert_level(self):
         if self['event'] in (Event.BREAKS, Event.FAILS):
@@ -1,11 +1,16 @@
 import logging
+import time
 from email import message_from_bytes
-from email.policy import EmailPolicy
 
+from mail2alert import profiling
 from mail2alert.actions import Actions
 from mail2alert.common import AlertLevels
+from mail2alert.metrics import MESSAGES, STAGES
+from mail2alert.tracing import span
 from mail2alert.rules import Rule
-from mail2alert.slackbot import SlackMessage
+from mail2alert.slackbot import SlackClient, SlackMessage, SlackThreads
+from mail2alert.slackqueue import SlackDispatcher
+from mail2alert.webhook import WebhookSender
 
 
 class Manager:
@@ -16,9 +21,106 @@ class Manager:
     they determine what to do with the mail message.
     """
 
+    # Set by the server, for managers which need to send mail about
+    # messages which didn't arrive by mail.
+    relay = None
+
+    # Created by async_init, if any rule posts to Slack.
+    slack = None
+    slack_dispatcher = None
+    slack_threads = None
+
+    # Created when first needed, if any rule calls a webhook.
+    webhooks = None
+
     def __init__(self, conf):
         logging.info('Started %s', self.__class__)
         self.conf = conf
+        self._rule_list = None
+        # What a manager replacing this one took over, which it uses
+        # until then, but mustn't close.
+        self._handed_over = set()
+
+    @property
+    def name(self):
+        return self.conf.get('name') or self.__module__.rpartition('.')[2]
+
+    @property
+    def rule_list(self):
+        """
+        The rules, built once from the configuration.
+        """
+        if self._rule_list is None:
+            self._rule_list = list(self.rules(self.conf.get('rules', [])))
+        return self._rule_list
+
+    async def async_init(self):
+        if self.slack is None and self.uses_slack():
+            self.slack = SlackClient.from_conf(self.conf)
+            if 'slack-threads' in self.conf:
+                self.slack_threads = SlackThreads.from_conf(
+                    self.conf['slack-threads']
+                )
+            self.slack_dispatcher = SlackDispatcher.from_conf(
+                self.slack,
+                self.conf.get('slack-queue', {}),
+                self.slack_threads
+            )
+
+    def owns(self, thing):
+        return thing is not None and thing not in self._handed_over
+
+    async def close(self, timeout=5):
+        if self.owns(self.webhooks):
+            await self.webhooks.close(timeout)
+        if self.owns(self.slack_dispatcher):
+            await self.slack_dispatcher.close(timeout)
+        if self.owns(self.slack):
+            await self.slack.close()
+
+    def adopt(self, previous):
+        """
+        Take over what previous, the manager this one replaces when
+        the configuration is reloaded, has set up, if it's still valid.
+        previous keeps using it until it's replaced, and what we don't
+        take over is closed with it.
+        """
+        slack_settings = ('slack-token', 'slack-api-url', 'slack-queue', 'slack-threads')
+        if all(self.conf.get(key) == previous.conf.get(key) for key in slack_settings):
+            self.slack = previous.slack
+            self.slack_dispatcher = previous.slack_dispatcher
+            self.slack_threads = previous.slack_threads
+            previous.hand_over(previous.slack, previous.slack_dispatcher)
+        if self.conf.get('webhooks') == previous.conf.get('webhooks'):
+            self.webhooks = previous.webhooks
+            previous.hand_over(previous.webhooks)
+
+    def hand_over(self, *things):
+        self._handed_over.update(thing for thing in things if thing is not None)
+
+    def validate(self):
+        """
+        Raise ValueError if a rule uses a rule function or an action
+        we don't know, or the webhooks settings are bad.
+        """
+        rule_types = self.rule_types()
+        for rule in self.rule_list:
+            function = rule.filter.get('function', '')
+            key, _, name = function.partition('.')
+            if key not in rule_types or not hasattr(rule_types[key], name):
+                raise ValueError('Unknown rule function: %r' % function)
+            for action in rule.actions:
+                if action.partition(':')[0] not in Actions.kinds():
+                    raise ValueError('Unknown action: %r' % action)
+        if 'webhooks' in self.conf:
+            WebhookSender.from_conf(self.conf['webhooks'])
+
+    def uses_slack(self):
+        return any(
+            action.startswith('slack:')
+            for rule in self.conf.get('rules', [])
+            for action in rule.get('actions', [])
+        )
 
     @staticmethod
     def rules(rule_list):
@@ -29,6 +131,16 @@ class Manager:
     async def rule_funcs(self):
         return {'mail': Mail()}
 
+    async def get_rule_funcs(self, msg):
+        """
+        The rule functions to check msg with.
+        """
+        return await self.rule_funcs
+
+    @staticmethod
+    def rule_types():
+        return {'mail': Mail}
+
     # noinspection PyUnusedLocal
     def wants_message(self, mail_from, rcpt_tos, content):
         """
@@ -44,28 +156,93 @@ class Manager:
         if wanted_from:
             return wanted_from == mail_from
 
-    async def process_message(self, mail_from, rcpt_tos, binary_content):
+    async def process_message(self, mail_from, rcpt_tos, binary_content, parsed=None):
+        """
+        parsed is the header fields and the body text of binary_content,
+        if it has been parsed already, e.g. in a worker process.
+        """
         logging.debug('process_message("%s", %s, %s)',
                       mail_from, rcpt_tos, binary_content)
-        recipients = []
-        msg = self.get_message(binary_content)
+        if parsed is None:
+            msg = self.get_message(binary_content, mail_from=mail_from)
+        else:
+            fields, body = parsed
+            msg = self.get_message(None, mail_from=mail_from, fields=fields, body=body)
         logging.info('Extracted message %s', msg)
-        for rule in self.rules(self.conf['rules']):
-            logging.debug('Check %s', rule)
-            actions = Actions(rule.check(msg, await self.rule_funcs))
-            recipients.extend([a.destination for a in actions.mailto])
+        recipients = await self.dispatch(msg)
+        return mail_from, recipients, binary_content
+
+    async def dispatch(self, msg):
+        """
+        Check msg against the rules and act on it. Return the list
+        of mail recipients, since mail is sent by the caller.
+
+        The actions of all matching rules are collected first, so
+        that each distinct action is only carried out once.
+        """
+        event = msg.get('event')
+        MESSAGES.inc(self.name, getattr(event, 'name', event or ''))
+        with STAGES.time('dispatch'):
+            actions = await self.matching_actions(msg)
             if actions.slack:
                 await self.notify_slack(msg, actions.slack)
-        return mail_from, recipients, binary_content
+            if actions.webhook:
+                self.notify_webhooks(msg, actions.webhook)
+            return [a.destination for a in actions.mailto]
 
-    @staticmethod
-    async def notify_slack(msg, slack_actions):
-        sm = SlackMessage(msg)
-        await sm.post(slack_actions)
+    async def matching_actions(self, msg):
+        targets = []
+        rule_funcs = await self.get_rule_funcs(msg)
+        with STAGES.time('rules'), span('rules', rules=len(self.rule_list)) as rules_span:
+            rule_times = profiling.RULE_TIMES
+            for index, rule in enumerate(self.rule_list):
+                logging.debug('Check %s', rule)
+                if rule_times is None:
+                    targets.extend(rule.check(msg, rule_funcs))
+                else:
+                    start = time.thread_time()
+                    targets.extend(rule.check(msg, rule_funcs))
+                    rule_times.add(self.name, index, rule, time.thread_time() - start)
+            rules_span.set(targets=len(targets))
+        return Actions(targets)
 
+    async def evaluate(self, fields):
+        """
+        Return a message with the header fields, and the actions the
+        rules give for it, without carrying them out.
+        """
+        msg = self.get_message(None, fields=fields)
+        return msg, await self.matching_actions(msg)
+
+    def status(self):
+        status = {'rules': len(self.rule_list)}
+        if self.slack_dispatcher is not None:
+            status['slack-queue'] = self.slack_dispatcher.status()
+        if self.webhooks is not None:
+            status['webhooks'] = self.webhooks.status()
+        return status
+
+    async def notify_slack(self, msg, slack_actions):
+        if self.slack_dispatcher is not None:
+            # Queued messages may wait a while, so don't keep them parsed.
+            self.slack_dispatcher.submit(SlackMessage(msg.compact()), slack_actions)
+        else:
+            await SlackMessage(msg).post(
+                slack_actions,
+                self.slack,
+                self.conf.get('slack-queue', {}).get('concurrency', 4),
+                self.slack_threads
+            )
+
+    def notify_webhooks(self, msg, webhook_actions):
+        if self.webhooks is None:
+            self.webhooks = WebhookSender.from_conf(self.conf.get('webhooks', {}))
+        self.webhooks.submit(msg, webhook_actions)
+
+    # noinspection PyUnusedLocal
     @staticmethod
-    def get_message(content):
-        return Message(content)
+    def get_message(content, mail_from=None, **kwargs):
+        return Message(content, **kwargs)
 
     async def test(self):
         pass
@@ -86,16 +263,35 @@ class Mail:
 class Message(dict):
     alert_level = AlertLevels.PRIMARY
 
-    def __init__(self, content):
+    def __init__(self, content, fields=None, body=''):
+        """
+        content is a binary email. Messages which didn't arrive as
+        email are built from a dict of header fields and a body text
+        instead, with content None.
+        """
         super().__init__()
-        msg = message_from_bytes(
-            content,
-            policy=EmailPolicy(utf8=True, linesep='\r\n')
-        )
-        self._msg = msg
+        if content is None:
+            self._msg = None
+            self._body = body
+            self.update(fields or {})
+        else:
+            from email.policy import EmailPolicy
+            with STAGES.time('parse'), span('parse', bytes=len(content)):
+                self._msg = message_from_bytes(
+                    content,
+                    policy=EmailPolicy(utf8=True, linesep='\r\n')
+                )
         logging.info('Message with subject: %s', self['Subject'])
 
     def __missing__(self, item):
+        if self._msg is None:
+            # Header field names are case-insensitive, as in the email.
+            if isinstance(item, str):
+                lower = item.lower()
+                for name, value in self.items():
+                    if isinstance(name, str) and name.lower() == lower:
+                        return value
+            return None
         return self._msg[item]
 
     def get(self, item, default=None):
@@ -106,8 +302,27 @@ class Message(dict):
 
     @property
     def body(self):
+        if self._msg is None:
+            return self._body
         return self._msg.get_content()
 
+    def compact(self):
+        """
+        A copy with the header fields and the body as text, without
+        the parsed email and its raw content, for messages which are
+        kept after dispatch, e.g. in the Slack queue.
+        """
+        if self._msg is None:
+            return self
+        # Not through __init__, which would log it again.
+        copy = Message.__new__(Message)
+        copy._msg = None
+        copy._body = self.body
+        copy.update((name, str(value)) for name, value in self._msg.items())
+        copy.update(self)
+        copy.alert_level = self.alert_level
+        return copy
+
 
 class MailRule(Rule):
     pass
@@ -0,0 +1,146 @@
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import signal
+import time
+
+from mail2alert.config import settings
+
+"""
+Profile the running server on demand.
+
+SIGUSR1, or POST /profile on the `http-ingest` port, starts a
+session. For its duration, cProfile records everything the event
+loop runs, i.e. the managers, the rule checks and the calls to other
+services, and the result is written as a pstats file, e.g. for
+`python -m pstats` or snakeviz. Optionally, the CPU time of each
+configured rule check is recorded too, and written as JSON, hottest
+rule first.
+
+Outside a session, this costs nothing but a check whether one is on
+for each message.
+"""
+
+# A RuleTimes while a session records the time per rule, else None.
+RULE_TIMES = None
+
+
+class ProfilingError(Exception):
+    pass
+
+
+class RuleTimes:
+    def __init__(self):
+        # (manager name, rule index) -> [rule, calls, seconds]
+        self.times = {}
+
+    def add(self, manager, index, rule, seconds):
+        entry = self.times.get((manager, index))
+        if entry is None:
+            entry = self.times[(manager, index)] = [rule, 0, 0.0]
+        entry[1] += 1
+        entry[2] += seconds
+
+    def report(self):
+        rows = [
+            {
+                'manager': manager,
+                'rule': index,
+                'name': rule.name,
+                'function': rule.filter.get('function'),
+                'args': rule.filter.get('args', []),
+                'calls': calls,
+                'cpu_ms': round(seconds * 1000, 3),
+            }
+            for (manager, index), (rule, calls, seconds) in self.times.items()
+        ]
+        return sorted(rows, key=lambda row: row['cpu_ms'], reverse=True)
+
+
+class Profiler:
+    """
+    Settings, from the `profiling` section of the configuration:
+
+    directory: where to write the files, default the current directory.
+    seconds: how long a session lasts, unless the request tells.
+    max-seconds: the longest session a request may ask for,
+    default 600.
+    rules: whether to record CPU time per rule, unless the request
+    tells.
+    """
+
+    def __init__(self, directory='.', seconds=30, max_seconds=600, rules=True):
+        self.directory = directory
+        self.seconds = seconds
+        self.max_seconds = max_seconds
+        self.rules = rules
+        self.running = False
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(**settings('profiling', conf, cls))
+
+    def install_signal_handler(self):
+        loop = asyncio.get_event_loop()
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self.profile_soon)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            logging.warning('Profiling on SIGUSR1 is not supported here')
+
+    def profile_soon(self):
+        asyncio.ensure_future(self.profile_logged())
+
+    async def profile_logged(self):
+        try:
+            await self.profile()
+        except Exception:
+            logging.exception('Profiling failed')
+
+    async def profile(self, seconds=None, rules=None):
+        """
+        Profile for seconds, and return the paths of the files written.
+        """
+        global RULE_TIMES
+        if self.running:
+            raise ProfilingError('Already profiling')
+        seconds = seconds or self.seconds
+        rules = self.rules if rules is None else rules
+        base = os.path.join(
+            self.directory,
+            'mail2alert-%s-%i' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        )
+        logging.info('Profiling for %s s', seconds)
+        profile = cProfile.Profile()
+        self.running = True
+        if rules:
+            RULE_TIMES = RuleTimes()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            rule_times, RULE_TIMES = RULE_TIMES, None
+            self.running = False
+
+        loop = asyncio.get_event_loop()
+        files = await loop.run_in_executor(
+            None,
+            self.write,
+            base,
+            profile,
+            rule_times
+        )
+        logging.info('Wrote profile to %s', ', '.join(files.values()))
+        return files
+
+    @staticmethod
+    def write(base, profile, rule_times):
+        files = {'pstats': base + '.pstats'}
+        profile.dump_stats(files['pstats'])
+        if rule_times is not None:
+            files['rules'] = base + '-rules.json'
+            with open(files['rules'], 'w') as rules_file:
+                json.dump(rule_times.report(), rules_file, indent=2)
+        return files
@@ -0,0 +1,195 @@
+import asyncio
+import importlib
+import logging
+import os
+import signal
+import time
+
+from mail2alert import plugin
+from mail2alert.config import Configuration, configuration_path
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+"""
+Reload the configuration while the server is running.
+
+The configuration file is watched, with inotify if inotify_simple
+is installed, otherwise by polling its modification time. It's also
+reloaded on SIGHUP.
+
+The new configuration is read in a worker thread, and its managers
+are built and validated before anything changes. If that fails, we
+keep running with the old configuration. Otherwise, each new manager
+takes over what still applies from the manager with the same name
+in the old configuration, e.g. GoCD state, Slack and webhook clients,
+and the new list of managers replaces the old one in one assignment.
+The old managers share what was taken over until then, since mail
+keeps coming to them while the new ones initialize, and don't close
+it. Messages already being handled finish with the old managers.
+
+Settings outside `managers`, e.g. `local-smtp`, need a restart.
+"""
+
+RESTART_SETTINGS = (
+    'local-smtp', 'remote-smtp', 'http-ingest', 'console', 'tracing', 'mime-offload'
+)
+
+
+def make_managers(cnf):
+    managers = []
+    for manager_conf in cnf['managers']:
+        manager_module = importlib.import_module(
+            '.' + manager_conf['name'], plugin.__name__
+        )
+        managers.append(manager_module.Manager(manager_conf))
+    return managers
+
+
+async def init_managers(managers, default_timeout=30):
+    """
+    Run async_init for all managers concurrently. A manager which
+    isn't done after `init-timeout` seconds, from its configuration,
+    continues in the background. Return (name, seconds) for each
+    manager.
+    """
+    async def init(manager):
+        name = manager.conf['name']
+        timeout = manager.conf.get('init-timeout', default_timeout)
+        start = time.perf_counter()
+        task = asyncio.ensure_future(manager.async_init())
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(
+                'Manager %s not initialized in %s s, continuing in the background',
+                name,
+                timeout
+            )
+        except Exception:
+            logging.exception('Manager %s failed to initialize', name)
+        return name, time.perf_counter() - start
+
+    return await asyncio.gather(*[init(manager) for manager in managers])
+
+
+class ConfigReloader:
+    def __init__(self, proxy, cnf, path=None, interval=5):
+        self.proxy = proxy
+        self.cnf = cnf
+        self.path = path or configuration_path()
+        self.interval = interval
+        self._stamp = self.stamp()
+        self._lock = asyncio.Lock()
+        self._watch_task = None
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def changed(self):
+        stamp = self.stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        return True
+
+    async def reload(self):
+        """
+        Return True if the new configuration is in use.
+        """
+        async with self._lock:
+            loop = asyncio.get_event_loop()
+            try:
+                cnf = await loop.run_in_executor(None, Configuration, self.path)
+                managers = make_managers(cnf)
+                for manager in managers:
+                    manager.validate()
+            except Exception:
+                logging.exception(
+                    'Bad configuration in %s, keeping the old one',
+                    self.path
+                )
+                return False
+            for key in RESTART_SETTINGS:
+                if cnf.get(key) != self.cnf.get(key):
+                    logging.warning('Changed %s needs a restart', key)
+
+            previous = self.previous_managers()
+            for manager in managers:
+                old = previous.get(manager.conf['name'])
+                if old is not None and type(old) is type(manager):
+                    manager.adopt(old)
+                manager.relay = self.proxy
+            await init_managers(managers)
+
+            old_managers = self.proxy.mail2alert_managers
+            self.proxy.mail2alert_managers = managers
+            self.cnf = cnf
+            logging.info('Reloaded configuration from %s', self.path)
+            for manager in old_managers:
+                await manager.close()
+            return True
+
+    def previous_managers(self):
+        previous = {}
+        for manager in self.proxy.mail2alert_managers:
+            previous.setdefault(manager.conf['name'], manager)
+        return previous
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload_soon)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            logging.warning('Reload on SIGHUP is not supported here')
+        if inotify_simple is not None:
+            self._watch_task = asyncio.ensure_future(self.notify())
+        elif self.interval:
+            self._watch_task = asyncio.ensure_future(self.poll())
+
+    def stop(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    def reload_soon(self):
+        asyncio.ensure_future(self.reload())
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.changed():
+                await self.reload()
+
+    async def notify(self):
+        """
+        Watch the directory, since editors and configuration management
+        tend to replace files rather than write to them.
+        """
+        flags = inotify_simple.flags
+        inotify = inotify_simple.INotify()
+        inotify.add_watch(
+            os.path.dirname(os.path.abspath(self.path)),
+            flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        )
+        events = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        loop.add_reader(inotify.fd, events.set)
+        try:
+            while True:
+                await events.wait()
+                events.clear()
+                inotify.read(timeout=0)
+                # Let a burst of writes settle before reading the file.
+                await asyncio.sleep(0.1)
+                if self.changed():
+                    await self.reload()
+        finally:
+            loop.remove_reader(inotify.fd)
+            inotify.close()
@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 import asyncio
-import importlib
+import inspect
 import logging
 import os
-from email import message_from_bytes
-from email.policy import EmailPolicy
+import signal
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import yaml
 from aiosmtpd.smtp import SMTP
 from aiosmtpd.controller import Controller
 from aiosmtpd.handlers import Proxy, CRLF, NLCRE
 
-from mail2alert import plugin
-from mail2alert.config import Configuration
+from mail2alert.config import (
+    Configuration, compiled_path, configuration_path, read_yaml, write_compiled
+)
+from mail2alert.loopmonitor import LoopMonitor
+from mail2alert.metrics import DROPPED, REFUSED, STAGES
+from mail2alert.mime import MimeOffload, mail_policy, update_mail_to_from  # noqa: F401
+from mail2alert.plugin.mail import Message
+from mail2alert.profiling import Profiler
+from mail2alert.reload import ConfigReloader, init_managers, make_managers
+from mail2alert.tracing import client_span, span, start_trace
+from mail2alert import tracing
 
 """
 This is a mail proxy server based on Python 3 standard
@@ -27,32 +39,22 @@ If the recipient list ends up empty, the message will not
 be sent by the email proxy. This means that the manager
 can drop messages or transport them with other mechanisms
 than email.
-"""
 
+The server accepts mail as soon as the configuration is read and
+valid. Managers are initialized concurrently after that, each with
+a timeout, `init-timeout` in its configuration, after which it
+continues in the background. Heavy modules, e.g. aiohttp and
+email.policy, are imported when first used. A report of how long
+each phase of startup took is logged when the server is up.
 
-def update_mail_to_from(bytes_data, rcpttos, mailfrom):
-    msg = message_from_bytes(
-        bytes_data,
-        policy=EmailPolicy(utf8=True, linesep='\r\n')
-    )
+main runs the server with asyncio.run, until SIGINT or SIGTERM. Then
+it stops accepting messages, lets the managers finish what they have
+queued, and stops the rest, as the shutdown hooks added while
+starting tell. The event loop is uvloop if it's installed, unless
+MAIL2ALERT_EVENT_LOOP says otherwise.
+"""
 
-    logging.debug('Removing To: %s', msg['To'])
-    del msg['To']
-    msg['To'] = rcpttos
-    logging.debug('Added To: %s', msg['To'])
-
-    logging.debug('Removing From: %s', msg['From'])
-    del msg['From']
-    msg['From'] = mailfrom
-    logging.debug('Added From: %s', msg['From'])
-
-    mail_bytes = msg.as_bytes()
-    logging.debug(
-        'update_mail_to_from got %i bytes and returned %i bytes',
-        len(bytes_data),
-        len(mail_bytes)
-    )
-    return mail_bytes
+EVENT_LOOPS = ('auto', 'asyncio', 'uvloop')
 
 
 class SMTPUTF8Controller(Controller):
@@ -61,14 +63,23 @@ class SMTPUTF8Controller(Controller):
 
 
 class Mail2AlertProxy(Proxy):
-    def __init__(self, host, port, managers):
+    def __init__(self, host, port, managers, mime=None):
         self.mail2alert_managers = managers
+        self.mime = mime or MimeOffload()
         super().__init__(host, port)
 
     async def handle_DATA(self, server, session, envelope):
         """
         The Proxy class had confused strings and bytes!
         """
+        with STAGES.time('smtp_receive'), start_trace(
+            'smtp message',
+            peer=session.peer[0]
+        ) as root:
+            logging.debug('handle_DATA trace %s', root.trace_id)
+            return await self._handle_data(session, envelope)
+
+    async def _handle_data(self, session, envelope):
         logging.debug(
             'handle_DATA got %s',
             envelope.content.decode('utf-8')
@@ -99,21 +110,92 @@ class Mail2AlertProxy(Proxy):
     async def _adeliver(self, mailfrom, rcpttos, data):
         for manager in self.mail2alert_managers:
             if manager.wants_message(mailfrom, rcpttos, data):
-                mailfrom, rcpttos, data = await manager.process_message(
-                    mailfrom,
-                    rcpttos,
-                    data
-                )
+                with span('manager', manager=manager.name):
+                    parsed = None
+                    if self.mime.offloads(data):
+                        parsed = await self.mime.parse(data)
+                    mailfrom, rcpttos, data = await manager.process_message(
+                        mailfrom,
+                        rcpttos,
+                        data,
+                        parsed
+                    )
                 if rcpttos:
-                    data = update_mail_to_from(data, rcpttos, mailfrom)
+                    data = await self.mime.update_mail_to_from(data, rcpttos, mailfrom)
                 break
         if rcpttos:
             logging.info('Sending mail to %s', rcpttos)
-            return self._deliver(mailfrom, rcpttos, data)
+            return await self.deliver(mailfrom, rcpttos, data)
         else:
             logging.info('Dropping email.')
+            DROPPED.inc('mail')
             return rcpttos
 
+    async def deliver_event(self, mailfrom, rcpttos, fields, body):
+        """
+        Like _adeliver, for events which arrived as header fields and
+        a body rather than as mail, e.g. through HTTP ingest.
+        """
+        for manager in self.mail2alert_managers:
+            if manager.wants_message(mailfrom, rcpttos, None):
+                with span('manager', manager=manager.name):
+                    msg = manager.get_message(
+                        None,
+                        mail_from=mailfrom,
+                        fields=fields,
+                        body=body
+                    )
+                    rcpttos = await manager.dispatch(msg)
+                break
+        else:
+            msg = Message(None, fields=fields, body=body)
+        if rcpttos:
+            return await self.relay_message(mailfrom, rcpttos, msg, fields)
+        else:
+            logging.info('Dropping event.')
+            DROPPED.inc('event')
+            return rcpttos
+
+    async def relay_message(self, mailfrom, rcpttos, msg, fields=None):
+        """
+        Send mail about a message which didn't arrive as mail,
+        e.g. a GoCD stage run we polled for. fields are header
+        fields to send as well, e.g. those of an event, except for
+        Subject, From and To, which are set here as for mail.
+        """
+        from email.message import EmailMessage
+        mail = EmailMessage(policy=mail_policy())
+        for name, value in (fields or {}).items():
+            if name.lower() not in ('subject', 'from', 'to'):
+                mail[name] = value
+        mail['Subject'] = msg['Subject']
+        mail['From'] = mailfrom
+        mail['To'] = ', '.join(rcpttos)
+        mail.set_content(msg.body)
+        logging.info('Sending mail to %s', rcpttos)
+        refused = await self.deliver(mailfrom, rcpttos, mail.as_bytes())
+        if refused:
+            logging.info('we got some refusals: %s' % refused)
+        return refused
+
+    async def deliver(self, mailfrom, rcpttos, data):
+        """
+        Proxy._deliver blocks while it talks to the remote SMTP
+        server, so it's run in a worker thread.
+        """
+        loop = asyncio.get_running_loop()
+        with STAGES.time('deliver'), client_span('smtp relay', recipients=len(rcpttos)):
+            refused = await loop.run_in_executor(
+                None,
+                self._deliver,
+                mailfrom,
+                rcpttos,
+                data
+            )
+        if refused:
+            REFUSED.inc(amount=len(refused))
+        return refused
+
 
 def host_port(text, default_port=25):
     if ':' in text:
@@ -123,26 +205,178 @@ def host_port(text, default_port=25):
         return text, default_port
 
 
-async def proxy_mail():
-    cnf = Configuration()
-    local_host, local_port = host_port(cnf['local-smtp'])
-    remote_host, remote_port = host_port(cnf['remote-smtp'])
-    managers = []
-    for manager_conf in cnf['managers']:
-        manager_module = importlib.import_module(
-            '.' + manager_conf['name'], plugin.__name__
+class StartupTimer:
+    """
+    Time the phases of starting the server.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - start)
+
+    def record(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    def report(self):
+        """
+        Milliseconds per phase, and in total.
+        """
+        report = OrderedDict(
+            (name, round(seconds * 1000, 1)) for name, seconds in self.phases
         )
-        manager = manager_module.Manager(manager_conf)
-        managers.append(
-            manager
+        report['total'] = round((self.clock() - self.started) * 1000, 1)
+        return report
+
+    def log(self):
+        logging.info('Startup: %s', ', '.join(
+            '%s %s ms' % (name, ms) for name, ms in self.report().items()
+        ))
+
+
+class Lifecycle:
+    """
+    What to do when the server shuts down. The hooks are run in the
+    reverse order of how they were added, so what was started last
+    is stopped first. A hook may return an awaitable, which is given
+    timeout seconds.
+    """
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self._shutdown_hooks = []
+
+    def on_shutdown(self, hook):
+        self._shutdown_hooks.append(hook)
+
+    async def shutdown(self):
+        while self._shutdown_hooks:
+            hook = self._shutdown_hooks.pop()
+            try:
+                result = hook()
+                if inspect.isawaitable(result):
+                    await asyncio.wait_for(result, self.timeout)
+            except Exception:
+                logging.exception('Shutdown hook %r failed', hook)
+
+
+async def close_server(server):
+    server.close()
+    await server.wait_closed()
+
+
+async def close_managers(proxy):
+    # Read at shutdown, since a reload replaces the list.
+    await asyncio.gather(
+        *[manager.close() for manager in proxy.mail2alert_managers]
+    )
+
+
+async def proxy_mail(timer=None, lifecycle=None):
+    timer = timer or StartupTimer()
+    lifecycle = lifecycle or Lifecycle()
+    loop = asyncio.get_running_loop()
+    with timer.phase('configuration'):
+        cnf = Configuration()
+        local_host, local_port = host_port(cnf['local-smtp'])
+        remote_host, remote_port = host_port(cnf['remote-smtp'])
+    loop_monitor = LoopMonitor.from_conf(cnf.get('loop-monitor') or {})
+    loop_monitor.start()
+    lifecycle.on_shutdown(loop_monitor.stop)
+    profiler = Profiler.from_conf(cnf.get('profiling') or {})
+    profiler.install_signal_handler()
+    if 'tracing' in cnf:
+        tracing.configure(cnf['tracing'] or {})
+        lifecycle.on_shutdown(lambda: tracing.configure(None))
+    with timer.phase('managers'):
+        managers = make_managers(cnf)
+        for manager in managers:
+            manager.validate()
+        mime = MimeOffload.from_conf(cnf.get('mime-offload') or {})
+        lifecycle.on_shutdown(mime.close)
+        proxy = Mail2AlertProxy(remote_host, remote_port, managers, mime)
+        for manager in managers:
+            manager.relay = proxy
+    lifecycle.on_shutdown(lambda: close_managers(proxy))
+    with timer.phase('smtp'):
+        smtp_server = await loop.create_server(
+            lambda: SMTP(proxy, enable_SMTPUTF8=True),
+            host=local_host,
+            port=local_port
         )
-        if hasattr(manager, 'async_init'):
-            await manager.async_init()
-    cont = SMTPUTF8Controller(
-        Mail2AlertProxy(remote_host, remote_port, managers),
-        hostname=local_host,
-        port=local_port)
-    cont.start()
+        lifecycle.on_shutdown(lambda: close_server(smtp_server))
+        logging.info('Accepting mail on %s:%s', local_host, local_port)
+    if 'http-ingest' in cnf:
+        with timer.phase('http-ingest'):
+            from mail2alert.ingest import IngestServer
+            ingest_host, ingest_port = host_port(cnf['http-ingest'], 50102)
+            ingest = IngestServer(proxy, profiler)
+            await ingest.start(ingest_host, ingest_port)
+            lifecycle.on_shutdown(ingest.stop)
+    if 'console' in cnf:
+        with timer.phase('console'):
+            from mail2alert.console import Console
+            console_host, console_port = host_port(cnf['console'], 50101)
+            console = Console(proxy, loop_monitor)
+            await console.start(console_host, console_port)
+            lifecycle.on_shutdown(console.stop)
+    with timer.phase('init'):
+        for name, seconds in await init_managers(managers):
+            timer.record('init %s' % name, seconds)
+    reloader = ConfigReloader(proxy, cnf, interval=cnf.get('reload-interval', 5))
+    reloader.start()
+    lifecycle.on_shutdown(reloader.stop)
+    timer.log()
+    return proxy
+
+
+async def serve(timer=None):
+    """
+    Run the server until SIGINT or SIGTERM.
+    """
+    lifecycle = Lifecycle()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            logging.warning('Shutdown on signal %s is not supported here', signum)
+    try:
+        await proxy_mail(timer, lifecycle)
+        await stopping.wait()
+        logging.info('Shutting down')
+    finally:
+        await lifecycle.shutdown()
+
+
+def use_event_loop(name=None, env=os.environ):
+    """
+    Make asyncio.run use the event loop name, by default the one
+    MAIL2ALERT_EVENT_LOOP tells: asyncio, uvloop, or auto, which is
+    uvloop if it's installed. Return the name of the one in use.
+    """
+    name = name or env.get('MAIL2ALERT_EVENT_LOOP') or 'auto'
+    if name not in EVENT_LOOPS:
+        raise ValueError('Unknown event loop: %s' % name)
+    if name == 'asyncio':
+        return name
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            raise ValueError('uvloop is not installed')
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
 
 
 def get_loglevel(env=os.environ):
@@ -153,39 +387,40 @@ def get_loglevel(env=os.environ):
     return logging._nameToLevel.get(log_env, logging.INFO)
 
 
-def main(loglevel=None):
+def main(loglevel=None, event_loop=None):
     if loglevel is None:
         loglevel = get_loglevel()
     logging.basicConfig(
         format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
         level=loglevel
     )
-    loop = asyncio.get_event_loop()
-    loop.create_task(proxy_mail())
+    logging.info('Using the %s event loop', use_event_loop(event_loop))
     try:
-        loop.run_forever()
+        asyncio.run(serve())
     except KeyboardInterrupt:
         logging.info('Got KeyboardInterrupt')
+    except Exception:
+        logging.exception('Could not start the server')
+        sys.exit(1)
 
 
 def get_managers():
     cnf = Configuration()
-    managers = {}
-    for manager in cnf['managers']:
-        manager_module = importlib.import_module(
-            '.' + manager['name'],
-            plugin.__name__
-        )
-        mgr = manager_module.Manager(manager)
-        managers[manager['name']] = mgr
-    return managers
+    return {
+        manager.conf['name']: manager
+        for manager in make_managers(cnf)
+    }
 
 
 async def aselftest():
     managers = get_managers()
     report = {}
-    for name, manager in sorted(managers.items()):
-        report[name] = await manager.test()
+    try:
+        for name, manager in sorted(managers.items()):
+            report[name] = await manager.test()
+    finally:
+        for manager in managers.values():
+            await manager.close()
     return report
 
 
@@ -195,10 +430,7 @@ def selftest(content_type=None):
         format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
         level=loglevel
     )
-    loop = asyncio.get_event_loop()
-    task = loop.create_task(aselftest())
-    loop.run_until_complete(task)
-    report = task.result()
+    report = asyncio.run(aselftest())
     if content_type == 'yaml':
         noalias_dumper = yaml.dumper.SafeDumper
         noalias_dumper.ignore_aliases = lambda self, data: True
@@ -208,3 +440,23 @@ def selftest(content_type=None):
             Dumper=noalias_dumper
         )
     return report
+
+
+def compile_configuration(config_path=None):
+    """
+    Check the configuration, and write it compiled for fast loading.
+    Raises ValueError if it's not valid.
+    """
+    if config_path is None:
+        config_path = configuration_path()
+    cnf = Configuration(config_path, compiled=False)
+    managers = make_managers(cnf)
+    for manager in managers:
+        manager.validate()
+    path = compiled_path(config_path)
+    write_compiled(read_yaml(config_path, expand=False), path, config_path)
+    return {
+        'compiled': path,
+        'managers': len(managers),
+        'rules': sum(len(manager.rule_list) for manager in managers),
+    }
@@ -1,9 +1,185 @@
+import asyncio
 import logging
+import time
+from collections import OrderedDict
 
 from mail2alert.common import AlertLevels
 from mail2alert.config import Configuration
+from mail2alert.metrics import STAGES, cache_lookup
+from mail2alert.tracing import client_span
 
-from aioslacker import Slacker, Error as SlackerError
+"""
+Post messages to Slack.
+
+A SlackClient is meant to live as long as the manager which owns
+it. It resolves its token once, and keeps a pooled HTTP session
+with keep-alive connections to the Slack API for all posts.
+
+With SlackThreads, messages about a pipeline which has already been
+posted to a channel recently are either posted in the thread of the
+first message, or replace it, rather than becoming new posts.
+"""
+
+SLACK_API_URL = 'https://slack.com/api/'
+
+
+class SlackError(Exception):
+    pass
+
+
+class SlackUnavailable(SlackError):
+    """
+    Slack failed in a way which might go away if we try again.
+    """
+
+
+class SlackRateLimited(SlackUnavailable):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SlackClient:
+    timeout = 10
+
+    def __init__(self, token, api_url=SLACK_API_URL):
+        self.token = token
+        self.api_url = api_url if api_url.endswith('/') else api_url + '/'
+        self._session = None
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Settings in the manager configuration take precedence over
+        the global ones, which are only read if needed.
+        """
+        settings = {}
+        for key in ('slack-token', 'slack-api-url'):
+            if key in conf:
+                settings[key] = conf[key]
+        if 'slack-token' not in settings:
+            global_conf = Configuration()
+            for key in ('slack-token', 'slack-api-url'):
+                if key in global_conf and key not in settings:
+                    settings[key] = global_conf[key]
+        return cls(
+            settings.get('slack-token'),
+            settings.get('slack-api-url', SLACK_API_URL)
+        )
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp
+            self._session = aiohttp.ClientSession(
+                headers={'Authorization': 'Bearer %s' % self.token},
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def call(self, method, **params):
+        with client_span('slack ' + method):
+            async with self.session.post(self.api_url + method, json=params) as resp:
+                if resp.status == 429:
+                    raise SlackRateLimited(
+                        '%s: rate limited' % method,
+                        retry_after(resp.headers)
+                    )
+                if resp.status >= 500:
+                    raise SlackUnavailable('%s: HTTP %s' % (method, resp.status))
+                if resp.status != 200:
+                    raise SlackError('%s: HTTP %s' % (method, resp.status))
+                data = await resp.json()
+            if not data.get('ok'):
+                if data.get('error') == 'ratelimited':
+                    raise SlackRateLimited(
+                        '%s: rate limited' % method,
+                        retry_after(resp.headers)
+                    )
+                raise SlackError('%s: %s' % (method, data.get('error')))
+            return data
+
+    async def post_message(self, channel, text='', attachments=None, **options):
+        return await self.call(
+            'chat.postMessage',
+            channel=channel,
+            text=text,
+            attachments=attachments or [],
+            **options
+        )
+
+    async def update_message(self, channel, ts, text='', attachments=None):
+        return await self.call(
+            'chat.update',
+            channel=channel,
+            ts=ts,
+            text=text,
+            attachments=attachments or []
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def retry_after(headers, default=1.0):
+    try:
+        return max(float(headers['Retry-After']), 0.0)
+    except (KeyError, ValueError):
+        return default
+
+
+class SlackThreads:
+    """
+    Remember the first message posted about each pipeline in each
+    channel, for max_age seconds. The least recently started threads
+    are forgotten first when there are more than max_size.
+
+    mode is 'thread' to reply in the thread of the first message, or
+    'update' to replace the first message.
+    """
+    modes = ('thread', 'update')
+
+    def __init__(self, mode='thread', max_age=86400, max_size=10000,
+                 clock=time.time):
+        if mode not in self.modes:
+            raise ValueError("Don't know slack thread mode: %s" % mode)
+        self.mode = mode
+        self.max_age = max_age
+        self.max_size = max_size
+        self.clock = clock
+        # (pipeline, channel) -> (channel id, ts, start time)
+        self._threads = OrderedDict()
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(
+            mode=conf.get('mode', 'thread'),
+            max_age=conf.get('max-age-hours', 24) * 3600,
+            max_size=conf.get('max-size', 10000)
+        )
+
+    def __len__(self):
+        return len(self._threads)
+
+    def get(self, key):
+        """
+        Return (channel id, ts) of the thread for key, if any.
+        """
+        thread = self._threads.get(key)
+        if thread is None:
+            return None
+        if self.clock() - thread[2] > self.max_age:
+            del self._threads[key]
+            return None
+        return thread[:2]
+
+    def start(self, key, channel_id, ts):
+        self._threads.pop(key, None)
+        self._threads[key] = (channel_id, ts, self.clock())
+        while len(self._threads) > self.max_size:
+            self._threads.popitem(last=False)
 
 
 class SlackMessage:
@@ -43,36 +219,84 @@ class SlackMessage:
             AlertLevels.DARK: '#666666',
         }[self.original.alert_level]
 
-    async def post(self, slack_actions):
-        token = Configuration()['slack-token']
+    def content(self, style):
+        if style == 'brief':
+            return dict(text='', attachments=[self.brief_attachment])
+        if style == 'full':
+            return dict(text=self.text, attachments=[self.full_attachment])
+        raise ValueError("Don't know slack message style: %s" % style)
 
-        async with Slacker(token) as slack:
-            for slack_action in slack_actions:
-                channel = slack_action.destination
-                style = slack_action.style
+    def thread_key(self, channel):
+        pipeline = self.original.get('pipeline')
+        if pipeline:
+            return pipeline, channel
+
+    async def post(self, slack_actions, slack=None, concurrency=4, threads=None):
+        """
+        Post using the SlackClient slack, normally the one owned by
+        the manager. Without it, a client is set up for this post only.
+
+        Channels are posted to concurrently, at most concurrency at
+        a time. A channel which fails doesn't stop the others.
+        """
+        if slack is None:
+            slack = SlackClient.from_conf({})
+            try:
+                await self.post(slack_actions, slack, concurrency, threads)
+            finally:
+                await slack.close()
+            return
+
+        import aiohttp
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def post_action(slack_action):
+            channel = slack_action.destination
+            async with semaphore:
                 try:
-                    if style == 'brief':
-                        await self.post_brief(slack, channel)
-                    elif style == 'full':
-                        await self.post_full(slack, channel)
-                    else:
-                        raise ValueError("Don't know slack message style: %s" % style)
-                except SlackerError as error:
+                    await self.post_to(slack, channel, slack_action.style, threads)
+                except (SlackError, aiohttp.ClientError, asyncio.TimeoutError) as error:
                     logging.error("SlackMessage.post: error=%s", error)
                     logging.error("SlackMessage.post: channel=%s", channel)
 
-    async def post_full(self, slack, channel):
-        logging.info("SlackMessage.post full to %s", channel)
-        await slack.chat.post_message(
-            channel,
-            text=self.text,
-            attachments=[self.full_attachment]
+        results = await asyncio.gather(
+            *[post_action(slack_action) for slack_action in slack_actions],
+            return_exceptions=True
         )
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
 
-    async def post_brief(self, slack, channel):
+    async def post_to(self, slack, channel, style, threads=None):
+        if style == 'brief':
+            post = self.post_brief
+        elif style == 'full':
+            post = self.post_full
+        else:
+            raise ValueError("Don't know slack message style: %s" % style)
+        key = self.thread_key(channel) if threads is not None else None
+        thread = threads.get(key) if key else None
+        if key:
+            cache_lookup('slack_threads', thread is not None)
+        with STAGES.time('slack_post'):
+            if thread is None:
+                reply = await post(slack, channel)
+                if key:
+                    threads.start(key, reply['channel'], reply['ts'])
+            elif threads.mode == 'update':
+                await self.update(slack, thread, style)
+            else:
+                await post(slack, channel, thread_ts=thread[1])
+
+    async def post_full(self, slack, channel, **options):
+        logging.info("SlackMessage.post full to %s", channel)
+        return await slack.post_message(channel, **self.content('full'), **options)
+
+    async def post_brief(self, slack, channel, **options):
         logging.info("SlackMessage.post brief to %s", channel)
-        await slack.chat.post_message(
-            channel,
-            text='',
-            attachments=[self.brief_attachment]
-        )
+        return await slack.post_message(channel, **self.content('brief'), **options)
+
+    async def update(self, slack, thread, style):
+        channel_id, ts = thread
+        logging.info("SlackMessage.update %s in %s", ts, channel_id)
+        return await slack.update_message(channel_id, ts, **self.content(style))
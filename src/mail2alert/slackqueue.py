@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+
+from mail2alert.config import settings
+from mail2alert.slackbot import SlackError, SlackUnavailable, SlackRateLimited
+
+"""
+Deliver Slack messages in the background.
+
+Posting to Slack while a mail is handled delays the reply to the
+mail sender, and a post which fails is lost. Instead, managers hand
+their Slack messages to a SlackDispatcher, which returns at once.
+
+The dispatcher keeps one lane per channel. Each lane has a token
+bucket, since Slack allows about one message per second and channel,
+with short bursts above that. Lanes work independently of each
+other, so a busy channel doesn't hold up the others, while messages
+to the same channel are posted in order. A semaphore limits the
+number of posts in flight across all lanes.
+
+Posts which fail in ways which might go away are retried: after
+the time given by Retry-After when Slack says we're rate limited,
+otherwise with exponential backoff.
+"""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def reserve(self):
+        """
+        Take a token, and return the number of seconds to wait
+        before it may be used.
+        """
+        now = self.clock()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    async def take(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class SlackDispatcher:
+    """
+    Settings, from the `slack-queue` section of the manager
+    configuration:
+
+    max-pending: messages waiting to be posted before we drop new ones.
+    rate: messages per second and channel.
+    burst: messages which may be posted to a channel at once.
+    concurrency: posts in flight at once, over all channels.
+    max-retries: retries before we give up on a message.
+    backoff: seconds to wait before the first retry, doubled for
+    each further retry, up to max-backoff.
+    """
+    def __init__(self, slack, max_pending=1000, rate=1.0, burst=3,
+                 concurrency=4, max_retries=5, backoff=1.0, max_backoff=60.0,
+                 threads=None):
+        self.slack = slack
+        self.threads = threads
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.max_pending = max_pending
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pending = 0
+        self._lanes = {}
+        self._workers = {}
+
+    @classmethod
+    def from_conf(cls, slack, conf, threads=None):
+        return cls(slack, threads=threads, **settings('slack-queue', conf, cls))
+
+    def submit(self, slack_message, slack_actions):
+        """
+        Queue slack_message for posting as slack_actions tell.
+        """
+        for slack_action in slack_actions:
+            channel = slack_action.destination
+            if self.pending >= self.max_pending:
+                logging.error(
+                    'SlackDispatcher: %i messages pending, dropping %s to %s',
+                    self.pending,
+                    slack_message.original['Subject'],
+                    channel
+                )
+                continue
+            self._lane(channel).put_nowait((slack_message, slack_action.style))
+            self.pending += 1
+
+    def status(self):
+        return {
+            'pending': self.pending,
+            'lanes': {
+                channel: lane.qsize() for channel, lane in self._lanes.items()
+            },
+        }
+
+    def _lane(self, channel):
+        if channel not in self._lanes:
+            lane = asyncio.Queue()
+            bucket = TokenBucket(self.rate, self.burst)
+            self._lanes[channel] = lane
+            self._workers[channel] = asyncio.ensure_future(
+                self._work(channel, lane, bucket)
+            )
+        return self._lanes[channel]
+
+    async def _work(self, channel, lane, bucket):
+        while True:
+            slack_message, style = await lane.get()
+            try:
+                await self.deliver(slack_message, channel, style, bucket)
+            except Exception:
+                logging.exception('SlackDispatcher: failed posting to %s', channel)
+            finally:
+                self.pending -= 1
+                lane.task_done()
+
+    async def deliver(self, slack_message, channel, style, bucket):
+        import aiohttp
+        retryable = (SlackUnavailable, aiohttp.ClientError, asyncio.TimeoutError)
+        for attempt in range(self.max_retries + 1):
+            await bucket.take()
+            try:
+                async with self._semaphore:
+                    await slack_message.post_to(
+                        self.slack,
+                        channel,
+                        style,
+                        self.threads
+                    )
+                return True
+            except SlackRateLimited as error:
+                delay = error.retry_after
+                logging.warning(
+                    'SlackDispatcher: rate limited in %s, retry in %.1f s',
+                    channel,
+                    delay
+                )
+            except retryable as error:
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                logging.warning(
+                    'SlackDispatcher: %s posting to %s, retry in %.1f s',
+                    error or error.__class__.__name__,
+                    channel,
+                    delay
+                )
+            except SlackError as error:
+                logging.error(
+                    'SlackDispatcher: %s posting to %s',
+                    error,
+                    channel
+                )
+                return False
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        logging.error(
+            'SlackDispatcher: giving up posting %s to %s',
+            slack_message.original['Subject'],
+            channel
+        )
+        return False
+
+    async def join(self):
+        """
+        Wait until all messages submitted so far are handled.
+        """
+        for lane in list(self._lanes.values()):
+            await lane.join()
+
+    async def close(self, timeout=None):
+        """
+        Stop the lanes, after waiting at most timeout seconds for
+        pending messages.
+        """
+        if timeout:
+            try:
+                await asyncio.wait_for(self.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(
+                    'SlackDispatcher: dropping %i pending messages',
+                    self.pending
+                )
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._lanes.clear()
+        self._workers.clear()
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import os
+"""
+Keep manager state on disk between restarts.
+
+A snapshot file is an append-only journal with one JSON record
+per line: [key, value]. Replaying the journal from the top gives
+the current value for each key, so a crash in the middle of a
+write costs us at most the last record. When the journal has
+grown long enough, the owner compacts it into one record per key.
+The compacted file is written by a worker thread, so the event loop
+isn't held up by it; records made meanwhile are added to it before
+it replaces the journal.
+"""
+
+
+class Snapshot:
+    def __init__(self, path, compact_after=1000):
+        self.path = path
+        self.compact_after = compact_after
+        self._journal = None
+        self._appended = 0
+        self._torn = False
+        # Records made while compacting, or None when we aren't.
+        self._compacting = None
+
+    def load(self):
+        """
+        Replay the journal and return a dict with the latest value
+        for each key, or None if there is no snapshot yet.
+        """
+        data = {}
+        lines = 0
+        try:
+            with open(self.path) as journal:
+                for line in journal:
+                    # A crash during write may leave a partial last line.
+                    self._torn = not line.endswith('\n')
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        logging.warning('Skipping bad record in %s', self.path)
+                        continue
+                    data[key] = value
+                    lines += 1
+        except FileNotFoundError:
+            logging.info('No snapshot in %s', self.path)
+            return None
+        self._appended = lines - len(data)
+        logging.info('Loaded %s keys from snapshot %s', len(data), self.path)
+        return data
+
+    def record(self, key, value):
+        if self._journal is None:
+            self._journal = open(self.path, 'a')
+            if self._torn:
+                self._journal.write('\n')
+                self._torn = False
+        line = json.dumps([key, value]) + '\n'
+        self._journal.write(line)
+        self._journal.flush()
+        self._appended += 1
+        if self._compacting is not None:
+            self._compacting.append(line)
+
+    @property
+    def needs_compaction(self):
+        return self._compacting is None and self._appended > self.compact_after
+
+    def compact(self, items):
+        """
+        Replace the journal with one record per (key, value) in items,
+        followed by what's recorded while we write those. The new file
+        is written aside and renamed into place, so we never leave a
+        half written snapshot behind. Returns the task which does it.
+        """
+        self._compacting = []
+        return asyncio.ensure_future(self._compact(list(items)))
+
+    async def _compact(self, items):
+        tmp_path = self.path + '.tmp'
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._write_compacted, tmp_path, items
+            )
+            with open(tmp_path, 'a') as tmp:
+                tmp.writelines(self._compacting)
+            self.close()
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            logging.error('Could not compact snapshot %s: %s', self.path, error)
+            return
+        finally:
+            recorded = self._compacting
+            self._compacting = None
+        self._appended = len(recorded)
+        self._torn = False
+        logging.info('Compacted snapshot %s to %s records', self.path, len(items))
+
+    @staticmethod
+    def _write_compacted(tmp_path, items):
+        with open(tmp_path, 'w') as tmp:
+            for key, value in items:
+                tmp.write(json.dumps([key, value]) + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
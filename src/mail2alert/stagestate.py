@@ -0,0 +1,181 @@
+import time
+from array import array
+from collections.abc import MutableMapping
+"""
+A compact store for the last known state of pipeline stages.
+
+Keys are "pipeline/stage" strings, as used in GoCD subjects. The
+pipeline and stage names are interned separately, so a pipeline
+with many stages, or a stage name used by many pipelines, is only
+stored once. Each entry is a small integer state code in an array,
+plus the time it was last set.
+
+Looking up an unknown stage gives the default state without
+storing anything. Stages which haven't been set for `ttl` seconds
+are dropped, as are the least recently set ones when there are more
+than `max_size` of them. `on_expire` is called with the key of each
+stage dropped, e.g. to forget it on disk too.
+
+There is room for 2 ** STAGE_BITS stage names in use at once. Setting
+a stage with a new name beyond that raises ValueError.
+"""
+
+# A key is the pipeline id shifted left by this, or'ed with the stage id.
+STAGE_BITS = 20
+
+
+class _Names:
+    """
+    Interned names with reference counts, so that the ids of names
+    no longer in use are recycled.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.refs = array('L')
+        self.free = []
+
+    def acquire(self, name):
+        name_id = self.ids.get(name)
+        if name_id is None:
+            if self.free:
+                name_id = self.free.pop()
+                self.names[name_id] = name
+            else:
+                name_id = len(self.names)
+                self.names.append(name)
+                self.refs.append(0)
+            self.ids[name] = name_id
+        self.refs[name_id] += 1
+        return name_id
+
+    def release(self, name_id):
+        self.refs[name_id] -= 1
+        if not self.refs[name_id]:
+            del self.ids[self.names[name_id]]
+            self.names[name_id] = None
+            self.free.append(name_id)
+
+
+class StageStates(MutableMapping):
+    def __init__(self, states, ttl=None, max_size=None, clock=time.time,
+                 on_expire=None):
+        """
+        states is a sequence of state classes. The position of a
+        class is its state code, and the first one is the default.
+        """
+        self._states = tuple(states)
+        self._codes = {state: code for code, state in enumerate(self._states)}
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self.on_expire = on_expire
+        self._pipelines = _Names()
+        self._stages = _Names()
+        # key -> slot, ordered from least to most recently set.
+        self._slots = {}
+        self._state_codes = array('B')
+        self._set_times = array('d')
+        self._free_slots = []
+
+    def _key(self, pipeline_stage):
+        pipeline, _, stage = pipeline_stage.partition('/')
+        pipeline_id = self._pipelines.ids.get(pipeline)
+        stage_id = self._stages.ids.get(stage)
+        if pipeline_id is None or stage_id is None:
+            return None
+        return pipeline_id << STAGE_BITS | stage_id
+
+    def _name(self, key):
+        return '{}/{}'.format(
+            self._pipelines.names[key >> STAGE_BITS],
+            self._stages.names[key & ((1 << STAGE_BITS) - 1)]
+        )
+
+    def __getitem__(self, pipeline_stage):
+        slot = self._slots.get(self._key(pipeline_stage))
+        if slot is None:
+            return self._states[0]()
+        return self._states[self._state_codes[slot]]()
+
+    def __setitem__(self, pipeline_stage, state):
+        code = self._codes[state.__class__]
+        if not code:
+            if pipeline_stage in self:
+                del self[pipeline_stage]
+            return
+        now = self._clock()
+        key = self._key(pipeline_stage)
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            pipeline, _, stage = pipeline_stage.partition('/')
+            pipeline_id = self._pipelines.acquire(pipeline)
+            stage_id = self._stages.acquire(stage)
+            if stage_id >> STAGE_BITS:
+                self._pipelines.release(pipeline_id)
+                self._stages.release(stage_id)
+                raise ValueError(
+                    'More than %i stage names, no room for %r' % (1 << STAGE_BITS, stage)
+                )
+            key = pipeline_id << STAGE_BITS | stage_id
+            if self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                slot = len(self._state_codes)
+                self._state_codes.append(0)
+                self._set_times.append(0)
+        self._slots[key] = slot
+        self._state_codes[slot] = code
+        self._set_times[slot] = now
+        self.expire(now)
+
+    def __delitem__(self, pipeline_stage):
+        key = self._key(pipeline_stage)
+        if key not in self._slots:
+            raise KeyError(pipeline_stage)
+        self._remove(key)
+
+    def _remove(self, key):
+        self._free_slots.append(self._slots.pop(key))
+        self._pipelines.release(key >> STAGE_BITS)
+        self._stages.release(key & ((1 << STAGE_BITS) - 1))
+
+    def __contains__(self, pipeline_stage):
+        return self._key(pipeline_stage) in self._slots
+
+    def get(self, pipeline_stage, default=None):
+        if pipeline_stage in self:
+            return self[pipeline_stage]
+        return default
+
+    def __iter__(self):
+        for key in list(self._slots):
+            yield self._name(key)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def expire(self, now=None):
+        """
+        Drop entries which are too old or too many. The least
+        recently set entries come first, so we can stop as soon as
+        we find one we keep.
+        """
+        if now is None:
+            now = self._clock()
+        expired = []
+        excess = len(self._slots) - self.max_size if self.max_size else 0
+        for key, slot in self._slots.items():
+            if len(expired) < excess:
+                expired.append(key)
+            elif self.ttl and self._set_times[slot] < now - self.ttl:
+                expired.append(key)
+            else:
+                break
+        for key in expired:
+            name = self._name(key) if self.on_expire else None
+            self._remove(key)
+            if name is not None:
+                self.on_expire(name)
+        return len(expired)
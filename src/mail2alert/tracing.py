@@ -0,0 +1,282 @@
+import json
+import logging
+import queue
+import random
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from mail2alert.config import settings
+
+"""
+Per-message tracing.
+
+A trace starts when a message arrives, in handle_DATA or for an
+HTTP ingest event, and has spans around the managers, the rule
+checks and the outbound calls: GoCD, Slack, webhooks and the SMTP
+relay. The current span is kept in a context variable, so it follows
+the message through awaits without being passed around.
+
+The decision whether to keep a trace is made when it's done, so
+slow traces, and traces with errors, are always kept, while others
+are kept with the probability `sample-rate`. Kept traces are written
+to a rotating file, one OTLP JSON object per line, as the OpenTelemetry
+collector's file exporter writes them. They're serialized and written
+by a thread of their own, so the event loop doesn't wait for the disk.
+
+Tracing is off unless the configuration has a `tracing` section, and
+then costs a few microseconds per span. Spans started in background
+tasks after the message is done, e.g. by the Slack queue, are not
+recorded.
+"""
+
+_current_span = ContextVar('mail2alert_span', default=None)
+
+TRACER = None
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def new_id(bits):
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_attributes(attributes):
+    return [
+        {'key': key, 'value': otlp_value(value)}
+        for key, value in attributes.items()
+    ]
+
+
+class Trace:
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.trace_id = new_id(128)
+        self.spans = []
+        self.finished = False
+
+    def add(self, span):
+        self.spans.append(span)
+
+    def finish(self, root):
+        self.finished = True
+        self.tracer.finish(self, root)
+
+    def otlp(self):
+        return {
+            'resourceSpans': [{
+                'resource': {
+                    'attributes': otlp_attributes({'service.name': 'mail2alert'})
+                },
+                'scopeSpans': [{
+                    'scope': {'name': 'mail2alert'},
+                    'spans': [span.otlp() for span in self.spans],
+                }],
+            }]
+        }
+
+
+class Span:
+    __slots__ = (
+        'trace', 'name', 'span_id', 'parent_id', 'kind', 'attributes',
+        'start', 'end', 'error', '_token'
+    )
+
+    def __init__(self, trace, name, parent_id=None, kind=SPAN_KIND_INTERNAL,
+                 attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = new_id(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start = self.end = None
+        self.error = None
+
+    @property
+    def trace_id(self):
+        return self.trace.trace_id
+
+    @property
+    def duration(self):
+        return (self.end - self.start) / 1e9
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time_ns()
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.error = '%s: %s' % (exc_type.__name__, exc)
+        self.trace.add(self)
+        if self.parent_id is None:
+            self.trace.finish(self)
+
+    def otlp(self):
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': otlp_attributes(self.attributes),
+            'status': (
+                {'code': STATUS_ERROR, 'message': self.error}
+                if self.error else {'code': STATUS_OK}
+            ),
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class NoSpan:
+    """
+    Stands in for a span when we aren't tracing.
+    """
+    trace_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def start_trace(name, **attributes):
+    if TRACER is None:
+        return NO_SPAN
+    return Span(Trace(TRACER), name, attributes=attributes)
+
+
+def span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """
+    A span in the current trace, if there is one.
+    """
+    parent = _current_span.get()
+    if parent is None or parent.trace.finished:
+        return NO_SPAN
+    return Span(parent.trace, name, parent.span_id, kind, attributes)
+
+
+def client_span(name, **attributes):
+    return span(name, SPAN_KIND_CLIENT, **attributes)
+
+
+def current_trace_id():
+    parent = _current_span.get()
+    return parent.trace_id if parent is not None else None
+
+
+class _TraceHandler(QueueHandler):
+    """
+    Queues the records as they are, for the listener thread to
+    serialize the traces in them.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _TraceFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg)
+
+
+class Tracer:
+    """
+    Settings, from the `tracing` section of the configuration:
+
+    file: where to write traces, default traces.jsonl.
+    sample-rate: the share of traces which aren't slow and had no
+    errors to keep, default 0.01.
+    slow-ms: traces taking at least this long are always kept,
+    default 1000.
+    max-bytes: size at which the file is rotated, default 10 MB.
+    backup-count: rotated files to keep, default 5.
+    """
+
+    def __init__(self, path='traces.jsonl', sample_rate=0.01, slow_ms=1000,
+                 max_bytes=10 * 1024 * 1024, backup_count=5, rng=random.random):
+        self.sample_rate = sample_rate
+        self.slow = slow_ms / 1000
+        self.rng = rng
+        file_handler = RotatingFileHandler(
+            path,
+            maxBytes=max_bytes,
+            backupCount=backup_count
+        )
+        file_handler.setFormatter(_TraceFormatter())
+        self.queue = queue.Queue()
+        self.listener = QueueListener(self.queue, file_handler)
+        self.listener.start()
+        self.handler = _TraceHandler(self.queue)
+        self.logger = logging.getLogger('mail2alert.traces')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(**settings('tracing', conf, cls, {'file': 'path'}))
+
+    def keep(self, root):
+        return (
+            root.duration >= self.slow
+            or any(span.error for span in root.trace.spans)
+            or self.rng() < self.sample_rate
+        )
+
+    def finish(self, trace, root):
+        if self.keep(root):
+            self.logger.info(trace.otlp())
+
+    def flush(self):
+        """
+        Wait until the traces kept so far are written.
+        """
+        self.queue.join()
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def configure(conf):
+    """
+    Start tracing as the `tracing` section conf tells, or stop
+    tracing if it's None.
+    """
+    global TRACER
+    if TRACER is not None:
+        TRACER.close()
+    TRACER = Tracer.from_conf(conf) if conf is not None else None
+    return TRACER
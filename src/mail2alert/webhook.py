@@ -0,0 +1,259 @@
+import asyncio
+import logging
+from collections import defaultdict
+from enum import Enum
+
+from mail2alert.config import settings
+from mail2alert.tracing import client_span
+
+"""
+Deliver messages to HTTP webhooks, for `webhook:` actions.
+
+All webhooks of a manager share one aiohttp session, with a limit
+on the number of connections to each host. Each message is POSTed
+as a JSON object, built from a template if the action names one.
+With a batch size above one, messages to the same URL which arrive
+within a short delay of each other are POSTed together as a JSON
+array.
+
+Deliveries which fail in ways which might go away, i.e. connection
+errors, timeouts, HTTP 429 and 5xx, are retried with exponential
+backoff, each by a task which sleeps until its retry is due. There
+are at most max-pending of those at once; further failures are
+dropped, and counted.
+
+Templates are checked when the sender is made, so a configuration
+with a template which can't be rendered is refused.
+"""
+
+
+class WebhookError(Exception):
+    pass
+
+
+class WebhookUnavailable(WebhookError):
+    pass
+
+
+def message_fields(msg):
+    """
+    The values a template may use: subject, from, body, and the
+    fields the manager extracted, e.g. pipeline and event for gocd.
+    """
+    fields = {
+        key: value.name if isinstance(value, Enum) else value
+        for key, value in msg.items()
+    }
+    fields.update(
+        subject=msg['Subject'],
+        body=msg.body,
+        alert_level=msg.alert_level.name,
+    )
+    fields['from'] = msg.get('From')
+    return fields
+
+
+def render(template, fields):
+    if isinstance(template, str):
+        return template.format_map(defaultdict(str, fields))
+    if isinstance(template, dict):
+        return {key: render(value, fields) for key, value in template.items()}
+    if isinstance(template, list):
+        return [render(value, fields) for value in template]
+    return template
+
+
+def check_template(name, template):
+    """
+    Raise ValueError if template can't be rendered, e.g. for bad
+    syntax, or a field such as {subject.x} or {subject[0]}.
+    """
+    try:
+        render(template, {})
+    except (ValueError, AttributeError, IndexError, KeyError, TypeError) as error:
+        raise ValueError('Bad webhook template %s: %s' % (name, error))
+
+
+class WebhookSender:
+    """
+    Settings, from the `webhooks` section of the manager
+    configuration:
+
+    templates: JSON templates by name. Strings in a template may
+    refer to message fields as e.g. {subject} or {pipeline}.
+    limit-per-host: connections to each host.
+    batch-size: messages POSTed together to a URL.
+    batch-delay: seconds to wait for more messages to a URL.
+    max-retries: retries before we give up on a delivery.
+    max-pending: retries waiting at once before we drop new ones.
+    backoff: seconds to wait before the first retry, doubled for
+    each further retry, up to max-backoff.
+    timeout: seconds to wait for a webhook to reply.
+    """
+
+    def __init__(self, templates=None, limit_per_host=4, batch_size=1,
+                 batch_delay=0.5, max_retries=5, max_pending=1000,
+                 backoff=1.0, max_backoff=60.0, timeout=10):
+        self.templates = templates or {}
+        for name, template in self.templates.items():
+            check_template(name, template)
+        self.limit_per_host = limit_per_host
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._session = None
+        self._batches = {}
+        self._batch_timers = {}
+        self._tasks = set()
+        self._retrying = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(**settings('webhooks', conf, cls))
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=self.limit_per_host
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    def payload(self, msg, template_name):
+        fields = message_fields(msg)
+        if template_name is None:
+            return {
+                key: value for key, value in fields.items()
+                if isinstance(value, (str, int, float, bool, type(None)))
+            }
+        try:
+            template = self.templates[template_name]
+        except KeyError:
+            raise WebhookError('No webhook template %s' % template_name)
+        return render(template, fields)
+
+    def submit(self, msg, webhook_actions):
+        """
+        Queue msg for delivery as webhook_actions tell.
+        """
+        for action in webhook_actions:
+            try:
+                payload = self.payload(msg, action.template)
+            except (WebhookError, ValueError, AttributeError, IndexError,
+                    KeyError, TypeError) as error:
+                logging.error('WebhookSender: %s for %s', error, action.destination)
+                continue
+            if self.batch_size <= 1:
+                self._start(self.send(action.destination, payload))
+                continue
+            batch = self._batches.setdefault(action.destination, [])
+            batch.append(payload)
+            if len(batch) >= self.batch_size:
+                self._flush(action.destination)
+            elif action.destination not in self._batch_timers:
+                self._batch_timers[action.destination] = self._start(
+                    self._flush_later(action.destination)
+                )
+
+    def status(self):
+        return {
+            'batched': sum(len(batch) for batch in self._batches.values()),
+            'tasks': len(self._tasks),
+            'retrying': self._retrying,
+            'dropped': self.dropped,
+        }
+
+    def _start(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self, url):
+        await asyncio.sleep(self.batch_delay)
+        self._batch_timers.pop(url, None)
+        self._flush(url)
+
+    def _flush(self, url):
+        timer = self._batch_timers.pop(url, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._batches.pop(url, None)
+        if batch:
+            self._start(self.send(url, batch))
+
+    async def post(self, url, data):
+        with client_span('POST', url=url) as post_span:
+            async with self.session.post(url, json=data) as resp:
+                post_span.set(status=resp.status)
+                if resp.status == 429 or resp.status >= 500:
+                    raise WebhookUnavailable('%s: HTTP %s' % (url, resp.status))
+                if resp.status >= 300:
+                    raise WebhookError('%s: HTTP %s' % (url, resp.status))
+                await resp.read()
+
+    async def send(self, url, data, attempt=0):
+        import aiohttp
+        try:
+            await self.post(url, data)
+            return True
+        except (WebhookUnavailable, aiohttp.ClientError, asyncio.TimeoutError) as error:
+            if attempt >= self.max_retries:
+                logging.error('WebhookSender: giving up on %s: %s', url, error)
+            elif self._retrying >= self.max_pending:
+                self.dropped += 1
+                logging.error(
+                    'WebhookSender: %i retries pending, dropping %s: %s',
+                    self._retrying, url, error
+                )
+            else:
+                logging.warning('WebhookSender: %s, will retry', error or url)
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                # Counted from now, so a burst of failures can't get
+                # past max-pending before the retries start.
+                self._retrying += 1
+                self._start(self._send_later(delay, url, data, attempt + 1))
+        except WebhookError as error:
+            logging.error('WebhookSender: %s', error)
+        return False
+
+    async def _send_later(self, delay, url, data, attempt):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._retrying -= 1
+        await self.send(url, data, attempt)
+
+    async def join(self):
+        """
+        Wait until everything submitted so far is delivered, or
+        given up on.
+        """
+        for url in list(self._batches):
+            self._flush(url)
+        # A retry is started before the send which failed is done.
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def close(self, timeout=None):
+        if timeout:
+            try:
+                await asyncio.wait_for(self.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning('WebhookSender: dropping undelivered messages')
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
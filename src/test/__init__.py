@@ -0,0 +1,5 @@
+import os
+
+if os.environ.get('MAIL2ALERT_LOOP_DEBUG'):
+    from mail2alert import loopmonitor
+    loopmonitor.fail_on_blocking()
@@ -11,6 +11,33 @@ class ActionsTests(unittest.TestCase):
 
         self.assertEqual([a.destination for a in act.mailto], ['a@b.c', 'd@e.f'])
 
+    def test_same_actions_once(self):
+        act = actions.Actions([
+            'mailto:a@b.c',
+            'slack:#channel',
+            'mailto:a@b.c',
+            'slack:#channel:brief',
+            'slack:#channel:full',
+        ])
+
+        self.assertEqual([a.destination for a in act.mailto], ['a@b.c'])
+        self.assertEqual([a.style for a in act.slack], ['brief', 'full'])
+
+    def test_webhook_actions(self):
+        act = actions.Actions([
+            'webhook:https://example.com:8443/hook',
+            'webhook:https://example.com:8443/hook#incident',
+            'webhook:https://example.com:8443/hook',
+        ])
+
+        self.assertEqual(
+            [(a.destination, a.template) for a in act.webhook],
+            [
+                ('https://example.com:8443/hook', None),
+                ('https://example.com:8443/hook', 'incident'),
+            ]
+        )
+
     def test_mixed_actions(self):
         actions.logging = MagicMock()
 
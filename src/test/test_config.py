@@ -1,3 +1,9 @@
+import datetime
+import json
+import os
+import shutil
+import stat
+import tempfile
 import unittest
 
 import mail2alert.config
@@ -9,5 +15,91 @@ class ConfigTests(unittest.TestCase):
 
         self.assertEqual(conf['local-smtp'], 'localhost:1025')
 
+
+class SettingsTests(unittest.TestCase):
+    @staticmethod
+    def target(max_size=1, path=None):
+        pass
+
+    def test_settings(self):
+        self.assertEqual(
+            {'max_size': 2, 'path': 'x'},
+            mail2alert.config.settings(
+                'test',
+                {'max-size': 2, 'file': 'x'},
+                self.target,
+                {'file': 'path'}
+            )
+        )
+
+    def test_unknown_setting(self):
+        with self.assertRaisesRegex(ValueError, "'max-sise' in test"):
+            mail2alert.config.settings('test', {'max-sise': 2}, self.target)
+
+
+class CompiledConfigTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'configuration.yml')
+        shutil.copy('configuration.yml', self.path)
+        self.compiled = mail2alert.config.compiled_path(self.path)
+        os.environ['SLACK_TOKEN'] = 'xoxb-compiled'
+        mail2alert.config.write_compiled(
+            mail2alert.config.read_yaml(self.path, expand=False),
+            self.compiled,
+            self.path
+        )
+
+    def tearDown(self):
+        del os.environ['SLACK_TOKEN']
+        self.dir.cleanup()
+
+    def test_read_compiled(self):
+        conf = mail2alert.config.Configuration(self.path)
+
+        self.assertEqual(conf['local-smtp'], 'localhost:1025')
+        self.assertEqual(conf['slack-token'], 'xoxb-compiled')
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.compiled).st_mode),
+            0o600
+        )
+
+    def test_json(self):
+        with open(self.compiled, 'rb') as compiled_file:
+            compiled_file.readline()
+            data = json.loads(compiled_file.read().decode('utf-8'))
+
+        self.assertEqual(data['local-smtp'], 'localhost:1025')
+        self.assertNotIn(b'xoxb-compiled', open(self.compiled, 'rb').read())
+
+    def test_expand_when_read(self):
+        os.environ['SLACK_TOKEN'] = 'xoxb-changed'
+
+        conf = mail2alert.config.Configuration(self.path)
+
+        self.assertEqual(conf['slack-token'], 'xoxb-changed')
+
+    def test_not_json(self):
+        for data in ({'since': datetime.date(2019, 1, 1)}, {'ports': {25: 'smtp'}}):
+            with self.assertRaises(ValueError):
+                mail2alert.config.write_compiled(data, self.compiled, self.path)
+
+    def test_ignore_damaged(self):
+        with open(self.compiled, 'r+b') as compiled_file:
+            compiled_file.seek(-1, os.SEEK_END)
+            compiled_file.write(b'?')
+
+        self.assertIsNone(
+            mail2alert.config.read_compiled(self.compiled, self.path)
+        )
+
+    def test_ignore_when_yaml_changed(self):
+        with open(self.path, 'a') as conf_file:
+            conf_file.write('http-ingest: localhost:50102\n')
+
+        conf = mail2alert.config.Configuration(self.path)
+
+        self.assertEqual(conf['http-ingest'], 'localhost:50102')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import unittest
+
+import yaml
+
+from mail2alert import server
+from mail2alert.console import Console
+from mail2alert.plugin import gocd, mail
+
+
+class ConsoleTests(unittest.TestCase):
+    def setUp(self):
+        self.gocd = gocd.Manager({
+            'name': 'gocd',
+            'url': 'http://localhost:8153/go',
+            'rules': [{
+                'actions': ['mailto:team@example.com', 'slack:#team:full'],
+                'filter': {
+                    'events': ['BREAKS'],
+                    'function': 'pipelines.in_group',
+                    'args': ['g1'],
+                }
+            }],
+        })
+        self.mail = mail.Manager({'name': 'mail', 'rules': []})
+        self.proxy = server.Mail2AlertProxy('localhost', 8025, [self.gocd, self.mail])
+        self.console = Console(self.proxy)
+        loop = asyncio.get_event_loop()
+        server_ = self.gocd.default_server
+        server_._pipeline_groups = [{'name': 'g1', 'pipelines': [{'name': 'p1'}]}]
+        server_._pipeline_groups_time = loop.time()
+
+    def run_command(self, command):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.console.run(command))
+
+    def test_eval(self):
+        state_before = len(self.gocd.previous_pipeline_state)
+
+        reply = yaml.safe_load(self.run_command('eval gocd Stage [p1/2/build/1] is broken'))
+
+        self.assertEqual('BREAKS', reply['event'])
+        self.assertEqual(
+            ['mailto:team@example.com', 'slack:#team:full'],
+            reply['actions']
+        )
+        self.assertEqual(state_before, len(self.gocd.previous_pipeline_state))
+
+    def test_eval_unknown_manager(self):
+        self.assertEqual('No manager x\n', self.run_command('eval x Hello'))
+
+    def test_gocd(self):
+        self.gocd.previous_pipeline_state['p1/build'] = gocd.BuildStateFailure()
+
+        reply = yaml.safe_load(self.run_command('gocd'))
+
+        status = reply['gocd']['gocd']
+        self.assertEqual(1, status['pipeline-groups'])
+        self.assertEqual(1, status['stage-states'])
+        self.assertLess(status['pipeline-groups-age'], 5)
+
+    def test_queues(self):
+        reply = yaml.safe_load(self.run_command('queues'))
+
+        self.assertEqual({'rules': 0}, reply['mail'])
+
+    def test_tasks(self):
+        async def waiting():
+            await asyncio.sleep(10)
+
+        async def tasks():
+            task = asyncio.ensure_future(waiting())
+            await asyncio.sleep(0)
+            try:
+                return await self.console.run('tasks')
+            finally:
+                task.cancel()
+
+        loop = asyncio.get_event_loop()
+        reply = loop.run_until_complete(tasks())
+
+        self.assertIn('waiting at', reply)
+
+    def test_unknown_command(self):
+        self.assertIn('Unknown command', self.run_command('frobnicate'))
+
+    def test_over_tcp(self):
+        async def talk():
+            await self.console.start('localhost', 8096)
+            try:
+                reader, writer = await asyncio.open_connection('localhost', 8096)
+                writer.write(b'help\nquit\n')
+                reply = await reader.read()
+                writer.close()
+                return reply.decode('utf-8')
+            finally:
+                await self.console.stop()
+
+        loop = asyncio.get_event_loop()
+        reply = loop.run_until_complete(talk())
+
+        self.assertIn('eval <name> <subject>', reply)
+
+
+if __name__ == '__main__':
+    unittest.main()
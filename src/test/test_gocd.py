@@ -1,9 +1,15 @@
 import asyncio
+import gc
+import os
+import tempfile
+import tracemalloc
 import unittest
 from collections import defaultdict
 from email.message import EmailMessage
 from xml.etree import ElementTree as Et
 
+from aiohttp import web
+
 from mail2alert.plugin import gocd
 
 
@@ -65,6 +71,44 @@ class GocdPipelinesTests(unittest.TestCase):
         self.assertTrue(rule_filter(dict(pipeline='b-test-release-x')))
         self.assertFalse(rule_filter(dict(pipeline='a-test')))
 
+    def test_filter_in_group_list(self):
+        pipelines = gocd.Pipelines(self.pipeline_groups)
+
+        rule_filter = pipelines.in_group(group=['alpha', 'release'])
+
+        self.assertTrue(rule_filter(dict(pipeline='a-build')))
+        self.assertTrue(rule_filter(dict(pipeline='b-test-release-x')))
+        self.assertFalse(rule_filter(dict(pipeline='b-test')))
+
+    def test_filter_in_any_group(self):
+        pipelines = gocd.Pipelines(self.pipeline_groups)
+
+        rule_filter = pipelines.in_any_group('alpha', 'beta')
+
+        self.assertTrue(rule_filter(dict(pipeline='a-test')))
+        self.assertTrue(rule_filter(dict(pipeline='b-test')))
+        self.assertFalse(rule_filter(dict(pipeline='a-test-release-x')))
+        self.assertFalse(rule_filter(dict(pipeline='unknown')))
+
+    def test_filter_name_like_in_group_list(self):
+        pipelines = gocd.Pipelines(self.pipeline_groups)
+
+        rule_filter = pipelines.name_like_in_group(
+            r'(.+)-release.*',
+            ['alpha', 'gamma']
+        )
+
+        self.assertTrue(rule_filter(dict(pipeline='a-test-release-x')))
+        self.assertFalse(rule_filter(dict(pipeline='b-test-release-x')))
+
+    def test_groups_of(self):
+        pipelines = gocd.Pipelines(self.pipeline_groups + [
+            {'name': 'extra', 'pipelines': [{'name': 'a-build'}]}
+        ])
+
+        self.assertEqual({'alpha', 'extra'}, pipelines.groups_of('a-build'))
+        self.assertEqual((), pipelines.groups_of('nowhere'))
+
     def test_filter_all(self):
         pipelines = gocd.Pipelines(self.pipeline_groups)
 
@@ -202,7 +246,7 @@ class ManagerTests(unittest.TestCase):
 
     def test_test_msgs(self):
         mgr = gocd.Manager(dict())
-        mgr._pipeline_groups = [
+        mgr.default_server._pipeline_groups = [
             {
                 'name': 'g1',
                 'pipelines': [
@@ -336,7 +380,7 @@ class ManagerTests(unittest.TestCase):
             },
         ]
         mgr = gocd.Manager(dict(rules=rules))
-        mgr._pipeline_groups = pipeline_groups
+        mgr.default_server._pipeline_groups = pipeline_groups
 
         loop = asyncio.get_event_loop()
         test_task = loop.create_task(mgr.test())
@@ -390,6 +434,46 @@ class ManagerTests(unittest.TestCase):
         self.assertEqual(['nosy@example.com'], receiver)
         self.assertIn(b'failed', body)
 
+    def test_memory_levels_off(self):
+        """
+        With state-max-stages, messages about ever new pipelines
+        don't make the manager grow, once it's full.
+        """
+        mgr = gocd.Manager({
+            'state-max-stages': 50,
+            'rules': [
+                {
+                    'actions': ['mailto:nosy@example.com'],
+                    'filter': {'events': ['BREAKS'], 'function': 'pipelines.any'},
+                },
+            ],
+        })
+        mgr.default_server._pipeline_groups = []
+        mgr.default_server._pipeline_groups_time = asyncio.get_event_loop().time()
+
+        async def process(first, count):
+            for i in range(first, first + count):
+                msg = EmailMessage()
+                msg['Subject'] = 'Stage [release-%i/1/build/1] failed' % i
+                await mgr.process_message('go@example.com', ['m@example.com'], msg.as_bytes())
+                # As the SMTP server does between messages.
+                await asyncio.sleep(0)
+
+        loop = asyncio.get_event_loop()
+        tracemalloc.start()
+        try:
+            loop.run_until_complete(process(0, 200))
+            gc.collect()
+            before, _ = tracemalloc.get_traced_memory()
+            loop.run_until_complete(process(200, 600))
+            gc.collect()
+            after, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(len(mgr.previous_pipeline_state), 50)
+        self.assertLess(after - before, 64 * 1024)
+
     def test_parse_cctray(self):
         xml = """<?xml version="1.0" encoding="utf-8"?>
 <Projects>
@@ -449,12 +533,298 @@ class ManagerTests(unittest.TestCase):
   />
 </Projects>"""
         mgr = gocd.Manager({})
-        mgr.parse_cctray(Et.fromstring(xml))
+        mgr.default_server.parse_cctray(Et.fromstring(xml))
 
         self.assertEqual(mgr.previous_pipeline_state['p1/build'], gocd.BuildStateSuccess())
         self.assertEqual(mgr.previous_pipeline_state['p2/build'], gocd.BuildStateSuccess())
         self.assertEqual(mgr.previous_pipeline_state['p2/test'], gocd.BuildStateFailure())
 
+    def test_snapshot_warm_start(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conf = dict(snapshot=os.path.join(tmp, 'gocd.snapshot'))
+            mgr = gocd.Manager(conf)
+            server = mgr.default_server
+            server._pipeline_groups = [{'name': 'g1', 'pipelines': [{'name': 'p1'}]}]
+            server.save_pipeline_groups()
+            mail = EmailMessage()
+            mail['Subject'] = 'Stage [p1/232/build/1] failed'
+            mgr.get_message(mail.as_bytes())
+            server._snapshot.close()
+
+            restarted = gocd.Manager(conf)
+            self.assertTrue(restarted.default_server.load_snapshot())
+
+        self.assertEqual(
+            restarted.default_server._pipeline_groups,
+            server._pipeline_groups
+        )
+        self.assertEqual(
+            restarted.previous_pipeline_state['p1/build'],
+            gocd.BuildStateFailure()
+        )
+
+    def test_snapshot_only_changes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'gocd.snapshot')
+            mgr = gocd.Manager(dict(snapshot=path))
+            for subject in (
+                'Stage [p1/1/build/1] failed',
+                'Stage [p1/2/build/1] failed',
+                'Stage [p1/3/build/1] passed',
+            ):
+                mail = EmailMessage()
+                mail['Subject'] = subject
+                mgr.get_message(mail.as_bytes())
+            mgr.default_server._snapshot.close()
+
+            with open(path) as journal:
+                self.assertEqual(
+                    ['["stage:p1/build", "Failure"]\n', '["stage:p1/build", "Success"]\n'],
+                    journal.readlines()
+                )
+
+    def test_snapshot_forgets_expired(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conf = dict(snapshot=os.path.join(tmp, 'gocd.snapshot'))
+            mgr = gocd.Manager(dict(conf, **{'state-max-stages': 1}))
+            for subject in ('Stage [p1/1/build/1] failed', 'Stage [p2/1/build/1] failed'):
+                mail = EmailMessage()
+                mail['Subject'] = subject
+                mgr.get_message(mail.as_bytes())
+            mgr.default_server._snapshot.close()
+
+            restarted = gocd.Manager(conf)
+            restarted.default_server.load_snapshot()
+
+        self.assertEqual(['p2/build'], list(restarted.previous_pipeline_state))
+
+
+class ValidateTests(unittest.TestCase):
+    @staticmethod
+    def manager(rule_filter):
+        return gocd.Manager({
+            'url': 'http://localhost:8153/go',
+            'rules': [{'actions': ['mailto:a@example.com'], 'filter': rule_filter}],
+        })
+
+    def test_valid(self):
+        self.manager({
+            'events': ['BREAKS', 'FIXED'],
+            'function': 'pipelines.name_like_in_group',
+            'args': ['(.+)-release.*', 'g1'],
+        }).validate()
+
+    def test_invalid(self):
+        for rule_filter in (
+            {'function': 'pipelines.in_grupp', 'args': ['g1']},
+            {'function': 'pipelines.any', 'events': ['BROKEN']},
+            {'function': 'pipelines.name_like_in_group', 'args': ['(.+', 'g1']},
+            {'function': 'pipelines.name_like_in_group', 'args': ['.+', 'g1']},
+        ):
+            with self.assertRaises(ValueError):
+                self.manager(rule_filter).validate()
+
+
+class MultiServerTests(unittest.TestCase):
+    conf = {
+        'user': 'olle',
+        'servers': [
+            {'name': 'a', 'url': 'http://a/go', 'sender': 'go@a.example.com'},
+            {'name': 'b', 'url': 'http://b/go', 'headers': {'X-GoCD': 'b'}},
+        ],
+        'rules': [
+            {
+                'actions': ['mailto:a-team@example.com'],
+                'filter': {
+                    'events': ['BREAKS'],
+                    'function': 'pipelines.in_group',
+                    'args': ['g1'],
+                }
+            },
+        ]
+    }
+
+    def test_servers_inherit_settings(self):
+        mgr = gocd.Manager(self.conf)
+
+        self.assertEqual(['a', 'b'], [s.name for s in mgr.servers])
+        self.assertEqual('olle', mgr.servers[1].conf['user'])
+
+    def test_attribution(self):
+        mgr = gocd.Manager(self.conf)
+        mail = EmailMessage()
+        mail['Subject'] = 'Stage [p1/2/build/1] is broken'
+        mail['X-GoCD'] = 'b'
+        content = mail.as_bytes()
+
+        by_sender = mgr.get_message(content, mail_from='go@a.example.com')
+        by_header = mgr.get_message(content, mail_from='go@other.example.com')
+
+        self.assertEqual('a', by_sender['server'])
+        self.assertEqual('b', by_header['server'])
+        self.assertEqual(
+            gocd.BuildStateFailure(),
+            mgr.servers[0].previous_pipeline_state['p1/build']
+        )
+        self.assertEqual(
+            gocd.BuildStateFailure(),
+            mgr.servers[1].previous_pipeline_state['p1/build']
+        )
+
+    def test_rules_use_the_groups_of_the_server(self):
+        mgr = gocd.Manager(self.conf)
+        mgr.servers[0]._pipeline_groups = [
+            {'name': 'g1', 'pipelines': [{'name': 'p1'}]}
+        ]
+        mgr.servers[1]._pipeline_groups = [
+            {'name': 'g1', 'pipelines': [{'name': 'p2'}]}
+        ]
+
+        async def dispatch(header):
+            mail = EmailMessage()
+            mail['Subject'] = 'Stage [p1/2/build/1] is broken'
+            mail['X-GoCD'] = header
+            msg = mgr.get_message(mail.as_bytes(), mail_from='go@example.com')
+            return await mgr.dispatch(msg)
+
+        loop = asyncio.get_event_loop()
+
+        self.assertEqual(
+            ['a-team@example.com'],
+            loop.run_until_complete(dispatch('a'))
+        )
+        self.assertEqual(
+            [],
+            loop.run_until_complete(dispatch('b'))
+        )
+
+
+class HistoryPollerTests(unittest.TestCase):
+    def test_report_again_after_failure(self):
+        relayed = []
+
+        class Relay:
+            @staticmethod
+            async def relay_message(mail_from, rcpt_tos, msg):
+                if not relayed:
+                    relayed.append(None)
+                    raise ConnectionRefusedError()
+                relayed.append(msg['event'])
+
+        mgr = gocd.Manager({
+            'url': 'http://localhost:8089/go',
+            'rules': [{
+                'actions': ['mailto:we@example.com'],
+                'filter': {'events': ['BREAKS'], 'function': 'pipelines.any'},
+            }],
+        })
+        mgr.relay = Relay()
+        mgr.previous_pipeline_state['p1/build'] = gocd.BuildStateSuccess()
+        poller = gocd.HistoryPoller(mgr, mgr.default_server)
+        poller.cursors = {'p1/build': (1, 1)}
+        loop = asyncio.get_event_loop()
+
+        with self.assertRaises(ConnectionRefusedError):
+            loop.run_until_complete(poller.report((2, 1), 'p1', 'build', 'Failed'))
+
+        self.assertEqual((1, 1), poller.cursors['p1/build'])
+        self.assertEqual(gocd.BuildStateSuccess(), mgr.previous_pipeline_state['p1/build'])
+
+        loop.run_until_complete(poller.report((2, 1), 'p1', 'build', 'Failed'))
+
+        self.assertEqual([None, gocd.Event.BREAKS], relayed)
+        self.assertEqual((2, 1), poller.cursors['p1/build'])
+
+    def test_poll(self):
+        last_counter = [1]
+        history = {'pipelines': []}
+        relayed = []
+
+        # noinspection PyUnusedLocal
+        async def handle_cctray(request):
+            xml = (
+                '<Projects><Project name="p1 :: build" '
+                'lastBuildStatus="Success" lastBuildLabel="{0}" '
+                'lastBuildTime="2017-05-18T15:31:16" '
+                'webUrl="http://localhost/go/pipelines/p1/{0}/build/1"/>'
+                '</Projects>'
+            ).format(last_counter[0])
+            return web.Response(text=xml, content_type='application/xml')
+
+        # noinspection PyUnusedLocal
+        async def handle_history(request):
+            return web.json_response(history)
+
+        # noinspection PyUnusedLocal
+        async def handle_pipeline_groups(request):
+            return web.json_response([])
+
+        class Relay:
+            @staticmethod
+            async def relay_message(mail_from, rcpt_tos, msg):
+                relayed.append((mail_from, rcpt_tos, msg['event']))
+
+        async def poll_twice():
+            app = web.Application()
+            app.router.add_get('/go/cctray.xml', handle_cctray)
+            app.router.add_get('/go/api/pipelines/p1/history', handle_history)
+            app.router.add_get(
+                '/go/api/config/pipeline_groups',
+                handle_pipeline_groups
+            )
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, 'localhost', 8089)
+            await site.start()
+            try:
+                rules = [
+                    {
+                        'actions': ['mailto:we@example.com'],
+                        'filter': {
+                            'events': ['BREAKS', 'FIXED'],
+                            'function': 'pipelines.any',
+                        }
+                    },
+                ]
+                mgr = gocd.Manager(
+                    dict(url='http://localhost:8089/go', rules=rules)
+                )
+                mgr.relay = Relay()
+                mgr.previous_pipeline_state['p1/build'] = gocd.BuildStateSuccess()
+                poller = gocd.HistoryPoller(
+                    mgr,
+                    mgr.default_server,
+                    mail_from='go@example.com'
+                )
+                await poller.poll()
+                last_counter[0] = 3
+                history['pipelines'] = [
+                    {'counter': 3, 'stages': [
+                        {'name': 'build', 'counter': '1', 'result': 'Passed'}
+                    ]},
+                    {'counter': 2, 'stages': [
+                        {'name': 'build', 'counter': '1', 'result': 'Failed'}
+                    ]},
+                    {'counter': 1, 'stages': [
+                        {'name': 'build', 'counter': '1', 'result': 'Passed'}
+                    ]},
+                ]
+                await poller.poll()
+                await poller.poll()
+            finally:
+                await runner.cleanup()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(poll_twice())
+
+        self.assertEqual(
+            [
+                ('go@example.com', ['we@example.com'], gocd.Event.BREAKS),
+                ('go@example.com', ['we@example.com'], gocd.Event.FIXED),
+            ],
+            relayed
+        )
+
 
 class MessageTests(unittest.TestCase):
     def test_parse_fixed_pipeline(self):
@@ -0,0 +1,165 @@
+import asyncio
+import unittest
+from email import message_from_bytes
+
+import aiohttp
+
+from mail2alert import server
+from mail2alert.ingest import IngestServer, normalize_event
+from mail2alert.plugin import mail
+
+
+class RecordingProxy(server.Mail2AlertProxy):
+    def __init__(self, managers):
+        super().__init__('localhost', 8025, managers)
+        self.delivered = []
+
+    def _deliver(self, mail_from, rcpt_tos, data):
+        self.delivered.append((mail_from, rcpt_tos, message_from_bytes(data)))
+        return {}
+
+
+class NormalizeEventTests(unittest.TestCase):
+    def test_normalize(self):
+        event = {
+            'from': 'a@example.com',
+            'to': ['b@example.com', 'c@example.com'],
+            'subject': 'Hello',
+            'body': 'Body',
+            'headers': {'X-Extra': 'x'},
+        }
+
+        mail_from, rcpt_tos, fields, body = normalize_event(event)
+
+        self.assertEqual('a@example.com', mail_from)
+        self.assertEqual(['b@example.com', 'c@example.com'], rcpt_tos)
+        self.assertEqual(
+            {
+                'X-Extra': 'x',
+                'Subject': 'Hello',
+                'From': 'a@example.com',
+                'To': 'b@example.com, c@example.com',
+            },
+            fields
+        )
+        self.assertEqual('Body', body)
+
+    def test_normalize_needs_subject(self):
+        with self.assertRaises(KeyError):
+            normalize_event({'from': 'a@example.com'})
+
+    def test_normalize_single_recipient(self):
+        _, rcpt_tos, fields, _ = normalize_event({
+            'to': 'ops@example.com',
+            'subject': 'Hello',
+        })
+
+        self.assertEqual(['ops@example.com'], rcpt_tos)
+        self.assertEqual('ops@example.com', fields['To'])
+
+    def test_normalize_bad_recipients(self):
+        with self.assertRaises(TypeError):
+            normalize_event({'to': {'ops': 'example.com'}, 'subject': 'Hello'})
+
+    def test_normalize_bad_headers(self):
+        with self.assertRaises(TypeError):
+            normalize_event({'headers': ['abc'], 'subject': 'Hello'})
+
+    def test_normalize_bad_subject(self):
+        with self.assertRaises(TypeError):
+            normalize_event({'subject': 123})
+
+
+class DeliverEventTests(unittest.TestCase):
+    def test_relay_keeps_headers(self):
+        proxy = RecordingProxy([])
+        mail_from, rcpt_tos, fields, body = normalize_event({
+            'from': 'x@example.com',
+            'to': 'y@example.com',
+            'subject': 'Hi',
+            'body': 'Body',
+            'headers': {'X-Extra': 'x'},
+        })
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(proxy.deliver_event(mail_from, rcpt_tos, fields, body))
+
+        [(_, _, msg)] = proxy.delivered
+        self.assertEqual('x', msg['X-Extra'])
+        self.assertEqual('Hi', msg['Subject'])
+        self.assertEqual('y@example.com', msg['To'])
+
+
+class IngestServerTests(unittest.TestCase):
+    def test_post_batch(self):
+        manager = mail.Manager({
+            'messages-we-want': {'from': 'go@example.com'},
+            'rules': [
+                {
+                    'actions': ['mailto:sys@example.com'],
+                    'filter': {
+                        'function': 'mail.in_subject',
+                        'args': ['backup'],
+                    }
+                },
+            ]
+        })
+        proxy = RecordingProxy([manager])
+        events = [
+            {'from': 'go@example.com', 'subject': 'Backup failed'},
+            {'from': 'go@example.com', 'subject': 'Something else'},
+            {'from': 'x@example.com', 'to': ['y@example.com'], 'subject': 'Hi'},
+            {'from': 'x@example.com'},
+        ]
+
+        async def post():
+            ingest = IngestServer(proxy)
+            await ingest.start('localhost', 8092)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(
+                        'http://localhost:8092/events',
+                        json=events
+                    ) as response:
+                        return response.status, await response.json()
+            finally:
+                await ingest.stop()
+
+        loop = asyncio.get_event_loop()
+        status, reply = loop.run_until_complete(post())
+
+        self.assertEqual(200, status)
+        self.assertEqual(4, len(reply['results']))
+        self.assertIn('error', reply['results'][3])
+        self.assertEqual(
+            [
+                ('go@example.com', ['sys@example.com'], 'Backup failed'),
+                ('x@example.com', ['y@example.com'], 'Hi'),
+            ],
+            [(f, t, m['Subject']) for f, t, m in proxy.delivered]
+        )
+
+    def test_metrics(self):
+        async def get():
+            ingest = IngestServer(RecordingProxy([]))
+            await ingest.start('localhost', 8092)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(
+                        'http://localhost:8092/metrics'
+                    ) as response:
+                        return response, await response.text()
+            finally:
+                await ingest.stop()
+
+        loop = asyncio.get_event_loop()
+        response, text = loop.run_until_complete(get())
+
+        self.assertEqual(200, response.status)
+        self.assertEqual('text/plain', response.content_type)
+        self.assertIn('# TYPE mail2alert_stage_seconds histogram\n', text)
+        self.assertIn('# TYPE mail2alert_messages_total counter\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
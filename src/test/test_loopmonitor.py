@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import os
+import time
+import unittest
+
+from mail2alert import loopmonitor
+from mail2alert.loopmonitor import (
+    BlockingCallError, DebugEventLoopPolicy, FailOnSlowCallbacks, LoopMonitor
+)
+
+
+def block(seconds):
+    time.sleep(seconds)
+
+
+class LoopMonitorTests(unittest.TestCase):
+    @unittest.skipIf(
+        os.environ.get('MAIL2ALERT_LOOP_DEBUG'),
+        'Blocks the loop on purpose'
+    )
+    def test_lag_and_blocking(self):
+        monitor = LoopMonitor(interval=0.02, threshold=0.1)
+        measured = loopmonitor.LOOP_LAG.count()
+        blocked = loopmonitor.BLOCKED.value()
+
+        async def run():
+            monitor.start()
+            try:
+                await asyncio.sleep(0.1)
+                block(0.3)
+                await asyncio.sleep(0.05)
+            finally:
+                await monitor.stop()
+
+        loop = asyncio.get_event_loop()
+        with self.assertLogs(level='WARNING'):
+            loop.run_until_complete(run())
+
+        self.assertGreater(loopmonitor.LOOP_LAG.count(), measured + 2)
+        self.assertEqual(blocked + 1, loopmonitor.BLOCKED.value())
+        [(_, seconds, stack)] = monitor.blocked
+        self.assertGreater(seconds, 0.1)
+        self.assertIn('in block', stack)
+
+    def test_not_blocked(self):
+        monitor = LoopMonitor(interval=0.02, threshold=0.1)
+
+        async def run():
+            monitor.start()
+            try:
+                await asyncio.sleep(0.2)
+            finally:
+                await monitor.stop()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run())
+
+        self.assertEqual(0, len(monitor.blocked))
+
+
+class FailOnBlockingTests(unittest.TestCase):
+    def setUp(self):
+        self.handler = FailOnSlowCallbacks()
+        logging.getLogger('asyncio').addHandler(self.handler)
+        self.loop = DebugEventLoopPolicy(0.05).new_event_loop()
+
+    def tearDown(self):
+        logging.getLogger('asyncio').removeHandler(self.handler)
+        self.loop.close()
+
+    def test_blocking_fails(self):
+        async def blocking():
+            block(0.1)
+
+        with self.assertRaises(BlockingCallError):
+            self.loop.run_until_complete(blocking())
+
+    def test_not_blocking(self):
+        async def sleeping():
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(sleeping())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
+import asyncio
 import unittest
 from email.message import EmailMessage
+from unittest.mock import patch
 
+from mail2alert.common import AlertLevels
 from mail2alert.plugin import mail
 
 
@@ -22,6 +25,62 @@ class MailMessage(unittest.TestCase):
         self.assertEqual(msg['extra'], 'extra')
         self.assertEqual(msg.body, 'body body body.\n')
 
+    def test_message_from_fields(self):
+        msg = mail.Message(None, fields={'Subject': 'About'}, body='body')
+
+        self.assertEqual(msg['Subject'], 'About')
+        self.assertEqual(msg.get('From'), None)
+        self.assertEqual(msg.body, 'body')
+
+    def test_compact(self):
+        email = EmailMessage()
+        email['Subject'] = 'About'
+        email['From'] = 'sen@der'
+        email.set_content('body body body.')
+        msg = mail.Message(email.as_bytes())
+        msg['extra'] = 'extra'
+        msg.alert_level = AlertLevels.DANGER
+
+        compact = msg.compact()
+
+        self.assertIsNone(compact._msg)
+        self.assertEqual(compact['Subject'], 'About')
+        self.assertEqual(compact.get('From'), 'sen@der')
+        self.assertEqual(compact['extra'], 'extra')
+        self.assertEqual(compact.body, 'body body body.\n')
+        self.assertEqual(compact.alert_level, AlertLevels.DANGER)
+        self.assertIs(compact.compact(), compact)
+
+
+class DispatchTests(unittest.TestCase):
+    @patch.object(mail.Manager, 'notify_slack')
+    def test_each_action_once(self, notify_slack):
+        async def notify(msg, slack_actions):
+            notified.append([(a.destination, a.style) for a in slack_actions])
+
+        notified = []
+        notify_slack.side_effect = notify
+        manager = mail.Manager({
+            'rules': [
+                {
+                    'actions': ['mailto:a@example.com', 'slack:#builds'],
+                    'filter': {'function': 'mail.in_subject', 'args': ['backup']},
+                },
+                {
+                    'actions': ['mailto:a@example.com', 'slack:#builds',
+                                'slack:#builds:full'],
+                    'filter': {'function': 'mail.in_subject', 'args': ['failed']},
+                },
+            ]
+        })
+        msg = mail.Message(None, fields={'Subject': 'Backup failed'})
+
+        loop = asyncio.get_event_loop()
+        recipients = loop.run_until_complete(manager.dispatch(msg))
+
+        self.assertEqual(['a@example.com'], recipients)
+        self.assertEqual([[('#builds', 'brief'), ('#builds', 'full')]], notified)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+
+from mail2alert import metrics
+from mail2alert.metrics import Counter, Histogram, Registry
+from mail2alert.plugin import mail
+
+
+class CounterTests(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = Counter('m_total', 'Messages.', ('manager', 'event'), registry)
+
+        counter.inc('gocd', 'BREAKS')
+        counter.inc('gocd', 'BREAKS')
+        counter.inc('mail', '', amount=3)
+
+        self.assertEqual(2, counter.value('gocd', 'BREAKS'))
+        self.assertEqual(
+            '# HELP m_total Messages.\n'
+            '# TYPE m_total counter\n'
+            'm_total{manager="gocd",event="BREAKS"} 2\n'
+            'm_total{manager="mail",event=""} 3\n',
+            registry.render()
+        )
+
+    def test_escape_label_values(self):
+        registry = Registry()
+        counter = Counter('c_total', 'C.', ('x',), registry)
+
+        counter.inc('a"b\\c\nd')
+
+        self.assertIn(r'c_total{x="a\"b\\c\nd"} 1', registry.render())
+
+
+class HistogramTests(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        histogram = Histogram('s_seconds', 'Stages.', ('stage',), (0.1, 1), registry)
+
+        histogram.observe(0.05, 'parse')
+        histogram.observe(0.1, 'parse')
+        histogram.observe(0.5, 'parse')
+        histogram.observe(3, 'parse')
+
+        self.assertEqual(
+            '# HELP s_seconds Stages.\n'
+            '# TYPE s_seconds histogram\n'
+            's_seconds_bucket{stage="parse",le="0.1"} 2\n'
+            's_seconds_bucket{stage="parse",le="1"} 3\n'
+            's_seconds_bucket{stage="parse",le="+Inf"} 4\n'
+            's_seconds_sum{stage="parse"} 3.65\n'
+            's_seconds_count{stage="parse"} 4\n',
+            registry.render()
+        )
+
+    def test_time(self):
+        histogram = Histogram('t_seconds', 'T.', ('stage',), registry=None)
+
+        with self.assertRaises(ValueError):
+            with histogram.time('x'):
+                raise ValueError
+
+        self.assertEqual(1, histogram.count('x'))
+
+
+class InstrumentationTests(unittest.TestCase):
+    def test_dispatch(self):
+        manager = mail.Manager({
+            'name': 'mail',
+            'rules': [{
+                'actions': ['mailto:sys@example.com'],
+                'filter': {'function': 'mail.in_subject', 'args': ['hi']},
+            }],
+        })
+        messages = metrics.MESSAGES.value('mail', '')
+        dispatched = metrics.STAGES.count('dispatch')
+        rules = metrics.STAGES.count('rules')
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(
+            manager.dispatch(mail.Message(None, fields={'Subject': 'Hi'}))
+        )
+
+        self.assertEqual(messages + 1, metrics.MESSAGES.value('mail', ''))
+        self.assertEqual(dispatched + 1, metrics.STAGES.count('dispatch'))
+        self.assertEqual(rules + 1, metrics.STAGES.count('rules'))
+
+    def test_parse(self):
+        parsed = metrics.STAGES.count('parse')
+
+        mail.Message(b'Subject: Hi\r\n\r\nBody\r\n')
+
+        self.assertEqual(parsed + 1, metrics.STAGES.count('parse'))
+
+
+if __name__ == '__main__':
+    unittest.main()
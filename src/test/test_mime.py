@@ -0,0 +1,180 @@
+import asyncio
+import unittest
+from email import message_from_bytes
+from email.message import EmailMessage
+
+from mail2alert import server
+from mail2alert.mime import MimeOffload, parse_message, update_mail_to_from
+from mail2alert.plugin import gocd, mail
+
+
+def make_mail(subject='Build failed', body='It broke.\n'):
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = 'go@example.com'
+    msg['To'] = 'mail2alert@example.com'
+    msg.set_content(body)
+    return msg.as_bytes()
+
+
+class RecordingProxy(server.Mail2AlertProxy):
+    def __init__(self, managers, mime):
+        super().__init__('localhost', 8025, managers, mime)
+        self.delivered = []
+
+    def _deliver(self, mail_from, rcpt_tos, data):
+        self.delivered.append((mail_from, rcpt_tos, message_from_bytes(data)))
+        return {}
+
+
+class ParseMessageTests(unittest.TestCase):
+    def test_fields_and_body(self):
+        fields, body = parse_message(make_mail())
+
+        self.assertEqual('Build failed', fields['Subject'])
+        self.assertEqual('go@example.com', fields['From'])
+        self.assertEqual('It broke.\n', body)
+
+    def test_as_message(self):
+        fields, body = parse_message(make_mail())
+        parsed = mail.Message(None, fields=fields, body=body)
+        inline = mail.Message(make_mail())
+
+        self.assertEqual(inline['Subject'], parsed['Subject'])
+        self.assertEqual(inline.body, parsed.body)
+
+    def test_lower_case_header_names(self):
+        data = (
+            b'subject: Stage [p/1/build/1] failed\r\n'
+            b'from: go@example.com\r\n'
+            b'\r\n'
+            b'It broke.\r\n'
+        )
+        fields, body = parse_message(data)
+        parsed = gocd.Message(None, fields=fields, body=body)
+        inline = gocd.Message(data)
+
+        self.assertEqual(inline['Subject'], parsed['Subject'])
+        self.assertEqual(inline['From'], parsed['From'])
+        self.assertEqual(inline['event'], parsed['event'])
+        self.assertEqual('p', parsed['pipeline'])
+
+    def test_multipart(self):
+        msg = EmailMessage()
+        msg['Subject'] = 'Report'
+        msg.set_content('text')
+        msg.add_attachment(b'data', maintype='application', subtype='octet-stream')
+
+        fields, body = parse_message(msg.as_bytes())
+
+        self.assertEqual('Report', fields['Subject'])
+        self.assertEqual('', body)
+
+
+class MimeOffloadTests(unittest.TestCase):
+    def test_from_conf(self):
+        mime = MimeOffload.from_conf({'threshold-kb': 1, 'workers': 3})
+
+        self.assertEqual(1024, mime.threshold)
+        self.assertEqual(3, mime.workers)
+
+    def test_offloads(self):
+        mime = MimeOffload(threshold_kb=1)
+
+        self.assertFalse(mime.offloads(b'x' * 1023))
+        self.assertTrue(mime.offloads(b'x' * 1024))
+        self.assertFalse(mime.offloads(None))
+
+    def test_no_workers(self):
+        mime = MimeOffload(threshold_kb=0, workers=0)
+
+        self.assertFalse(mime.offloads(b'x' * 1024 * 1024))
+
+    def test_same_as_inline(self):
+        data = make_mail(body='line\n' * 1000)
+        mime = MimeOffload(threshold_kb=1, workers=1)
+
+        async def run():
+            return (
+                await mime.parse(data),
+                await mime.update_mail_to_from(data, ['a@example.com'], 'b@example.com'),
+            )
+
+        try:
+            parsed, updated = asyncio.get_event_loop().run_until_complete(run())
+        finally:
+            mime.close()
+
+        self.assertEqual(parse_message(data), parsed)
+        self.assertEqual(
+            update_mail_to_from(data, ['a@example.com'], 'b@example.com'),
+            updated
+        )
+
+    def test_proxy_offloads(self):
+        manager = mail.Manager({
+            'messages-we-want': {'to': 'mail2alert@example.com'},
+            'rules': [
+                {
+                    'actions': ['mailto:sys@example.com'],
+                    'filter': {
+                        'function': 'mail.in_subject',
+                        'args': ['failed'],
+                    },
+                },
+            ],
+        })
+        mime = MimeOffload(threshold_kb=0, workers=1)
+        proxy = RecordingProxy([manager], mime)
+
+        try:
+            asyncio.get_event_loop().run_until_complete(proxy._adeliver(
+                'go@example.com',
+                ['mail2alert@example.com'],
+                make_mail()
+            ))
+        finally:
+            mime.close()
+
+        [(mail_from, rcpt_tos, msg)] = proxy.delivered
+        self.assertEqual(['sys@example.com'], rcpt_tos)
+        self.assertEqual('sys@example.com', msg['To'])
+        self.assertEqual('Build failed', msg['Subject'])
+
+    def test_proxy_offloads_lower_case_header_names(self):
+        manager = mail.Manager({
+            'messages-we-want': {'to': 'mail2alert@example.com'},
+            'rules': [
+                {
+                    'actions': ['mailto:sys@example.com'],
+                    'filter': {
+                        'function': 'mail.in_subject',
+                        'args': ['failed'],
+                    },
+                },
+            ],
+        })
+        data = (
+            b'subject: Build failed\r\n'
+            b'from: go@example.com\r\n'
+            b'to: mail2alert@example.com\r\n'
+            b'\r\n'
+            b'It broke.\r\n'
+        )
+        delivered = []
+        for mime in (MimeOffload(workers=0), MimeOffload(threshold_kb=0, workers=1)):
+            proxy = RecordingProxy([manager], mime)
+            try:
+                asyncio.get_event_loop().run_until_complete(proxy._adeliver(
+                    'go@example.com',
+                    ['mail2alert@example.com'],
+                    data
+                ))
+            finally:
+                mime.close()
+            [(_, rcpt_tos, msg)] = proxy.delivered
+            delivered.append((rcpt_tos, msg['Subject']))
+
+        inline, offloaded = delivered
+        self.assertEqual((['sys@example.com'], 'Build failed'), inline)
+        self.assertEqual(inline, offloaded)
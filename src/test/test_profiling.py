@@ -0,0 +1,134 @@
+import asyncio
+import json
+import pstats
+import tempfile
+import unittest
+
+import aiohttp
+
+from mail2alert import profiling, server
+from mail2alert.ingest import IngestServer
+from mail2alert.plugin import mail
+from mail2alert.profiling import Profiler, ProfilingError
+
+
+def make_manager():
+    return mail.Manager({
+        'name': 'mail',
+        'rules': [
+            {
+                'name': 'backup',
+                'actions': ['mailto:sys@example.com'],
+                'filter': {'function': 'mail.in_subject', 'args': ['backup']},
+            },
+            {
+                'name': 'disk',
+                'actions': ['mailto:ops@example.com'],
+                'filter': {'function': 'mail.in_subject', 'args': ['disk']},
+            },
+        ]
+    })
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.profiler = Profiler(self.dir.name, seconds=0.1)
+        self.manager = make_manager()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def dispatch_while_profiling(self, **kwargs):
+        profile = asyncio.ensure_future(self.profiler.profile(**kwargs))
+        await asyncio.sleep(0)
+        for _ in range(3):
+            msg = mail.Message(None, fields={'Subject': 'Backup failed'})
+            await self.manager.dispatch(msg)
+        return await profile
+
+    def test_profile(self):
+        loop = asyncio.get_event_loop()
+        files = loop.run_until_complete(self.dispatch_while_profiling())
+
+        stats = pstats.Stats(files['pstats'])
+        self.assertIn(
+            'matching_actions',
+            {function for _, _, function in stats.stats}
+        )
+        with open(files['rules']) as rules_file:
+            rules = json.load(rules_file)
+        self.assertEqual(['backup', 'disk'], sorted(rule['name'] for rule in rules))
+        self.assertEqual([3, 3], [rule['calls'] for rule in rules])
+        self.assertIsNone(profiling.RULE_TIMES)
+        self.assertFalse(self.profiler.running)
+
+    def test_without_rules(self):
+        loop = asyncio.get_event_loop()
+        files = loop.run_until_complete(self.dispatch_while_profiling(rules=False))
+
+        self.assertEqual(['pstats'], list(files))
+
+    def test_one_at_a_time(self):
+        async def twice():
+            first = asyncio.ensure_future(self.profiler.profile())
+            await asyncio.sleep(0)
+            try:
+                await self.profiler.profile()
+            finally:
+                await first
+
+        loop = asyncio.get_event_loop()
+        with self.assertRaises(ProfilingError):
+            loop.run_until_complete(twice())
+
+    def test_http(self):
+        proxy = server.Mail2AlertProxy('localhost', 8025, [self.manager])
+
+        async def post():
+            ingest = IngestServer(proxy, self.profiler)
+            await ingest.start('localhost', 8097)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(
+                        'http://localhost:8097/profile?seconds=0.05&rules=0'
+                    ) as response:
+                        return response.status, await response.json()
+            finally:
+                await ingest.stop()
+
+        loop = asyncio.get_event_loop()
+        status, reply = loop.run_until_complete(post())
+
+        self.assertEqual(200, status)
+        self.assertEqual(['pstats'], list(reply['files']))
+
+    def test_http_bad_seconds(self):
+        proxy = server.Mail2AlertProxy('localhost', 8025, [self.manager])
+
+        async def post(seconds):
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    'http://localhost:8097/profile?seconds=%s' % seconds
+                ) as response:
+                    return response.status
+
+        async def posts():
+            ingest = IngestServer(proxy, self.profiler)
+            await ingest.start('localhost', 8097)
+            try:
+                return [
+                    await post(seconds)
+                    for seconds in ('inf', 'nan', '-1', '0', 'x', '1e9')
+                ]
+            finally:
+                await ingest.stop()
+
+        loop = asyncio.get_event_loop()
+
+        self.assertEqual([400] * 6, loop.run_until_complete(posts()))
+        self.assertFalse(self.profiler.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from mail2alert import server
+from mail2alert.config import Configuration
+from mail2alert.plugin import gocd, mail
+from mail2alert.reload import ConfigReloader, init_managers, make_managers
+
+CONFIGURATION = """\
+---
+local-smtp: localhost:1025
+remote-smtp: localhost:8025
+managers:
+  - name: mail
+    messages-we-want:
+      from: go@example.com
+    rules:
+      - actions:
+          - mailto:%s
+        filter:
+          function: %s
+          args:
+            - backup
+"""
+
+
+class ConfigReloaderTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'configuration.yml')
+        self.write('sys@example.com', 'mail.in_subject')
+        cnf = Configuration(self.path)
+        self.proxy = server.Mail2AlertProxy('localhost', 8025, make_managers(cnf))
+        self.reloader = ConfigReloader(self.proxy, cnf, self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, recipient, function):
+        with open(self.path, 'w') as conf_file:
+            conf_file.write(CONFIGURATION % (recipient, function))
+
+    def reload(self):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.reloader.reload())
+
+    def recipients(self):
+        msg = mail.Message(None, fields={'Subject': 'Backup failed'})
+        manager = self.proxy.mail2alert_managers[0]
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(manager.dispatch(msg))
+
+    def test_reload(self):
+        old_managers = self.proxy.mail2alert_managers
+        self.write('op@example.com', 'mail.in_subject')
+
+        self.assertTrue(self.reload())
+        self.assertIsNot(old_managers, self.proxy.mail2alert_managers)
+        self.assertEqual(['op@example.com'], self.recipients())
+
+    def test_keep_old_configuration_when_bad(self):
+        old_managers = self.proxy.mail2alert_managers
+        self.write('op@example.com', 'mail.in_body')
+
+        self.assertFalse(self.reload())
+        self.assertIs(old_managers, self.proxy.mail2alert_managers)
+        self.assertEqual(['sys@example.com'], self.recipients())
+
+    def test_changed(self):
+        self.assertFalse(self.reloader.changed())
+        self.write('someone.else@example.com', 'mail.in_subject')
+        os.utime(self.path, ns=(0, 0))
+
+        self.assertTrue(self.reloader.changed())
+        self.assertFalse(self.reloader.changed())
+
+
+class AdoptTests(unittest.TestCase):
+    conf = {
+        'name': 'gocd',
+        'url': 'http://localhost:8153/go',
+        'messages-we-want': {'to': 'mail2alert@example.com'},
+        'rules': [],
+    }
+
+    def test_adopt_unchanged_server(self):
+        old = gocd.Manager(self.conf)
+        old.previous_pipeline_state['p1/build'] = gocd.BuildStateFailure()
+        server = old.default_server
+        new = gocd.Manager(dict(self.conf, rules=[{'actions': []}]))
+
+        new.adopt(old)
+
+        self.assertIs(server, new.default_server)
+        self.assertEqual('Failure', new.previous_pipeline_state['p1/build'].status)
+
+    def test_old_manager_works_until_replaced(self):
+        old = gocd.Manager(self.conf)
+        new = gocd.Manager(dict(self.conf, rules=[{'actions': []}]))
+        new.adopt(old)
+        closed = []
+        old.default_server.close = lambda: closed.append(True) or asyncio.sleep(0)
+
+        msg = old.get_message(None, fields={'Subject': 'Stage [p1/1/build/1] failed'})
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(old.close())
+
+        self.assertEqual('FAILS', msg['event'].name)
+        self.assertEqual([], closed)
+
+    def test_keep_state_of_changed_server(self):
+        old = gocd.Manager(self.conf)
+        old.previous_pipeline_state['p1/build'] = gocd.BuildStateFailure()
+        old.default_server._pipeline_groups = [{'name': 'g1', 'pipelines': []}]
+        new = gocd.Manager(dict(self.conf, user='olle'))
+
+        new.adopt(old)
+
+        self.assertIsNot(old.default_server, new.default_server)
+        self.assertEqual('Failure', new.previous_pipeline_state['p1/build'].status)
+        self.assertEqual(
+            [{'name': 'g1', 'pipelines': []}],
+            new.default_server._pipeline_groups
+        )
+
+    def test_new_state_limits(self):
+        old = gocd.Manager(dict(self.conf, **{'state-max-stages': 10}))
+        for i in range(3):
+            old.previous_pipeline_state['p%i/build' % i] = gocd.BuildStateFailure()
+        new = gocd.Manager(dict(self.conf, **{'state-max-stages': 2, 'state-ttl-days': 1}))
+
+        new.adopt(old)
+
+        states = new.previous_pipeline_state
+        self.assertEqual(2, states.max_size)
+        self.assertEqual(24 * 3600, states.ttl)
+        self.assertEqual(['p1/build', 'p2/build'], list(states))
+
+    def test_new_server_starts_cold(self):
+        old = gocd.Manager(self.conf)
+        old.previous_pipeline_state['p1/build'] = gocd.BuildStateFailure()
+        new = gocd.Manager(dict(self.conf, url='http://elsewhere:8153/go'))
+
+        new.adopt(old)
+
+        self.assertEqual('Unknown', new.previous_pipeline_state['p1/build'].status)
+
+    def test_adopt_slack_client(self):
+        conf = {'slack-token': 'xoxb-1', 'rules': [{'actions': ['slack:#a']}]}
+        old = mail.Manager(conf)
+        old.slack = object()
+        new = mail.Manager(dict(conf, rules=[{'actions': ['slack:#b']}]))
+
+        new.adopt(old)
+
+        self.assertIs(old.slack, new.slack)
+        self.assertFalse(old.owns(old.slack))
+        self.assertTrue(new.owns(new.slack))
+
+
+class SlowManager(mail.Manager):
+    def __init__(self, conf, delay):
+        super().__init__(conf)
+        self.delay = delay
+        self.initialized = False
+
+    async def async_init(self):
+        await asyncio.sleep(self.delay)
+        if self.delay < 0:
+            raise RuntimeError('broken')
+        self.initialized = True
+
+
+class InitManagersTests(unittest.TestCase):
+    def init(self, managers):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(init_managers(managers))
+
+    def test_concurrent(self):
+        managers = [SlowManager({'name': 'm%i' % i}, 0.1) for i in range(5)]
+
+        timings = self.init(managers)
+
+        self.assertEqual(['m0', 'm1', 'm2', 'm3', 'm4'], [name for name, _ in timings])
+        self.assertLess(max(seconds for _, seconds in timings), 0.4)
+        self.assertTrue(all(manager.initialized for manager in managers))
+
+    def test_timeout_continues_in_background(self):
+        slow = SlowManager({'name': 'slow', 'init-timeout': 0.05}, 0.2)
+        fast = SlowManager({'name': 'fast'}, 0)
+
+        with self.assertLogs(level='WARNING'):
+            timings = self.init([slow, fast])
+
+        self.assertLess(dict(timings)['slow'], 0.2)
+        self.assertFalse(slow.initialized)
+        self.assertTrue(fast.initialized)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertTrue(slow.initialized)
+
+    def test_failure_does_not_stop_others(self):
+        broken = SlowManager({'name': 'broken'}, -1)
+        fine = SlowManager({'name': 'fine'}, 0)
+
+        with self.assertLogs(level='ERROR'):
+            self.init([broken, fine])
+
+        self.assertTrue(fine.initialized)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import asyncio
 import unittest
 import json
 import logging
@@ -8,6 +9,7 @@ from email import message_from_bytes
 from multiprocessing import Process
 from http.server import SimpleHTTPRequestHandler
 from time import sleep
+from unittest.mock import patch
 
 
 from mail2alert import server
@@ -98,6 +100,83 @@ class UpdateMailTests(unittest.TestCase):
         self.assertEqual(msg, new)
 
 
+class StartupTimerTests(unittest.TestCase):
+    def test_report(self):
+        now = [10.0]
+        timer = server.StartupTimer(clock=lambda: now[0])
+
+        with timer.phase('configuration'):
+            now[0] += 0.25
+        timer.record('init gocd', 1.5)
+        now[0] += 1.5
+
+        self.assertEqual(
+            [('configuration', 250.0), ('init gocd', 1500.0), ('total', 1750.0)],
+            list(timer.report().items())
+        )
+
+    def test_phase_recorded_on_error(self):
+        timer = server.StartupTimer()
+
+        with self.assertRaises(ValueError):
+            with timer.phase('configuration'):
+                raise ValueError
+
+        self.assertEqual(['configuration', 'total'], list(timer.report()))
+
+
+class LifecycleTests(unittest.TestCase):
+    def test_shutdown_in_reverse_order(self):
+        stopped = []
+
+        async def stop_async(name):
+            stopped.append(name)
+
+        def fail():
+            raise RuntimeError('Oops')
+
+        lifecycle = server.Lifecycle()
+        lifecycle.on_shutdown(lambda: stopped.append('first'))
+        lifecycle.on_shutdown(lambda: stop_async('second'))
+        lifecycle.on_shutdown(fail)
+        lifecycle.on_shutdown(lambda: stopped.append('last'))
+
+        with self.assertLogs(level='ERROR'):
+            asyncio.get_event_loop().run_until_complete(lifecycle.shutdown())
+
+        self.assertEqual(['last', 'second', 'first'], stopped)
+
+    def test_shutdown_hook_timeout(self):
+        stopped = []
+        lifecycle = server.Lifecycle(timeout=0.01)
+        lifecycle.on_shutdown(lambda: stopped.append('first'))
+        lifecycle.on_shutdown(lambda: asyncio.sleep(10))
+
+        with self.assertLogs(level='ERROR'):
+            asyncio.get_event_loop().run_until_complete(lifecycle.shutdown())
+
+        self.assertEqual(['first'], stopped)
+
+
+class UseEventLoopTests(unittest.TestCase):
+    def test_asyncio(self):
+        self.assertEqual('asyncio', server.use_event_loop('asyncio'))
+
+    def test_from_environment(self):
+        env = dict(MAIL2ALERT_EVENT_LOOP='asyncio')
+        self.assertEqual('asyncio', server.use_event_loop(env=env))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            server.use_event_loop('tokio')
+
+    def test_auto_without_uvloop(self):
+        with patch.dict('sys.modules', {'uvloop': None}):
+            self.assertEqual('asyncio', server.use_event_loop('auto'))
+            with self.assertRaises(ValueError):
+                server.use_event_loop('uvloop')
+
+
 class MyWebRequestHandler(SimpleHTTPRequestHandler):
     def do_GET(self):
         pipeline_groups = [
@@ -139,6 +218,10 @@ class SelfTestTests(unittest.TestCase):
     def tearDownClass(cls):
         cls.webserver.terminate()
 
+    def tearDown(self):
+        # asyncio.run leaves no current event loop, which other tests expect.
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
     def test_self_test_yaml(self):
         expected_yaml = (
             'gocd:\n'
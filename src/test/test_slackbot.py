@@ -1,9 +1,14 @@
 import asyncio
 import unittest
+from unittest.mock import patch
 from asynctest import CoroutineMock
 
-from mail2alert.slackbot import SlackMessage
-from mail2alert.plugin.mail import Message
+from aiohttp import web
+
+from mail2alert.slackbot import (
+    SlackClient, SlackError, SlackMessage, SlackRateLimited, SlackThreads
+)
+from mail2alert.plugin.mail import Manager, Message
 
 
 class SlackMessageTests(unittest.TestCase):
@@ -22,10 +27,9 @@ class SlackMessageTests(unittest.TestCase):
         self.assertEqual('Message from: a@b', sm.text)
         self.assertEqual(attachment, sm.full_attachment)
 
-    def test_post_messages(self):
-        SlackMessage.post_full = CoroutineMock()
-        SlackMessage.post_brief = CoroutineMock()
-
+    @patch.object(SlackMessage, 'post_brief', new_callable=CoroutineMock)
+    @patch.object(SlackMessage, 'post_full', new_callable=CoroutineMock)
+    def test_post_messages(self, post_full, post_brief):
         class MockAction:
             def __init__(self, destination, style):
                 self.destination = destination
@@ -40,8 +44,201 @@ class SlackMessageTests(unittest.TestCase):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(sm.post(slactions))
 
-        SlackMessage.post_full.assert_called_once()
-        SlackMessage.post_brief.assert_called_once()
+        post_full.assert_called_once()
+        post_brief.assert_called_once()
+
+    def test_post_channels_concurrently(self):
+        class SlowSlack:
+            def __init__(self):
+                self.in_flight = 0
+                self.most_in_flight = 0
+                self.posted = []
+
+            async def post_message(self, channel, text='', attachments=None):
+                self.in_flight += 1
+                self.most_in_flight = max(self.most_in_flight, self.in_flight)
+                await asyncio.sleep(0.01)
+                self.in_flight -= 1
+                if channel == '#broken':
+                    raise SlackError('channel_not_found')
+                self.posted.append(channel)
+
+        class MockAction:
+            def __init__(self, destination):
+                self.destination = destination
+                self.style = 'brief'
+
+        channels = ['#c%i' % i for i in range(5)] + ['#broken']
+        slack = SlowSlack()
+        m = Message(b'message')
+        m['Subject'] = 'sub'
+        sm = SlackMessage(m)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(
+            sm.post([MockAction(c) for c in channels], slack, concurrency=3)
+        )
+
+        self.assertEqual(3, slack.most_in_flight)
+        self.assertEqual(channels[:-1], sorted(slack.posted))
+
+
+class SlackClientTests(unittest.TestCase):
+    def test_posts_share_session(self):
+        calls = []
+
+        async def post_message(request):
+            body = await request.json()
+            calls.append((request.headers['Authorization'], body['channel']))
+            if body['channel'] == '#busy':
+                return web.json_response(
+                    {'ok': False, 'error': 'ratelimited'},
+                    status=429,
+                    headers={'Retry-After': '7'}
+                )
+            if body['channel'] == '#nowhere':
+                return web.json_response({'ok': False, 'error': 'channel_not_found'})
+            return web.json_response({'ok': True})
+
+        async def post():
+            app = web.Application()
+            app.router.add_post('/api/chat.postMessage', post_message)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, 'localhost', 8093).start()
+            slack = SlackClient('xoxb-1', 'http://localhost:8093/api')
+            try:
+                await slack.post_message('#one', text='1')
+                session = slack.session
+                await slack.post_message('#two', text='2')
+                self.assertIs(session, slack.session)
+                with self.assertRaises(SlackError):
+                    await slack.post_message('#nowhere')
+                with self.assertRaises(SlackRateLimited) as context:
+                    await slack.post_message('#busy')
+                self.assertEqual(7.0, context.exception.retry_after)
+            finally:
+                await slack.close()
+                await runner.cleanup()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(post())
+
+        self.assertEqual(
+            [
+                ('Bearer xoxb-1', '#one'),
+                ('Bearer xoxb-1', '#two'),
+                ('Bearer xoxb-1', '#nowhere'),
+                ('Bearer xoxb-1', '#busy'),
+            ],
+            calls
+        )
+
+    def test_manager_creates_client_once(self):
+        manager = Manager({
+            'slack-token': 'xoxb-2',
+            'rules': [{'actions': ['slack:#ops'], 'filter': {}}],
+        })
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(manager.async_init())
+        slack = manager.slack
+        loop.run_until_complete(manager.async_init())
+
+        self.assertIs(slack, manager.slack)
+        self.assertEqual('xoxb-2', slack.token)
+
+    def test_manager_without_slack_rules(self):
+        manager = Manager({'rules': [{'actions': ['mailto:a@example.com']}]})
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(manager.async_init())
+
+        self.assertIsNone(manager.slack)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ThreadingSlack:
+    def __init__(self):
+        self.calls = []
+
+    async def post_message(self, channel, text='', attachments=None, **options):
+        ts = '%i.0' % (len(self.calls) + 1)
+        self.calls.append(('post', channel, options.get('thread_ts')))
+        return {'ok': True, 'channel': 'C' + channel[1:], 'ts': ts}
+
+    async def update_message(self, channel, ts, text='', attachments=None):
+        self.calls.append(('update', channel, ts))
+        return {'ok': True, 'channel': channel, 'ts': ts}
+
+
+class SlackThreadsTests(unittest.TestCase):
+    def test_expiry(self):
+        clock = Clock()
+        threads = SlackThreads(max_age=10, clock=clock)
+        threads.start(('p1', '#a'), 'CA', '1.0')
+        clock.now = 5
+
+        self.assertEqual(('CA', '1.0'), threads.get(('p1', '#a')))
+        clock.now = 11
+        self.assertIsNone(threads.get(('p1', '#a')))
+        self.assertEqual(0, len(threads))
+
+    def test_max_size(self):
+        threads = SlackThreads(max_size=2)
+        threads.start(('p1', '#a'), 'CA', '1.0')
+        threads.start(('p2', '#a'), 'CA', '2.0')
+        threads.start(('p3', '#a'), 'CA', '3.0')
+
+        self.assertIsNone(threads.get(('p1', '#a')))
+        self.assertEqual(('CA', '3.0'), threads.get(('p3', '#a')))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            SlackThreads(mode='shout')
+
+    def post(self, threads, *pipelines):
+        slack = ThreadingSlack()
+        loop = asyncio.get_event_loop()
+        for pipeline in pipelines:
+            m = Message(b'message')
+            m['Subject'] = 'sub'
+            if pipeline:
+                m['pipeline'] = pipeline
+            loop.run_until_complete(
+                SlackMessage(m).post_to(slack, '#a', 'brief', threads)
+            )
+        return slack.calls
+
+    def test_reply_in_thread(self):
+        calls = self.post(SlackThreads('thread'), 'p1', 'p1', 'p2', 'p1', None)
+
+        self.assertEqual(
+            [
+                ('post', '#a', None),
+                ('post', '#a', '1.0'),
+                ('post', '#a', None),
+                ('post', '#a', '1.0'),
+                ('post', '#a', None),
+            ],
+            calls
+        )
+
+    def test_update_in_place(self):
+        calls = self.post(SlackThreads('update'), 'p1', 'p1', 'p1')
+
+        self.assertEqual(
+            [
+                ('post', '#a', None),
+                ('update', 'Ca', '1.0'),
+                ('update', 'Ca', '1.0'),
+            ],
+            calls
+        )
 
 
 if __name__ == '__main__':
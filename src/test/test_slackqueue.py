@@ -0,0 +1,166 @@
+import asyncio
+import unittest
+
+from mail2alert.plugin.mail import Message
+from mail2alert.slackbot import SlackError, SlackMessage, SlackRateLimited, SlackUnavailable
+from mail2alert.slackqueue import SlackDispatcher, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Action:
+    def __init__(self, destination, style='brief'):
+        self.destination = destination
+        self.style = style
+
+
+class FakeSlack:
+    """
+    Raises the errors in failures, in order, before it starts posting.
+    """
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.posts = []
+
+    async def post_message(self, channel, text='', attachments=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.posts.append((channel, attachments[0]['title']))
+        return {'ok': True}
+
+
+def slack_message(subject):
+    msg = Message(b'body\n')
+    msg['Subject'] = subject
+    msg['From'] = 'go@example.com'
+    return SlackMessage(msg)
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_burst_then_rate(self):
+        clock = Clock()
+        bucket = TokenBucket(rate=1.0, capacity=2, clock=clock)
+
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        self.assertAlmostEqual(1.0, bucket.reserve())
+        self.assertAlmostEqual(2.0, bucket.reserve())
+
+    def test_refill(self):
+        clock = Clock()
+        bucket = TokenBucket(rate=2.0, capacity=2, clock=clock)
+        bucket.reserve()
+        bucket.reserve()
+        clock.now = 0.5
+
+        self.assertEqual(0, bucket.reserve())
+        self.assertAlmostEqual(0.5, bucket.reserve())
+
+
+class SlackDispatcherTests(unittest.TestCase):
+    def dispatch(self, dispatcher, *messages):
+        async def run():
+            for subject, channels in messages:
+                dispatcher.submit(
+                    slack_message(subject),
+                    [Action(channel) for channel in channels]
+                )
+            await dispatcher.join()
+            await dispatcher.close()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run())
+
+    def test_posts_in_order_per_channel(self):
+        slack = FakeSlack()
+        dispatcher = SlackDispatcher(slack, rate=1000, burst=10)
+
+        self.dispatch(
+            dispatcher,
+            ('one', ['#a', '#b']),
+            ('two', ['#a']),
+        )
+
+        self.assertEqual(
+            [('#a', 'one'), ('#a', 'two')],
+            [post for post in slack.posts if post[0] == '#a']
+        )
+        self.assertIn(('#b', 'one'), slack.posts)
+        self.assertEqual(0, dispatcher.pending)
+
+    def test_retries(self):
+        slack = FakeSlack(
+            SlackRateLimited('rate limited', 0.01),
+            SlackUnavailable('HTTP 503'),
+        )
+        dispatcher = SlackDispatcher(slack, rate=1000, burst=10, backoff=0.01)
+
+        self.dispatch(dispatcher, ('one', ['#a']))
+
+        self.assertEqual([('#a', 'one')], slack.posts)
+
+    def test_gives_up(self):
+        slack = FakeSlack(*[SlackUnavailable('HTTP 503')] * 3)
+        dispatcher = SlackDispatcher(
+            slack, rate=1000, burst=10, max_retries=2, backoff=0.01
+        )
+
+        self.dispatch(dispatcher, ('one', ['#a']), ('two', ['#a']))
+
+        self.assertEqual([('#a', 'two')], slack.posts)
+
+    def test_no_retry_of_permanent_errors(self):
+        slack = FakeSlack(SlackError('channel_not_found'))
+        dispatcher = SlackDispatcher(slack, rate=1000, burst=10, backoff=0.01)
+
+        self.dispatch(dispatcher, ('one', ['#a']), ('two', ['#a']))
+
+        self.assertEqual([('#a', 'two')], slack.posts)
+
+    def test_drops_when_full(self):
+        slack = FakeSlack()
+        dispatcher = SlackDispatcher(slack, max_pending=2, rate=1000, burst=10)
+
+        self.dispatch(dispatcher, ('one', ['#a', '#b', '#c']))
+
+        self.assertEqual(2, len(slack.posts))
+
+    def test_concurrency_over_channels(self):
+        class SlowSlack(FakeSlack):
+            in_flight = 0
+            most_in_flight = 0
+
+            async def post_message(self, channel, text='', attachments=None):
+                self.in_flight += 1
+                self.most_in_flight = max(self.most_in_flight, self.in_flight)
+                await asyncio.sleep(0.01)
+                self.in_flight -= 1
+                return await super().post_message(channel, text, attachments)
+
+        slack = SlowSlack()
+        dispatcher = SlackDispatcher(slack, rate=1000, burst=10, concurrency=2)
+
+        self.dispatch(dispatcher, ('one', ['#a', '#b', '#c', '#d']))
+
+        self.assertEqual(4, len(slack.posts))
+        self.assertEqual(2, slack.most_in_flight)
+
+    def test_from_conf(self):
+        dispatcher = SlackDispatcher.from_conf(
+            None,
+            {'max-pending': 10, 'rate': 0.5, 'max-retries': 1}
+        )
+
+        self.assertEqual(10, dispatcher.max_pending)
+        self.assertEqual(0.5, dispatcher.rate)
+        self.assertEqual(1, dispatcher.max_retries)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from mail2alert.snapshot import Snapshot
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'test.snapshot')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_load_missing(self):
+        self.assertIsNone(Snapshot(self.path).load())
+
+    def test_record_and_load(self):
+        snapshot = Snapshot(self.path)
+        snapshot.record('a', 1)
+        snapshot.record('b', [1, 2])
+        snapshot.record('a', 3)
+        snapshot.close()
+
+        self.assertEqual({'a': 3, 'b': [1, 2]}, Snapshot(self.path).load())
+
+    def test_compaction(self):
+        snapshot = Snapshot(self.path, compact_after=2)
+        for i in range(3):
+            snapshot.record('a', i)
+        self.assertTrue(snapshot.needs_compaction)
+
+        asyncio.get_event_loop().run_until_complete(snapshot.compact([('a', 2)]))
+
+        self.assertFalse(snapshot.needs_compaction)
+        with open(self.path) as journal:
+            self.assertEqual(['["a", 2]\n'], journal.readlines())
+
+    def test_record_while_compacting(self):
+        snapshot = Snapshot(self.path, compact_after=2)
+        for i in range(3):
+            snapshot.record('a', i)
+
+        async def compact():
+            task = snapshot.compact([('a', 2)])
+            self.assertFalse(snapshot.needs_compaction)
+            snapshot.record('b', 1)
+            await task
+
+        asyncio.get_event_loop().run_until_complete(compact())
+        snapshot.record('a', 3)
+        snapshot.close()
+
+        with open(self.path) as journal:
+            self.assertEqual(
+                ['["a", 2]\n', '["b", 1]\n', '["a", 3]\n'],
+                journal.readlines()
+            )
+        self.assertEqual({'a': 3, 'b': 1}, Snapshot(self.path).load())
+
+    def test_torn_record(self):
+        with open(self.path, 'w') as journal:
+            journal.write('["a", 1]\n["b", ')
+        snapshot = Snapshot(self.path)
+
+        self.assertEqual({'a': 1}, snapshot.load())
+        snapshot.record('c', 3)
+        snapshot.close()
+
+        self.assertEqual({'a': 1, 'c': 3}, Snapshot(self.path).load())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from unittest import mock
+
+from mail2alert.stagestate import StageStates
+
+
+class Unknown:
+    pass
+
+
+class Good:
+    pass
+
+
+class Bad:
+    pass
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StageStatesTests(unittest.TestCase):
+    def test_lookup_does_not_insert(self):
+        states = StageStates((Unknown, Good, Bad))
+
+        self.assertIsInstance(states['p/s'], Unknown)
+        self.assertEqual(0, len(states))
+        self.assertNotIn('p/s', states)
+        self.assertIsNone(states.get('p/s'))
+
+    def test_set_and_get(self):
+        states = StageStates((Unknown, Good, Bad))
+
+        states['p1/build'] = Good()
+        states['p1/test'] = Bad()
+        states['p2/build'] = Bad()
+
+        self.assertIsInstance(states['p1/build'], Good)
+        self.assertIsInstance(states['p1/test'], Bad)
+        self.assertIsInstance(states['p2/build'], Bad)
+        self.assertEqual(['p1/build', 'p1/test', 'p2/build'], sorted(states))
+
+    def test_set_default_removes(self):
+        states = StageStates((Unknown, Good, Bad))
+        states['p/s'] = Bad()
+
+        states['p/s'] = Unknown()
+
+        self.assertEqual(0, len(states))
+        self.assertEqual({}, states._pipelines.ids)
+        self.assertEqual({}, states._stages.ids)
+
+    def test_ttl(self):
+        clock = Clock()
+        states = StageStates((Unknown, Good, Bad), ttl=100, clock=clock)
+        states['old/s'] = Good()
+        clock.now += 60
+        states['new/s'] = Bad()
+        clock.now += 60
+
+        self.assertEqual(1, states.expire())
+        self.assertEqual(['new/s'], list(states))
+
+    def test_max_size_drops_least_recently_set(self):
+        states = StageStates((Unknown, Good, Bad), max_size=2)
+        states['a/s'] = Good()
+        states['b/s'] = Good()
+        states['a/s'] = Bad()
+        states['c/s'] = Good()
+
+        self.assertEqual(['a/s', 'c/s'], sorted(states))
+
+    @mock.patch('mail2alert.stagestate.STAGE_BITS', 2)
+    def test_too_many_stage_names(self):
+        states = StageStates((Unknown, Good, Bad))
+        for stage in range(4):
+            states['p/%i' % stage] = Good()
+
+        with self.assertRaises(ValueError):
+            states['q/4'] = Good()
+
+        self.assertEqual(['p/0', 'p/1', 'p/2', 'p/3'], sorted(states))
+        self.assertNotIn('q', states._pipelines.ids)
+        self.assertNotIn('4', states._stages.ids)
+        states['q/3'] = Bad()
+        self.assertIsInstance(states['q/3'], Bad)
+
+    def test_on_expire(self):
+        expired = []
+        states = StageStates((Unknown, Good, Bad), max_size=1, on_expire=expired.append)
+        states['a/s'] = Good()
+        states['b/s'] = Good()
+        states['b/s'] = Unknown()
+
+        self.assertEqual(['a/s'], expired)
+
+    def test_slots_are_reused(self):
+        states = StageStates((Unknown, Good, Bad), max_size=1)
+        for i in range(10):
+            states['p%i/s' % i] = Good()
+
+        self.assertEqual(2, len(states._state_codes))
+        self.assertEqual(['p9/s'], list(states))
+
+
+if __name__ == '__main__':
+    unittest.main()
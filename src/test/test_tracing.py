@@ -0,0 +1,151 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from mail2alert import tracing
+from mail2alert.plugin import mail
+from mail2alert.tracing import NO_SPAN, client_span, span, start_trace
+
+
+class TracingTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'traces.jsonl')
+        self.tracer = tracing.configure({
+            'file': self.path,
+            'sample-rate': 0,
+            'slow-ms': 50,
+        })
+
+    def tearDown(self):
+        tracing.configure(None)
+        self.dir.cleanup()
+
+    def traces(self):
+        self.tracer.flush()
+        with open(self.path) as traces_file:
+            return [json.loads(line) for line in traces_file]
+
+    @staticmethod
+    def spans(trace):
+        return trace['resourceSpans'][0]['scopeSpans'][0]['spans']
+
+    def test_off_without_configuration(self):
+        tracing.configure(None)
+
+        self.assertIs(NO_SPAN, start_trace('smtp message'))
+        self.assertIs(NO_SPAN, span('rules'))
+
+    def test_no_span_outside_trace(self):
+        self.assertIs(NO_SPAN, span('rules'))
+
+    def test_slow_trace_kept(self):
+        with start_trace('smtp message', peer='127.0.0.1') as root:
+            with span('manager', manager='gocd'):
+                with client_span('GET', url='http://go/cctray.xml'):
+                    time.sleep(0.06)
+
+        [trace] = self.traces()
+        get, manager, message = self.spans(trace)
+        self.assertEqual(['GET', 'manager', 'smtp message'], [
+            s['name'] for s in (get, manager, message)
+        ])
+        self.assertEqual({root.trace_id}, {s['traceId'] for s in (get, manager, message)})
+        self.assertEqual(manager['spanId'], get['parentSpanId'])
+        self.assertEqual(message['spanId'], manager['parentSpanId'])
+        self.assertNotIn('parentSpanId', message)
+        self.assertEqual(tracing.SPAN_KIND_CLIENT, get['kind'])
+        self.assertEqual(
+            [{'key': 'manager', 'value': {'stringValue': 'gocd'}}],
+            manager['attributes']
+        )
+        self.assertLess(int(message['startTimeUnixNano']), int(message['endTimeUnixNano']))
+
+    def test_written_on_close(self):
+        self.tracer.sample_rate = 1
+        with start_trace('smtp message'):
+            pass
+
+        tracing.configure(None)
+
+        with open(self.path) as traces_file:
+            self.assertEqual(1, len(traces_file.readlines()))
+
+    def test_fast_trace_dropped(self):
+        with start_trace('smtp message'):
+            with span('manager'):
+                pass
+
+        self.assertFalse(os.path.exists(self.path) and self.traces())
+
+    def test_error_trace_kept(self):
+        with self.assertRaises(ValueError):
+            with start_trace('smtp message'):
+                with span('manager'):
+                    raise ValueError('bad')
+
+        [trace] = self.traces()
+        manager = self.spans(trace)[0]
+        self.assertEqual(
+            {'code': tracing.STATUS_ERROR, 'message': 'ValueError: bad'},
+            manager['status']
+        )
+
+    def test_sampled(self):
+        self.tracer.sample_rate = 0.5
+        self.tracer.rng = iter([0.2, 0.7]).__next__
+
+        for _ in range(2):
+            with start_trace('smtp message'):
+                pass
+
+        self.assertEqual(1, len(self.traces()))
+
+    def test_spans_after_trace_are_not_recorded(self):
+        async def late():
+            await asyncio.sleep(0.01)
+            return span('slack post')
+
+        async def message():
+            with start_trace('smtp message'):
+                task = asyncio.ensure_future(late())
+            return await task
+
+        loop = asyncio.get_event_loop()
+        self.assertIs(NO_SPAN, loop.run_until_complete(message()))
+
+    def test_rules_span(self):
+        self.tracer.sample_rate = 1
+        manager = mail.Manager({
+            'name': 'mail',
+            'rules': [{
+                'actions': ['mailto:sys@example.com'],
+                'filter': {'function': 'mail.in_subject', 'args': ['backup']},
+            }],
+        })
+
+        async def dispatch():
+            with start_trace('event'):
+                msg = mail.Message(None, fields={'Subject': 'Backup failed'})
+                return await manager.dispatch(msg)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(dispatch())
+
+        [trace] = self.traces()
+        rules = self.spans(trace)[0]
+        self.assertEqual('rules', rules['name'])
+        self.assertEqual(
+            [
+                {'key': 'rules', 'value': {'intValue': '1'}},
+                {'key': 'targets', 'value': {'intValue': '1'}},
+            ],
+            rules['attributes']
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
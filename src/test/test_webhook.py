@@ -0,0 +1,163 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+
+from mail2alert.actions import Actions
+from mail2alert.plugin.mail import Manager, Message
+from mail2alert.webhook import WebhookSender, check_template, render
+
+
+def make_message(subject):
+    msg = Message(None, fields={'Subject': subject, 'From': 'go@example.com'}, body='Body')
+    msg['pipeline'] = 'p1'
+    return msg
+
+
+class StandIn:
+    """
+    A webhook which answers with the statuses in failures, in order,
+    before it starts accepting posts.
+    """
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.received = []
+        self.app = web.Application()
+        self.app.router.add_post('/hook', self.hook)
+
+    async def hook(self, request):
+        data = await request.json()
+        if self.failures:
+            return web.Response(status=self.failures.pop(0))
+        self.received.append(data)
+        return web.json_response({'ok': True})
+
+    def run(self, sender, *messages, actions=('webhook:http://localhost:8094/hook',)):
+        async def run():
+            runner = web.AppRunner(self.app)
+            await runner.setup()
+            await web.TCPSite(runner, 'localhost', 8094).start()
+            try:
+                for msg in messages:
+                    sender.submit(msg, Actions(actions).webhook)
+                await sender.join()
+            finally:
+                await sender.close()
+                await runner.cleanup()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run())
+        return self.received
+
+
+class RenderTests(unittest.TestCase):
+    def test_render(self):
+        template = {'title': '{subject}', 'tags': ['{pipeline}', 'ci'], 'n': 1}
+
+        self.assertEqual(
+            {'title': 'Broken', 'tags': ['', 'ci'], 'n': 1},
+            render(template, {'subject': 'Broken'})
+        )
+
+    def test_check_template(self):
+        check_template('good', {'title': '{subject}', 'tags': ['{pipeline}']})
+        for template in ('{subject.x}', '{subject[9]}', {'title': '{subject'}, '{0}'):
+            with self.assertRaises(ValueError):
+                check_template('bad', template)
+
+
+class WebhookSenderTests(unittest.TestCase):
+    def test_default_payload(self):
+        received = StandIn().run(WebhookSender(), make_message('Broken'))
+
+        self.assertEqual(1, len(received))
+        self.assertEqual('Broken', received[0]['subject'])
+        self.assertEqual('go@example.com', received[0]['from'])
+        self.assertEqual('p1', received[0]['pipeline'])
+        self.assertEqual('Body', received[0]['body'])
+
+    def test_template(self):
+        sender = WebhookSender(templates={'incident': {'title': '{pipeline}: {subject}'}})
+
+        received = StandIn().run(
+            sender,
+            make_message('Broken'),
+            actions=['webhook:http://localhost:8094/hook#incident']
+        )
+
+        self.assertEqual([{'title': 'p1: Broken'}], received)
+
+    def test_batch(self):
+        sender = WebhookSender(batch_size=2, batch_delay=0.01)
+
+        received = StandIn().run(
+            sender,
+            make_message('one'),
+            make_message('two'),
+            make_message('three'),
+        )
+
+        self.assertEqual(
+            [['one', 'two'], ['three']],
+            sorted([event['subject'] for event in batch] for batch in received)
+        )
+
+    def test_retry(self):
+        sender = WebhookSender(backoff=0.01)
+
+        received = StandIn(503, 429).run(sender, make_message('Broken'))
+
+        self.assertEqual(['Broken'], [event['subject'] for event in received])
+
+    def test_bad_template(self):
+        with self.assertRaises(ValueError):
+            WebhookSender(templates={'incident': {'title': '{subject.x}'}})
+        with self.assertRaises(ValueError):
+            Manager({
+                'rules': [],
+                'webhooks': {'templates': {'incident': '{subject[9]}'}},
+            }).validate()
+
+    def test_template_error_skips_action(self):
+        sender = WebhookSender()
+        # As if it had got past check_template.
+        sender.templates['incident'] = '{subject[9]}'
+
+        received = StandIn().run(
+            sender,
+            make_message('Broken'),
+            actions=[
+                'webhook:http://localhost:8094/hook#incident',
+                'webhook:http://localhost:8094/hook',
+            ]
+        )
+
+        self.assertEqual(['Broken'], [event['subject'] for event in received])
+
+    def test_max_pending(self):
+        sender = WebhookSender(backoff=0.01, max_pending=1)
+
+        received = StandIn(503, 503).run(
+            sender,
+            make_message('one'),
+            make_message('two')
+        )
+
+        self.assertEqual(1, len(received))
+        self.assertEqual(1, sender.status()['dropped'])
+        self.assertEqual(0, sender.status()['retrying'])
+
+    def test_no_retry_when_refused(self):
+        sender = WebhookSender(backoff=0.01)
+
+        received = StandIn(400).run(
+            sender,
+            make_message('one'),
+            make_message('two')
+        )
+
+        self.assertEqual(1, len(received))
+
+
+if __name__ == '__main__':
+    unittest.main()